@@ -1,8 +1,38 @@
 # audio_utils.py
+import io
+import struct
+import logging
 import numpy as np
 import random
+import soundfile as sf
+from functools import lru_cache
 
-# หมายเหตุ: ไม่ต้อง import soundfile แล้ว เพราะเราไม่ได้อ่านไฟล์ Ref มาทำ room tone อีกต่อไป
+import observability
+
+logger = logging.getLogger(__name__)
+
+# หมายเหตุ: room tone ไม่ได้อ่านไฟล์ Ref แล้ว (soundfile ใช้เฉพาะ load_audio)
+
+def load_audio(source, target_sr=24000):
+    """
+    Decode ไฟล์เสียง (path, bytes หรือ file-like) เป็น mono float32 ที่ target_sr
+    """
+    if isinstance(source, (bytes, bytearray)):
+        source = io.BytesIO(source)
+    wav, sr = sf.read(source, dtype='float32', always_2d=True)
+    wav = wav.mean(axis=1) if wav.shape[1] > 1 else wav[:, 0]
+    return np.ascontiguousarray(resample(wav, sr, target_sr)), target_sr
+
+def resample(wav, sr, target_sr):
+    """
+    Resample แบบ polyphase (คืน array เดิมถ้า sample rate ตรงกันอยู่แล้ว)
+    """
+    if sr == target_sr or len(wav) == 0:
+        return wav
+    from math import gcd
+    from scipy.signal import resample_poly
+    g = gcd(sr, target_sr)
+    return resample_poly(wav, target_sr // g, sr // g).astype(np.float32)
 
 def get_room_tone(audio_path, duration=0.5, target_sr=24000):
     """
@@ -12,11 +42,22 @@ def get_room_tone(audio_path, duration=0.5, target_sr=24000):
     # ไม่ต้องอ่านไฟล์ ไม่ต้องคำนวณ RMS แค่สร้าง array 0 ก็พอ
     # ประสิทธิภาพสูงมาก (O(1) relative to IO)
     # audio_path ถูกรับมาเพื่อให้ signature ตรงกับโค้ดเก่าใน main.py แต่ไม่ได้ถูกใช้
-    return np.zeros(int(duration * target_sr))
+    return np.zeros(int(duration * target_sr), dtype=np.float32)
+
+@lru_cache(maxsize=64)
+def _fade_curves(fade_samples):
+    """
+    (fade_in, fade_out) ความยาว fade_samples (cache ตามความยาว ไม่ต้อง linspace ใหม่ทุก Segment)
+    """
+    fade_in = np.linspace(0, 1, fade_samples)
+    fade_out = np.linspace(1, 0, fade_samples)
+    fade_in.flags.writeable = False
+    fade_out.flags.writeable = False
+    return fade_in, fade_out
 
 def apply_fade(audio, fade_duration=0.02, sr=24000):
     """
-    ใส่ Fade In/Out
+    ใส่ Fade In/Out (แก้ array เดิม)
     """
     if len(audio) == 0: return audio
     
@@ -25,29 +66,260 @@ def apply_fade(audio, fade_duration=0.02, sr=24000):
     
     if fade_samples <= 0: return audio
     
-    fade_in_curve = np.linspace(0, 1, fade_samples)
+    fade_in_curve, fade_out_curve = _fade_curves(fade_samples)
     audio[:fade_samples] *= fade_in_curve
-    
-    fade_out_curve = np.linspace(1, 0, fade_samples)
     audio[-fade_samples:] *= fade_out_curve
     
     return audio
 
+EDGE_SCAN_CHUNK = 2048  # samples ต่อก้อนที่ใช้ไล่หาขอบเสียงจากหัว/ท้าย (~85ms ที่ 24kHz)
+
+def _sound_edges(wav, threshold, chunk=EDGE_SCAN_CHUNK):
+    """
+    index ของ sample แรก/สุดท้ายที่ |x| > threshold (None ถ้าเงียบทั้งหมด)
+    ไล่จากหัวและจากท้ายทีละก้อน (argmax ใน mask ของก้อนนั้น) จึงอ่านแค่ช่วงเงียบที่ขอบ
+    ไม่ต้องสร้าง mask/index array ขนาดเท่าเสียงทั้งก้อน
+    """
+    start = None
+    for pos in range(0, len(wav), chunk):
+        loud = np.abs(wav[pos:pos + chunk]) > threshold
+        i = int(np.argmax(loud))
+        if loud[i]:
+            start = pos + i
+            break
+    if start is None: return None
+
+    for end_pos in range(len(wav), start, -chunk):
+        loud = np.abs(wav[max(start, end_pos - chunk):end_pos]) > threshold
+        i = int(np.argmax(loud[::-1]))
+        if loud[len(loud) - 1 - i]:
+            return start, end_pos - 1 - i
+    return start, start
+
+def _trim_bounds(wav, threshold=0.005, padding=0.02, sr=24000):
+    edges = _sound_edges(wav, threshold) if len(wav) else None
+    if edges is None: return 0, len(wav)
+    pad_samples = int(padding * sr)
+    return max(0, edges[0] - pad_samples), min(len(wav), edges[1] + pad_samples)
+
 def trim_silence_numpy(wav, threshold=0.005, padding=0.02, sr=24000):
     """
     ตัดความเงียบส่วนเกิน (Auto Trim)
     """
-    if len(wav) == 0: return wav
-    
-    is_sound = np.abs(wav) > threshold
-    if not np.any(is_sound): return wav
-        
-    indices = np.where(is_sound)[0]
-    start = indices[0]
-    end = indices[-1]
-    
-    pad_samples = int(padding * sr)
-    start = max(0, start - pad_samples)
-    end = min(len(wav), end + pad_samples)
-    
+    start, end = _trim_bounds(wav, threshold, padding, sr)
     return wav[start:end]
+
+def postprocess_segments(wavs, room_tone_path=None, rng=random, trim=True, fade_duration=0.05):
+    """
+    Generator: ตัดเงียบ + Fade ให้เสียงแต่ละ Segment โดยคั่นแต่ละ Segment ด้วย Room Tone (โหมด stream)
+    rng: ส่ง random.Random(seed) เข้ามาถ้าต้องการช่วงเว้นวรรคเท่าเดิมทุกครั้ง (เช่น batch job ที่ resume)
+    """
+    for i, wav in enumerate(wavs):
+        # Insert Room Tone (ก่อน Segment ถัดไป)
+        if i > 0:
+            pause_dur = rng.uniform(0.07, 0.14)
+            room_tone = get_room_tone(room_tone_path, duration=pause_dur)
+            yield apply_fade(room_tone, fade_duration=0.02)
+
+        with observability.stage("postprocess"):
+            # 1. ตัดเงียบ (Auto Split)
+            if trim:
+                original_len = len(wav)
+                wav = trim_silence_numpy(wav, threshold=0.005, padding=0.02)
+
+                # 2. Log เฉพาะตอนที่ตัด
+                if len(wav) < original_len:
+                    logger.debug(f"Trimmed: {original_len} -> {len(wav)} samples")
+
+            # 3. ใส่ Fade ตามปกติ
+            wav = apply_fade(wav, fade_duration=fade_duration)
+        yield wav
+
+def render_segments(wavs, room_tone_path=None, rng=random, trim=True, fade_duration=0.05, sr=24000, pcm16=False):
+    """
+    ผลเหมือน np.concatenate(postprocess_segments(...)) แต่เขียนทุก Segment/ช่วงเว้นวรรคลง buffer float32
+    ก้อนเดียวที่จองไว้ล่วงหน้า (ตัดเงียบแค่คำนวณขอบ ไม่ copy) แล้ว Fade ใน buffer นั้นเลย
+    pcm16=True: แปลงเป็น int16 ใน buffer เดิม (พร้อมส่งให้ WAV writer)
+    """
+    spans = []
+    for wav in wavs:
+        with observability.stage("postprocess"):
+            wav = np.asarray(wav)
+            start, end = _trim_bounds(wav, 0.005, 0.02, sr) if trim else (0, len(wav))
+        if end - start < len(wav):
+            logger.debug(f"Trimmed: {len(wav)} -> {end - start} samples")
+        spans.append((wav, start, end))
+    if not spans:
+        raise Exception("No audio generated from segments")
+
+    with observability.stage("postprocess"):
+        # room tone เป็นความเงียบ (ดู get_room_tone) จึงแค่เว้นช่องเป็น 0 ไม่ต้องสร้าง array/Fade
+        pauses = [int(rng.uniform(0.07, 0.14) * sr) for _ in spans[1:]]
+        out = np.empty(sum(end - start for _, start, end in spans) + sum(pauses), dtype=np.float32)
+
+        pos = 0
+        for i, (wav, start, end) in enumerate(spans):
+            if i > 0:
+                out[pos:pos + pauses[i - 1]] = 0.0
+                pos += pauses[i - 1]
+            segment = out[pos:pos + end - start]
+            segment[:] = wav[start:end]
+            apply_fade(segment, fade_duration=fade_duration, sr=sr)
+            pos += end - start
+
+    if not pcm16: return out
+    with observability.stage("encode"):
+        return to_pcm16_inplace(out)
+
+# --- Streaming Output ---
+
+STREAM_LENGTH_MARKER = 0xFFFFFFFF  # ขนาดไม่ทราบล่วงหน้า (ผู้เล่นส่วนใหญ่จะอ่านไปจนจบ stream)
+
+def wav_stream_header(sr=24000, channels=1, bits=16):
+    """
+    WAV header (PCM) สำหรับ stream ที่ยังไม่รู้ความยาว: ใส่ STREAM_LENGTH_MARKER ใน RIFF/data size
+    """
+    block_align = channels * bits // 8
+    return (
+        b"RIFF" + struct.pack("<I", STREAM_LENGTH_MARKER) + b"WAVE"
+        + b"fmt " + struct.pack("<IHHIIHH", 16, 1, channels, sr, sr * block_align, block_align, bits)
+        + b"data" + struct.pack("<I", STREAM_LENGTH_MARKER)
+    )
+
+def to_pcm16(wav):
+    """
+    แปลง float (-1..1) เป็น bytes PCM 16-bit little-endian (แปลงแบบเดียวกับ to_pcm16_inplace / sf.write)
+    """
+    pcm = to_pcm16_inplace(np.array(wav, dtype=np.float32))
+    return pcm.astype('<i2', copy=False).tobytes()
+
+# --- Output Encoding ---
+
+# format -> (libsndfile format, subtype, media type)
+OUTPUT_FORMATS = {
+    "wav": ("WAV", "PCM_16", "audio/wav"),
+    "flac": ("FLAC", "PCM_16", "audio/flac"),
+    "opus": ("OGG", "OPUS", "audio/ogg"),
+}
+if "MP3" in sf.available_formats():  # libsndfile >= 1.1
+    OUTPUT_FORMATS["mp3"] = ("MP3", "MPEG_LAYER_III", "audio/mpeg")
+# FLAC/MP3 แก้ header ย้อนหลังตอนปิดไฟล์ (จำนวน sample, LAME tag) จึง stream ทีละก้อนไม่ได้
+STREAMABLE_FORMATS = ("wav", "opus")
+OUTPUT_SAMPLE_RATES = (24000, 22050, 16000)
+OPUS_SAMPLE_RATES = (48000, 24000, 16000, 12000, 8000)
+
+class _DrainSink(io.RawIOBase):
+    """
+    ปลายทางของ SoundFile ตอน stream: เก็บเฉพาะ bytes ที่ยังไม่ได้ drain() ออกไป
+    การเขียนย้อนไปส่วนที่ส่งแล้วจะถูกทิ้ง (ใช้กับ STREAMABLE_FORMATS ที่เขียนต่อท้ายอย่างเดียว)
+    """
+    def __init__(self):
+        self._base = 0         # offset ของ byte แรกใน _buf
+        self._buf = bytearray()
+        self._pos = 0
+
+    def writable(self): return True
+    def seekable(self): return True
+    def readable(self): return True
+
+    def write(self, data):
+        data = memoryview(data).cast("B")
+        n = len(data)
+        start = self._pos - self._base
+        if start < 0:
+            data, start = data[-start:], 0
+        if start > len(self._buf):
+            self._buf.extend(bytes(start - len(self._buf)))
+        self._buf[start:start + len(data)] = data
+        self._pos += n
+        return n
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR: offset += self._pos
+        elif whence == io.SEEK_END: offset += self._base + len(self._buf)
+        self._pos = offset
+        return self._pos
+
+    def tell(self):
+        return self._pos
+
+    def readinto(self, b):
+        return 0
+
+    def drain(self):
+        out = bytes(self._buf)
+        self._base += len(self._buf)
+        self._buf.clear()
+        return out
+
+class AudioEncoder:
+    """
+    เข้ารหัสเสียงทีละก้อน (float32 ที่ source_sr) เป็น format ใน OUTPUT_FORMATS พร้อม resample เป็น sr
+    streaming=True: write() คืน bytes ที่ส่งได้ทันที (เฉพาะ STREAMABLE_FORMATS; WAV ใช้ wav_stream_header)
+    streaming=False: เก็บทั้งไฟล์ (ที่บีบอัดแล้ว) แล้วคืนตอน close()
+    """
+    def __init__(self, fmt, sr=24000, streaming=False, source_sr=24000):
+        if streaming and fmt not in STREAMABLE_FORMATS:
+            raise ValueError(f"{fmt} cannot be streamed")
+        self.fmt = fmt
+        self.sr = sr
+        self.source_sr = source_sr
+        self.streaming = streaming
+        self.media_type = OUTPUT_FORMATS[fmt][2]
+        self._pending = b""
+        self._file = None
+        if fmt == "wav" and streaming:
+            self._pending = wav_stream_header(sr)
+        else:
+            container, subtype, _ = OUTPUT_FORMATS[fmt]
+            self._sink = _DrainSink() if streaming else io.BytesIO()
+            self._file = sf.SoundFile(self._sink, "w", samplerate=sr, channels=1, format=container, subtype=subtype)
+
+    def _take(self):
+        if self._file is None:
+            out, self._pending = self._pending, b""
+            return out
+        return self._sink.drain() if self.streaming else b""
+
+    def flush(self):
+        """
+        bytes ที่พร้อมส่งตอนนี้ (เช่น header ก่อนเริ่มสังเคราะห์)
+        """
+        return self._take()
+
+    def write(self, clip):
+        clip = resample(np.asarray(clip, dtype=np.float32), self.source_sr, self.sr)
+        if self._file is None:
+            self._pending += to_pcm16(clip)
+        else:
+            self._file.write(clip)
+        return self._take()
+
+    def close(self):
+        if self._file is None:
+            return self._take()
+        self._file.close()
+        return self._sink.drain() if self.streaming else self._sink.getvalue()
+
+PCM16_CHUNK = 1 << 16  # ทำทีละก้อนเล็ก ๆ ให้ข้อมูลอยู่ใน cache ของ CPU ระหว่างคูณ/ปัด/clip/cast
+
+def to_pcm16_inplace(buf):
+    """
+    แปลง float32 (-1..1) เป็น int16 โดยใช้หน่วยความจำของ buffer เดิม
+    (ได้ค่าเดียวกับที่ sf.write แปลง float32 -> PCM_16: floor(x * 32768) แล้ว clip)
+    คืน view int16 ที่อยู่ครึ่งแรกของ buffer; ห้ามใช้ buf แบบ float ต่อหลังเรียก
+    """
+    n = len(buf)
+    out = buf.view(np.int16)[:n]
+
+    # int16[i] ทับ bytes [2i, 2i+2) ส่วน float32[i] อยู่ที่ [4i, 4i+4)
+    # ช่วง [a, b) ที่ b <= 2a จึงเขียนได้โดยไม่ทับค่าที่ยังไม่ได้อ่าน; ช่วงแรก cast ออกมาก่อนค่อยเขียน
+    a, b = 0, min(n, PCM16_CHUNK)
+    while a < n:
+        chunk = buf[a:b]
+        chunk *= 32768
+        np.floor(chunk, out=chunk)
+        np.clip(chunk, -32768, 32767, out=chunk)
+        out[a:b] = chunk.astype(np.int16) if a == 0 else chunk
+        a, b = b, min(n, 2 * b, b + PCM16_CHUNK)
+    return out
@@ -0,0 +1,419 @@
+# batch_jobs.py
+"""
+Batch Job: สังเคราะห์เสียงจากไฟล์ JSONL (1 บรรทัด = 1 request) แบบ offline
+
+แต่ละบรรทัด (ทุกฟิลด์ยกเว้น text มีค่า default จาก config):
+    {"id": "bkk-001", "text": "...", "ref": "data/reference.wav", "ref_text": "...",
+     "model_version": "v2", "speed": 1.0, "step": 32, "cfg": 2.0, "use_norm": true}
+
+ขั้นตอน (ใช้ Auto Split เสมอ เหมือน /api/generate ที่ use_auto_split=true):
+1. Plan: split + normalize ทุก request แล้วคำนวณ key ของ Segment -> Segment ที่ซ้ำกันทั้งไฟล์สังเคราะห์ครั้งเดียว
+2. Synthesize: จัดกลุ่มตาม (model, ref, step, cfg, speed) แบ่งเป็นก้อนละ chunk_size แล้วส่งให้ process pool
+   แต่ละ process โหลดโมเดล/conditioning ครั้งเดียวแล้วใช้ซ้ำทุกก้อน เสียงเขียนลง <out>/segments/<key>.f32
+3. Assemble: request ที่ Segment ครบแล้วจะถูกต่อเป็น <out>/wav/<id>.wav และเพิ่มบรรทัดใน <out>/manifest.jsonl
+
+Resume: รันซ้ำด้วย output dir เดิม -> ข้าม request ที่ manifest บอกว่า ok แล้ว และ Segment ที่มีไฟล์อยู่แล้ว
+
+Usage:
+    python batch_jobs.py announcements.jsonl --out data/jobs/announcements --workers 2
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import random
+import re
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import soundfile as sf
+
+import config
+import audio_utils
+import text_utils
+import tts_handler
+import observability
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_NAME = "manifest.jsonl"
+REQUESTS_NAME = "requests.jsonl"
+
+# --- Input ---
+
+def read_requests(path):
+    """
+    อ่าน JSONL -> list ของ (request_id, request dict หรือ None, error)
+    บรรทัดว่างถูกข้าม, id ที่ไม่ได้ระบุจะใช้เลขบรรทัด
+    id ซ้ำ (รวมถึงที่ได้ชื่อไฟล์ wav เดียวกัน) ต่อท้ายด้วยเลขบรรทัด ไม่ให้ทับ wav/manifest ของกันและกัน
+    """
+    requests, names = [], set()
+    with open(path, encoding="utf-8") as f:
+        for line_no, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line: continue
+            try:
+                req = json.loads(line)
+                if not isinstance(req, dict) or not str(req.get("text", "")).strip():
+                    raise ValueError("missing 'text'")
+            except ValueError as e:
+                names.add(_wav_name(str(line_no)))
+                requests.append((str(line_no), None, f"line {line_no}: {e}"))
+                continue
+            request_id = str(req.get("id", line_no))
+            if _wav_name(request_id) in names:
+                unique = f"{request_id}-line{line_no}"
+                while _wav_name(unique) in names:
+                    unique += "_"
+                logger.warning(f"Duplicate id {request_id!r} on line {line_no}, using {unique!r}")
+                request_id = unique
+            names.add(_wav_name(request_id))
+            requests.append((request_id, req, None))
+    return requests
+
+def _wav_name(request_id):
+    return re.sub(r"[^\w.-]", "_", request_id) + ".wav"
+
+def _check_ref(path):
+    """
+    Reference ต้องอยู่ใน BATCH_REF_DIRS หรือเป็นไฟล์ที่ลงทะเบียนไว้ (DEFAULT_REF_AUDIO_PATH / WARMUP_REFERENCES)
+    กันไฟล์ Job ที่ upload ผ่าน /api/jobs สั่งให้ server อ่านไฟล์อื่น
+    """
+    real = os.path.realpath(path)
+    registered = [config.DEFAULT_REF_AUDIO_PATH] + [p for p, _ in config.WARMUP_REFERENCES]
+    if real in {os.path.realpath(p) for p in registered}:
+        return path
+    for ref_dir in config.BATCH_REF_DIRS:
+        ref_dir = os.path.realpath(ref_dir)
+        if os.path.commonpath([real, ref_dir]) == ref_dir:
+            return path
+    raise ValueError(f"ref {path!r} is outside the allowed reference directories")
+
+def read_manifest(out_dir):
+    """
+    สถานะล่าสุดของแต่ละ request จาก manifest (บรรทัดหลังทับบรรทัดก่อน)
+    """
+    entries = {}
+    path = os.path.join(out_dir, MANIFEST_NAME)
+    if not os.path.exists(path): return entries
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue   # บรรทัดสุดท้ายอาจเขียนไม่ครบตอน crash
+            entries[entry.get("id")] = entry
+    return entries
+
+# --- Segment Files ---
+
+def _segment_path(out_dir, key):
+    return os.path.join(out_dir, "segments", f"{key}.f32")
+
+def _write_segment(out_dir, key, wav):
+    path = _segment_path(out_dir, key)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    np.ascontiguousarray(wav, dtype=np.float32).tofile(tmp_path)
+    os.replace(tmp_path, path)
+
+def _read_segment(out_dir, key):
+    return np.fromfile(_segment_path(out_dir, key), dtype=np.float32)
+
+_TRUE = {"true", "1", "yes"}
+_FALSE = {"false", "0", "no"}
+
+def _as_bool(value, name):
+    """
+    ค่า boolean จาก JSON: true/false หรือสตริง/ตัวเลขที่ชัดเจน ("false", "0") ค่าอื่นถือว่า request ผิด
+    """
+    if isinstance(value, bool):
+        return value
+    text = str(value).strip().lower()
+    if text in _TRUE: return True
+    if text in _FALSE: return False
+    raise ValueError(f"{name} must be a boolean, got {value!r}")
+
+# --- Worker ---
+
+def _synthesize_chunk(out_dir, model_version, ref_path, ref_text, step, cfg, speed, items, retry_duration):
+    """
+    รันใน worker process: items = [(key, text, fix_duration)]
+    โมเดลและ Reference ถูก cache ไว้ใน tts_handler ของ process นั้น ใช้ซ้ำข้ามก้อนได้
+    """
+    model = tts_handler.get_tts_model(model_version)
+    if model is None:
+        raise RuntimeError(f"Model {model_version} could not be loaded")
+    ref = tts_handler.load_reference(ref_path, ref_text)
+    wavs = tts_handler.synthesize_segments(
+        model, model_version, ref, [text for _, text, _ in items],
+        step=step, speed=speed, cfg=cfg,
+        fix_durations=[fix for _, _, fix in items],
+        retry_duration=retry_duration
+    )
+    for (key, _, _), wav in zip(items, wavs):
+        _write_segment(out_dir, key, wav)
+    return len(items)
+
+def _synthesize_on_scheduler(chunk):
+    """
+    workers=0: รันก้อนผ่าน tts_handler.scheduler ร่วมกับ request ของ API (ไม่แย่ง GPU นอกคิว)
+    คิวเต็มก็รอตาม Retry-After แล้วส่งใหม่ (Job เป็นงาน background รอได้)
+    """
+    while True:
+        try:
+            return tts_handler.scheduler.call(lambda cancel_event: _synthesize_chunk(*chunk))
+        except tts_handler.QueueFullError as e:
+            time.sleep(e.retry_after)
+
+# --- Job ---
+
+class BatchJob:
+    """
+    สถานะของ Job หนึ่งงาน (ใช้ทั้ง CLI และ /api/jobs)
+    """
+    def __init__(self, input_path, out_dir, workers=None, chunk_size=None, job_id=None):
+        self.job_id = job_id or uuid.uuid4().hex[:12]
+        self.input_path = input_path
+        self.out_dir = out_dir
+        self.workers = config.BATCH_JOB_WORKERS if workers is None else workers
+        self.chunk_size = chunk_size or config.BATCH_JOB_CHUNK_SIZE
+        self.status = "queued"
+        self.error = None
+        self.total = 0
+        self.skipped = 0          # เสร็จแล้วจากรอบก่อน (resume)
+        self.completed = 0
+        self.failed = 0
+        self.segments_total = 0
+        self.segments_unique = 0
+        self.segments_existing = 0
+        self.segments_done = 0
+        self.started_at = None
+        self.finished_at = None
+        self._manifest_lock = threading.Lock()
+
+    def stats(self):
+        elapsed = None
+        if self.started_at:
+            elapsed = (self.finished_at or time.time()) - self.started_at
+        return {
+            "job_id": self.job_id,
+            "status": self.status,
+            "error": self.error,
+            "out_dir": self.out_dir,
+            "workers": self.workers,
+            "requests": {"total": self.total, "skipped": self.skipped,
+                         "completed": self.completed, "failed": self.failed},
+            "segments": {"total": self.segments_total, "unique": self.segments_unique,
+                         "existing": self.segments_existing, "done": self.segments_done},
+            "elapsed_sec": elapsed,
+        }
+
+    def _record(self, entry):
+        with self._manifest_lock:
+            with open(os.path.join(self.out_dir, MANIFEST_NAME), "a", encoding="utf-8") as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            if entry["status"] == "ok": self.completed += 1
+            else: self.failed += 1
+
+    def _plan(self, requests, manifest):
+        """
+        คืน (plans, groups)
+        plans: request ที่ต้องทำ -> dict(id, text, keys, ref_path)
+        groups: (model, ref_path, ref_text, step, cfg, speed, retry_duration) -> {key: (text, fix)}
+        """
+        plans, groups, seen = [], {}, set()
+        for request_id, req, error in requests:
+            if manifest.get(request_id, {}).get("status") == "ok":
+                self.skipped += 1
+                continue
+            if error:
+                self._record({"id": request_id, "status": "error", "error": error})
+                continue
+            try:
+                ref_path = _check_ref(req.get("ref") or config.DEFAULT_REF_AUDIO_PATH)
+                ref_text = req.get("ref_text", config.DEFAULT_REF_TEXT)
+                model_version = req.get("model_version") or config.CURRENT_MODEL_VERSION
+                speed = float(req.get("speed", config.DEFAULT_SPEED))
+                step = int(req.get("step", config.DEFAULT_STEPS))
+                cfg = float(req.get("cfg", config.DEFAULT_CFG))
+                use_norm = _as_bool(req.get("use_norm", config.USE_NORM_DEFAULT), "use_norm")
+
+                ref = tts_handler.load_reference(ref_path, ref_text)
+                ref_duration_sec = ref.duration if ref.duration > 0 else 5.0
+                seg_texts, forced_durs = tts_handler.plan_segments(req["text"], ref_duration_sec, use_norm)
+            except Exception as e:
+                self._record({"id": request_id, "status": "error", "error": str(e)})
+                continue
+
+            group = groups.setdefault(
+                (model_version, ref_path, ref_text, step, cfg, speed, ref_duration_sec + 6.0), {})
+            keys = []
+            for text, fix in zip(seg_texts, forced_durs):
+                key = tts_handler.segment_cache_key(text, model_version, ref, step, cfg, speed, fix)
+                keys.append(key)
+                if key in seen: continue
+                seen.add(key)
+                if os.path.exists(_segment_path(self.out_dir, key)):
+                    self.segments_existing += 1
+                else:
+                    group[key] = (text, fix)
+            self.segments_total += len(keys)
+            plans.append({"id": request_id, "text": req["text"], "keys": keys, "ref_path": ref_path})
+        self.segments_unique = len(seen)
+        return plans, {k: v for k, v in groups.items() if v}
+
+    def _assemble(self, plan):
+        name = _wav_name(plan["id"])
+        wav_path = os.path.join(self.out_dir, "wav", name)
+        wavs = (_read_segment(self.out_dir, key) for key in plan["keys"])
+        # seed ตาม id: ช่วงเว้นวรรคเท่าเดิมไม่ว่าจะรันกี่รอบ
+        pcm = audio_utils.render_segments(wavs, plan["ref_path"], rng=random.Random(plan["id"]), pcm16=True)
+        sf.write(wav_path, pcm, 24000, format='WAV', subtype='PCM_16')
+        self._record({
+            "id": plan["id"], "status": "ok", "wav": os.path.join("wav", name),
+            "duration": round(len(pcm) / 24000, 3), "segments": len(plan["keys"]),
+            "text": plan["text"],
+        })
+
+    def run(self):
+        self.status = "running"
+        self.started_at = time.time()
+        try:
+            os.makedirs(os.path.join(self.out_dir, "segments"), exist_ok=True)
+            os.makedirs(os.path.join(self.out_dir, "wav"), exist_ok=True)
+            if text_utils.custom_tokenizer is None:
+                text_utils.setup_tokenizer()
+
+            requests = read_requests(self.input_path)
+            self.total = len(requests)
+            plans, groups = self._plan(requests, read_manifest(self.out_dir))
+            logger.info(f"Job {self.job_id} planned", extra={"fields": {
+                "todo": len(plans), "skipped": self.skipped,
+                "unique_segments": self.segments_unique, "existing_segments": self.segments_existing}})
+
+            # request -> key ที่ยังรออยู่ / key -> request ที่ใช้ key นั้น
+            pending = {}
+            waiting = {}
+            for i, plan in enumerate(plans):
+                missing = {k for k in plan["keys"] if not os.path.exists(_segment_path(self.out_dir, k))}
+                pending[i] = missing
+                for key in missing:
+                    waiting.setdefault(key, []).append(i)
+                if not missing:
+                    self._try_assemble(plan)
+
+            chunks = []
+            for (model_version, ref_path, ref_text, step, cfg, speed, retry), segs in groups.items():
+                items = [(key, text, fix) for key, (text, fix) in segs.items()]
+                for start in range(0, len(items), self.chunk_size):
+                    chunks.append((self.out_dir, model_version, ref_path, ref_text, step, cfg, speed,
+                                   items[start:start + self.chunk_size], retry))
+
+            for chunk, error in self._execute(chunks):
+                for key, _, _ in chunk[7]:
+                    for i in waiting.pop(key, []):
+                        if pending[i] is None: continue
+                        if error is not None:
+                            self._record({"id": plans[i]["id"], "status": "error", "error": error})
+                            pending[i] = None
+                            continue
+                        pending[i].discard(key)
+                        if not pending[i]:
+                            pending[i] = None
+                            self._try_assemble(plans[i])
+                if error is None: self.segments_done += len(chunk[7])
+
+            self.status = "done"
+        except Exception as e:
+            logger.exception(f"Job {self.job_id} failed: {e}")
+            self.status = "failed"
+            self.error = str(e)
+        finally:
+            self.finished_at = time.time()
+        logger.info(f"Job {self.job_id} {self.status}", extra={"fields": {
+            "completed": self.completed, "failed": self.failed, "skipped": self.skipped,
+            "elapsed_sec": round(self.finished_at - self.started_at, 1)}})
+        return self
+
+    def _try_assemble(self, plan):
+        try:
+            self._assemble(plan)
+        except Exception as e:
+            self._record({"id": plan["id"], "status": "error", "error": str(e)})
+
+    def _execute(self, chunks):
+        """
+        Generator: yield (chunk, error) ตามลำดับที่เสร็จ
+        workers=0 รันใน process นี้ผ่าน scheduler (ใช้โมเดลที่โหลดไว้แล้วร่วมกับ server)
+        """
+        if self.workers <= 0:
+            for chunk in chunks:
+                try:
+                    _synthesize_on_scheduler(chunk)
+                    yield chunk, None
+                except Exception as e:
+                    yield chunk, str(e)
+            return
+
+        # spawn: ปลอดภัยกับ CUDA/torch มากกว่า fork
+        ctx = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=self.workers, mp_context=ctx,
+                                 initializer=observability.setup_logging) as pool:
+            futures = {pool.submit(_synthesize_chunk, *chunk): chunk for chunk in chunks}
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                    yield futures[future], None
+                except Exception as e:
+                    yield futures[future], str(e)
+
+# --- Background Jobs (API) ---
+jobs = {}
+_jobs_lock = threading.Lock()
+
+class JobLimitError(Exception):
+    """
+    มี Job ที่ queued/running ครบ BATCH_MAX_JOBS แล้ว: ให้ผู้เรียกตอบ 429
+    """
+
+def active_jobs():
+    return sum(1 for job in list(jobs.values()) if job.status in ("queued", "running"))
+
+def start_job(input_path, out_dir=None, workers=None, job_id=None):
+    """
+    เริ่ม Job ใน background thread แล้วคืน BatchJob ทันที (ใช้โดย /api/jobs)
+    รันพร้อมกันได้ไม่เกิน BATCH_MAX_JOBS งาน เกินแล้วโยน JobLimitError
+    """
+    job_id = job_id or uuid.uuid4().hex[:12]
+    out_dir = out_dir or os.path.join(config.BATCH_JOBS_DIR, job_id)
+    job = BatchJob(input_path, out_dir, workers=workers, job_id=job_id)
+    with _jobs_lock:
+        if active_jobs() >= config.BATCH_MAX_JOBS:
+            raise JobLimitError(f"Too many batch jobs running (max {config.BATCH_MAX_JOBS})")
+        jobs[job.job_id] = job
+    threading.Thread(target=job.run, name=f"batch-job-{job.job_id}", daemon=True).start()
+    return job
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline batch synthesis from a JSONL request file")
+    parser.add_argument("input", help="JSONL file: one {text, ref, model_version, speed, step, cfg} per line")
+    parser.add_argument("--out", default=None, help="output dir (re-use the same dir to resume)")
+    parser.add_argument("--workers", type=int, default=config.BATCH_JOB_WORKERS,
+                        help="worker processes (0 = run in this process)")
+    parser.add_argument("--chunk-size", type=int, default=config.BATCH_JOB_CHUNK_SIZE)
+    args = parser.parse_args()
+    observability.setup_logging()
+
+    out_dir = args.out or os.path.join(
+        config.BATCH_JOBS_DIR, os.path.splitext(os.path.basename(args.input))[0])
+    job = BatchJob(args.input, out_dir, workers=args.workers, chunk_size=args.chunk_size).run()
+    print(json.dumps(job.stats(), ensure_ascii=False, indent=2))
+    if job.status != "done" or job.failed:
+        raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
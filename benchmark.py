@@ -0,0 +1,781 @@
+# benchmark.py
+"""
+Benchmark สำหรับ Pipeline การสังเคราะห์เสียง (ใช้ MockTTS ได้บนเครื่องที่ไม่มี GPU)
+
+Usage:
+    python benchmark.py batch --segments 60 --batch-size 8 --call-overhead 0.05
+    python benchmark.py startup --runs 3
+    python benchmark.py normalize
+    python benchmark.py postprocess --segments 100
+    python benchmark.py split --pages 50
+    python benchmark.py encode --seconds 60
+    python benchmark.py steps --model v2 --steps 8,16,24,32
+    python benchmark.py load --mix mixed --concurrency 1,4,8 --requests 100 --save baseline.json
+    python benchmark.py load --url http://localhost:8000 --compare baseline.json
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import config
+import text_utils
+import tts_handler
+
+SAMPLE_ANNOUNCEMENT = (
+    "ขบวนรถด่วนพิเศษที่ 7 จาก กรุงเทพ ถึง เชียงใหม่ จะออกจาก ชานชาลา 3 เวลา 10:30 น. "
+    "วันที่ 18/12/2567 ผู้โดยสารที่จะเดินทางไป อยุธยา บ้านภาชี ลพบุรี นครสวรรค์ พิษณุโลก "
+    "กรุณา ขึ้นรถ ได้ที่ ชานชาลา 3 ขอบคุณครับ"
+)
+
+def _make_segments(n):
+    base = text_utils.intelligent_split(SAMPLE_ANNOUNCEMENT)
+    return [text_utils.normalize_text(base[i % len(base)])[0] for i in range(n)]
+
+def _configure_mock(args):
+    if hasattr(tts_handler.TTS, "call_overhead"):
+        tts_handler.TTS.call_overhead = args.call_overhead
+        tts_handler.TTS.sec_per_char = args.sec_per_char
+
+def bench_batch(args):
+    """
+    เปรียบเทียบ segments/sec ระหว่างการเรียก model.infer ทีละ Segment กับ tts_handler.infer_batch
+    """
+    _configure_mock(args)
+    text_utils.setup_tokenizer()
+    model = tts_handler.get_tts_model(args.model)
+    segments = _make_segments(args.segments)
+    ref = args.ref_audio
+
+    t0 = time.perf_counter()
+    for seg in segments:
+        tts_handler.to_mono(model.infer(ref_audio=ref, ref_text=args.ref_text, gen_text=seg,
+                                        step=args.step, speed=1.0, cfg=2.0))
+    loop_sec = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    tts_handler.infer_batch(model, ref, args.ref_text, segments, step=args.step,
+                            batch_size=args.batch_size)
+    batch_sec = time.perf_counter() - t0
+
+    print(f"\n📊 {len(segments)} segments (batch_size={args.batch_size})")
+    print(f"   loop : {loop_sec:8.3f}s  {len(segments) / loop_sec:8.2f} seg/s")
+    print(f"   batch: {batch_sec:8.3f}s  {len(segments) / batch_sec:8.2f} seg/s")
+    print(f"   speedup: x{loop_sec / batch_sec:.2f}")
+
+_STARTUP_PROBE = """
+import json, time
+t0 = time.perf_counter()
+import text_utils
+t1 = time.perf_counter()
+text_utils.setup_tokenizer()
+t2 = time.perf_counter()
+text_utils.normalize_text(%r)
+t3 = time.perf_counter()
+print(json.dumps({"import": t1 - t0, "setup": t2 - t1, "first_request": t3 - t2}))
+"""
+
+def _probe_startup(lexicon_cache_path):
+    env = dict(os.environ, LEXICON_CACHE_PATH=lexicon_cache_path)
+    out = subprocess.run(
+        [sys.executable, "-c", _STARTUP_PROBE % SAMPLE_ANNOUNCEMENT],
+        env=env, capture_output=True, text=True, check=True,
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+    ).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+def bench_startup(args):
+    """
+    เวลา import / setup_tokenizer / normalize ครั้งแรก ในโปรเซสใหม่:
+    legacy (สร้าง trie ทุกครั้ง) vs compiled artifact (ครั้งแรกต้อง build, ครั้งต่อไปโหลดอย่างเดียว)
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        artifact = os.path.join(tmp, "lexicon_index.pkl")
+        results = {
+            "legacy": [_probe_startup("") for _ in range(args.runs)],
+            "compiled (cold build)": [_probe_startup(artifact)],
+            "compiled (warm)": [_probe_startup(artifact) for _ in range(args.runs)],
+        }
+
+    print(f"\n📊 Startup latency (best of {args.runs}, seconds)")
+    print(f"   {'mode':<24}{'import':>10}{'setup':>10}{'1st req':>10}{'total':>10}")
+    for mode, runs in results.items():
+        best = min(runs, key=lambda r: sum(r.values()))
+        print(f"   {mode:<24}{best['import']:>10.3f}{best['setup']:>10.3f}"
+              f"{best['first_request']:>10.3f}{sum(best.values()):>10.3f}")
+
+def _percentile(sorted_samples, q):
+    return sorted_samples[min(len(sorted_samples) - 1, int(q * len(sorted_samples)))]
+
+def _latency_summary(samples):
+    samples = sorted(samples)
+    pick = lambda q: _percentile(samples, q)
+    return {
+        "mean_us": sum(samples) / len(samples) * 1e6,
+        "p50_us": pick(0.50) * 1e6,
+        "p95_us": pick(0.95) * 1e6,
+    }
+
+def _normalize_corpus():
+    with open(config.LEXICON_PATH, encoding="utf-8") as f:
+        stations = list(json.load(f).keys())
+    announcements = [
+        f"ขบวนรถที่ {i + 1} จาก กรุงเทพ ถึง {name} จะออกเวลา {6 + i % 17}:{i % 60:02d} น. "
+        f"วันที่ {i % 28 + 1}/{i % 12 + 1}/2567 ชานชาลา {i % 12 + 1}"
+        for i, name in enumerate(stations)
+    ]
+    return {"stations": stations, "announcements": announcements}
+
+def bench_normalize(args):
+    """
+    Latency ต่อการเรียก normalize_text: cold (ล้าง memo) / warm (memo hit) และ normalize_many ต่อ Segment
+    """
+    text_utils.setup_tokenizer()
+    print("\n📊 normalize_text latency (microseconds per call)")
+    print(f"   {'corpus':<15}{'mode':<16}{'mean':>10}{'p50':>10}{'p95':>10}")
+
+    for name, texts in _normalize_corpus().items():
+        for mode in ("cold", "warm"):
+            if mode == "cold":
+                text_utils._normalize_memo.clear()
+                text_utils.verbalize_number.cache_clear()
+            samples = []
+            for text in texts:
+                t0 = time.perf_counter()
+                text_utils.normalize_text(text)
+                samples.append(time.perf_counter() - t0)
+            r = _latency_summary(samples)
+            print(f"   {name:<15}{mode:<16}{r['mean_us']:>10.1f}{r['p50_us']:>10.1f}{r['p95_us']:>10.1f}")
+
+        # Auto Split: normalize ทีละ Segment vs normalize_many ต่อ request
+        split_texts = [text_utils.intelligent_split(text) for text in texts]
+        n_segments = sum(len(segs) for segs in split_texts)
+        for mode in ("segments loop", "segments many"):
+            text_utils._normalize_memo.clear()
+            t0 = time.perf_counter()
+            for segs in split_texts:
+                if mode == "segments many":
+                    text_utils.normalize_many(segs)
+                else:
+                    for seg in segs: text_utils.normalize_text(seg)
+            per_seg = (time.perf_counter() - t0) / max(1, n_segments) * 1e6
+            print(f"   {name:<15}{mode:<16}{per_seg:>10.1f}{'':>10}{'':>10}  ({n_segments} segments)")
+
+def _legacy_postprocess(wavs):
+    """
+    ขั้น post-process แบบเดิม (mask + np.where, linspace ทุกครั้ง, room tone float64, concatenate, sf.write float)
+    """
+    import io
+    import random
+    import numpy as np
+    import soundfile as sf
+
+    clips = []
+    for i, wav in enumerate(wavs):
+        is_sound = np.abs(wav) > 0.005
+        if np.any(is_sound):
+            indices = np.where(is_sound)[0]
+            wav = wav[max(0, indices[0] - 480):min(len(wav), indices[-1] + 480)]
+        n = min(1200, len(wav) // 2)
+        wav[:n] *= np.linspace(0, 1, n)
+        wav[-n:] *= np.linspace(1, 0, n)
+        clips.append(wav)
+        if i < len(wavs) - 1:
+            room_tone = np.zeros(int(random.uniform(0.07, 0.14) * 24000))
+            n = min(480, len(room_tone) // 2)
+            room_tone[:n] *= np.linspace(0, 1, n)
+            room_tone[-n:] *= np.linspace(1, 0, n)
+            clips.append(room_tone)
+    buffer = io.BytesIO()
+    sf.write(buffer, np.concatenate(clips), 24000, format='WAV')
+    return buffer.getvalue()
+
+def _engine_postprocess(wavs):
+    import io
+    import soundfile as sf
+    import audio_utils
+
+    pcm = audio_utils.render_segments(wavs, pcm16=True)
+    buffer = io.BytesIO()
+    sf.write(buffer, pcm, 24000, format='WAV', subtype='PCM_16')
+    return buffer.getvalue()
+
+def bench_postprocess(args):
+    """
+    ตัดเงียบ + Fade + เว้นวรรค + เขียน WAV สำหรับผลลัพธ์ --segments Segment: แบบเดิม vs audio_utils.render_segments
+    วัดเวลา และ peak memory ที่ numpy จองระหว่างทำ (tracemalloc)
+    """
+    import io
+    import tracemalloc
+    import numpy as np
+
+    rs = np.random.RandomState(0)
+    # Segment ละ ~1-3 วินาที มีเงียบหัว/ท้าย เหมือนผลจากโมเดล
+    source = [np.concatenate([
+        np.zeros(rs.randint(2400, 9600), dtype=np.float32),
+        rs.uniform(-0.5, 0.5, rs.randint(24000, 72000)).astype(np.float32),
+        np.zeros(rs.randint(2400, 9600), dtype=np.float32),
+    ]) for _ in range(args.segments)]
+    audio_seconds = sum(len(w) for w in source) / 24000
+
+    print(f"\n📊 post-process {args.segments} segments ({audio_seconds:.0f}s of audio), best of {args.runs}")
+    print(f"   {'mode':<10}{'ms':>10}{'peak MB':>10}")
+    for name, fn in (("legacy", _legacy_postprocess), ("engine", _engine_postprocess)):
+        best_sec, peak = float("inf"), 0
+        for _ in range(args.runs):
+            wavs = [w.copy() for w in source]
+            # ไม่นับ print "Trimmed" ต่อ Segment
+            with contextlib.redirect_stdout(io.StringIO()):
+                t0 = time.perf_counter()
+                fn(wavs)
+                best_sec = min(best_sec, time.perf_counter() - t0)
+
+        wavs = [w.copy() for w in source]
+        tracemalloc.start()
+        with contextlib.redirect_stdout(io.StringIO()):
+            fn(wavs)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print(f"   {name:<10}{best_sec * 1000:>10.1f}{peak / 2**20:>10.1f}")
+
+def _legacy_intelligent_split(text):
+    """
+    intelligent_split แบบเดิม (re.sub หลายรอบด้วย TEMP_MARKER, split 2 ชั้น, ต่อ string ใน split_long_sentence)
+    """
+    import re
+    from pythainlp import word_tokenize
+
+    def split_long_sentence(text, max_length=150):
+        text = text.strip()
+        if len(text) <= max_length:
+            return [text]
+        words = word_tokenize(text, engine="newmm", custom_dict=text_utils.custom_tokenizer)
+        chunks = []
+        current_chunk = ""
+        for word in words:
+            if len(current_chunk) + len(word) <= max_length:
+                current_chunk += word
+            else:
+                if current_chunk: chunks.append(current_chunk)
+                current_chunk = word
+        if current_chunk:
+            chunks.append(current_chunk)
+        return chunks
+
+    if not text: return []
+    marker = text_utils.TEMP_MARKER
+    text = text_utils.replace_dates(text.strip())
+    text = re.sub(r'(?<=[ก-๙])\s+(?=\d)', marker, text)
+    text = re.sub(r'(?<=\d)\s+(?=[ก-๙])', marker, text)
+    final_segments = []
+    for chunk in re.split(r'[\n\r]+', text):
+        for sub in re.split(r'\s+', chunk):
+            sub = sub.strip()
+            if sub:
+                restored = sub.replace(marker, " ")
+                if len(restored) > 120:
+                    final_segments.extend(split_long_sentence(restored, max_length=150))
+                else:
+                    final_segments.append(restored)
+    return final_segments
+
+GOLDEN_SPLIT_PATH = os.path.join(config.DATA_DIR, "golden", "split.json")
+GOLDEN_SPLIT_PAGES = 2  # เอกสารยาวใน golden file (พอให้ผ่าน split_long_sentence โดยไฟล์ไม่ใหญ่)
+
+def _split_corpus(pages):
+    corpus = _normalize_corpus()
+    texts = corpus["stations"] + corpus["announcements"] + [SAMPLE_ANNOUNCEMENT]
+    # เอกสารยาวหลายหน้า (~2,000 ตัวอักษรต่อหน้า) มีทั้ง newline และย่อหน้ายาวที่ต้องตัดด้วย split_long_sentence
+    page = "\n".join(corpus["announcements"][:20]) + "\n" + "".join(corpus["stations"][:40])
+    texts.append("\n\n".join([page] * pages))
+    return texts
+
+def bench_split(args):
+    """
+    intelligent_split (text_utils.iter_segments รอบเดียว) vs แบบเดิม: ตรวจว่าได้ Segment เหมือนกันทุกข้อความ
+    แล้ววัดเวลา (best of --runs) แยกข้อความสั้นทั้งชุด กับเอกสาร --pages หน้า
+    --compare ตรวจกับ golden file (ค่า default data/golden/split.json ที่สร้างจาก splitter แบบเดิม, exit 1 ถ้าต่าง)
+    --save สร้าง golden file ใหม่: Segment จาก splitter แบบเดิม + offset จาก iter_segments (tests/test_golden_split.py ใช้ไฟล์เดียวกัน)
+    """
+    text_utils.setup_tokenizer()
+    texts = _split_corpus(args.pages)
+
+    mismatches = [t for t in texts if text_utils.intelligent_split(t) != _legacy_intelligent_split(t)]
+    print(f"\n📊 intelligent_split: {len(texts) - len(mismatches)}/{len(texts)} texts identical to legacy")
+    for text in mismatches[:5]:
+        print(f"   ❌ {text[:60]!r}")
+
+    if args.save:
+        # Segment มาจาก splitter แบบเดิม (baseline) เสมอ ไม่ใช่จาก engine ที่กำลังตรวจ
+        # offset มีแต่ใน engine: บันทึกได้เฉพาะเมื่อ Segment ของ engine ตรงกับแบบเดิมทุกข้อความ
+        golden = []
+        for t in _split_corpus(GOLDEN_SPLIT_PAGES):
+            pieces = list(text_utils.iter_segments(t))
+            segments = _legacy_intelligent_split(t)
+            if [seg for seg, _, _ in pieces] != segments:
+                sys.exit(f"   ❌ engine differs from legacy on {t[:60]!r}, not saving {args.save}")
+            golden.append({"text": t, "segments": segments, "offsets": [[a, b] for _, a, b in pieces]})
+        os.makedirs(os.path.dirname(args.save) or ".", exist_ok=True)
+        with open(args.save, "w", encoding="utf-8") as f:
+            # บรรทัดละข้อความ: diff ของ golden file อ่านได้ทีละกรณี
+            f.write("[\n" + ",\n".join(json.dumps(case, ensure_ascii=False) for case in golden) + "\n]\n")
+        print(f"   saved golden file to {args.save}")
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            expected = json.load(f)
+        changed = 0
+        for case in expected:
+            pieces = list(text_utils.iter_segments(case["text"]))
+            if ([seg for seg, _, _ in pieces] != case["segments"]
+                    or [[a, b] for _, a, b in pieces] != case["offsets"]
+                    or text_utils.intelligent_split(case["text"]) != case["segments"]):
+                changed += 1
+                if changed <= 5: print(f"   ❌ golden {case['text'][:60]!r}")
+        print(f"   golden {args.compare}: {'✅ match' if not changed else f'❌ {changed}/{len(expected)} texts differ'}")
+        mismatches += [None] * changed
+
+    short, document = texts[:-1], texts[-1]
+    print(f"   {'mode':<10}{'short ms':>12}{f'{args.pages}-page ms':>14}{'segments':>10}")
+    for name, fn in (("legacy", _legacy_intelligent_split), ("engine", text_utils.intelligent_split)):
+        best_short = best_doc = float("inf")
+        for _ in range(args.runs):
+            t0 = time.perf_counter()
+            for text in short: fn(text)
+            best_short = min(best_short, time.perf_counter() - t0)
+            t0 = time.perf_counter()
+            n_segments = len(fn(document))
+            best_doc = min(best_doc, time.perf_counter() - t0)
+        print(f"   {name:<10}{best_short * 1000:>12.1f}{best_doc * 1000:>14.1f}{n_segments:>10}")
+
+    # เวลาถึง Segment แรก: generator ไม่ต้องตัดทั้งเอกสารก่อน
+    t0 = time.perf_counter()
+    next(text_utils.iter_segments(document))
+    print(f"   first segment of the {len(document):,}-char document after {(time.perf_counter() - t0) * 1000:.2f} ms")
+    if mismatches:
+        sys.exit(1)
+
+def bench_encode(args):
+    """
+    เวลา encode เทียบกับขนาดไฟล์ที่ได้ ของทุก format / sample rate ใน audio_utils.OUTPUT_FORMATS
+    ใช้เสียงพูดจริงจาก Reference (ต่อกันเป็นก้อน ๆ ละ ~3 วินาที เหมือน Segment) เพราะ noise บีบอัดไม่ได้
+    """
+    import audio_utils
+
+    speech, _ = audio_utils.load_audio(args.ref_audio)
+    seg = 3 * 24000
+    n_segments = max(1, int(args.seconds * 24000) // seg)
+    clips = [speech[(i * seg) % max(1, len(speech) - seg):][:seg].copy() for i in range(n_segments)]
+    audio_seconds = sum(len(c) for c in clips) / 24000
+
+    rows = []
+    for fmt in audio_utils.OUTPUT_FORMATS:
+        for sr in audio_utils.OUTPUT_SAMPLE_RATES:
+            if fmt == "opus" and sr not in audio_utils.OPUS_SAMPLE_RATES: continue
+            best, size = float("inf"), 0
+            for _ in range(args.runs):
+                t0 = time.perf_counter()
+                encoder = audio_utils.AudioEncoder(fmt, sr)
+                for clip in clips: encoder.write(clip)
+                size = len(encoder.close())
+                best = min(best, time.perf_counter() - t0)
+            rows.append((fmt, sr, best, size))
+
+    baseline = next(size for fmt, sr, _, size in rows if fmt == "wav" and sr == 24000)
+    print(f"\n📊 encode {audio_seconds:.0f}s of speech in {n_segments} segments, best of {args.runs}")
+    print(f"   {'format':<8}{'rate':>8}{'ms':>10}{'ms/min':>10}{'KB':>10}{'vs wav':>9}{'kbps':>8}")
+    for fmt, sr, sec, size in rows:
+        print(f"   {fmt:<8}{sr:>8}{sec * 1000:>10.1f}{sec * 1000 * 60 / audio_seconds:>10.1f}"
+              f"{size / 1024:>10.0f}{size / baseline:>8.1%}{size * 8 / audio_seconds / 1000:>8.0f}")
+
+def bench_steps(args):
+    """
+    step -> เวลา / RTF (วินาทีเสียง / วินาทีที่ใช้) ของโมเดลหนึ่ง ทั้งมี CFG และ cfg=0
+    ใช้เลือก ADAPTIVE_MIN_STEPS ของแต่ละ version และดูว่า step ที่ลดลงซื้อ throughput ได้เท่าไหร่
+    """
+    import step_control
+
+    _configure_mock(args)
+    text_utils.setup_tokenizer()
+    model = tts_handler.get_tts_model(args.model)
+    ref = tts_handler.load_reference(args.ref_audio, args.ref_text)
+    segments = _make_segments(args.segments)
+    chars = sum(len(t) for t in segments)
+
+    def run(step, cfg):
+        best, audio_sec = float("inf"), 0.0
+        for _ in range(args.runs):
+            t0 = time.perf_counter()
+            wavs = tts_handler.infer_batch(model, ref, ref.ref_text, segments, step=step, cfg=cfg)
+            best = min(best, time.perf_counter() - t0)
+            audio_sec = sum(len(w) for w in wavs) / 24000
+        return best, audio_sec
+
+    cost = step_control.CostModel()
+    rows = []
+    for step in args.steps:
+        sec, audio_sec = run(step, args.cfg)
+        sec_nocfg, audio_nocfg = run(step, 0.0)
+        cost.add(step * chars, sec)
+        rows.append({"step": step, "sec": sec, "rtf": audio_sec / sec, "sec_nocfg": sec_nocfg,
+                     "rtf_nocfg": audio_nocfg / sec_nocfg})
+
+    overhead, per_unit = cost.coefficients()
+    print(f"\n📊 {args.model}: {len(segments)} segments, {chars} chars, cfg={args.cfg}, best of {args.runs}")
+    print(f"   {'step':>6}{'sec':>10}{'RTF':>10}{'sec cfg=0':>12}{'RTF cfg=0':>12}")
+    for r in rows:
+        print(f"   {r['step']:>6}{r['sec']:>10.3f}{r['rtf']:>10.2f}{r['sec_nocfg']:>12.3f}{r['rtf_nocfg']:>12.2f}")
+    print(f"   fit: {overhead:.3f}s + {per_unit * 1e6:.2f}µs x step x chars")
+    if args.slo:
+        fit = int((args.slo - overhead) / (per_unit * args.chars)) if args.slo > overhead else 0
+        print(f"   a {args.chars}-char request meets a {args.slo:g}s SLO on an idle worker up to step {fit}")
+
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump({"model": args.model, "chars": chars, "cfg": args.cfg, "rows": rows,
+                       "overhead_sec": overhead, "sec_per_step_char": per_unit}, f, indent=2)
+        print(f"   saved {args.save}")
+
+# --- End-to-end load ---
+
+# น้ำหนักของแต่ละ scenario ใน mix (ดู _load_scenarios)
+LOAD_MIXES = {
+    "stations": {"station": 1},
+    "announcements": {"announcement": 1, "announcement_split": 1},
+    "mixed": {"station": 5, "announcement": 2, "announcement_split": 2, "normalize": 1},
+}
+
+def _load_scenarios():
+    """
+    scenario -> (path, รายการ form data): ชื่อสถานีสั้น ๆ, ประกาศหลายประโยคมีวันที่/เวลา (Auto Split ปิด/เปิด), normalize
+    """
+
+    corpus = _normalize_corpus()
+    stations = corpus["stations"]
+    announcements = [
+        f"{text} ผู้โดยสารที่จะเดินทางไป {stations[(i * 7) % len(stations)]} "
+        f"กรุณาขึ้นรถได้ที่ชานชาลา {i % 12 + 1} ขอบคุณครับ"
+        for i, text in enumerate(corpus["announcements"])
+    ]
+    generate = lambda texts, split: [
+        {"text": t, "ref_text": config.DEFAULT_REF_TEXT, "use_auto_split": split} for t in texts]
+    return {
+        "station": ("/api/generate", generate(stations, "false")),
+        "announcement": ("/api/generate", generate(announcements, "false")),
+        "announcement_split": ("/api/generate", generate(announcements, "true")),
+        "normalize": ("/api/normalize", [{"text": t} for t in announcements]),
+    }
+
+def _load_plan(mix, n, seed):
+    import random
+
+    rng = random.Random(seed)
+    scenarios = _load_scenarios()
+    names = list(LOAD_MIXES[mix])
+    weights = [LOAD_MIXES[mix][name] for name in names]
+    plan = []
+    for name in rng.choices(names, weights, k=n):
+        path, forms = scenarios[name]
+        plan.append((name, path, rng.choice(forms)))
+    return plan
+
+def _audio_seconds(body):
+    """
+    ความยาวเสียงของ response จาก header ที่อ่านด้วย soundfile (ไม่สมมติ header 44 bytes / 24 kHz)
+    """
+    import io
+    import soundfile as sf
+
+    try:
+        info = sf.info(io.BytesIO(body))
+    except RuntimeError:
+        return 0.0
+    return info.frames / info.samplerate
+
+async def _run_load(client, plan, concurrency):
+    """
+    ยิง plan ด้วย concurrency worker: คืน [(scenario, status, latency_sec, audio_sec)] และเวลารวม
+    """
+    import httpx
+
+    queue = list(reversed(plan))
+    results = []
+
+    async def worker():
+        while queue:
+            name, path, data = queue.pop()
+            t0 = time.perf_counter()
+            try:
+                r = await client.post(path, data=data)
+                status, body = r.status_code, r.content
+            except httpx.HTTPError:
+                status, body = 0, b""
+            latency = time.perf_counter() - t0
+            audio_sec = _audio_seconds(body) if status == 200 and path == "/api/generate" else 0.0
+            results.append((name, status, latency, audio_sec))
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return results, time.perf_counter() - t0
+
+def _load_summary(results, wall):
+    def summarize(rows):
+        ok = sorted(r[2] for r in rows if r[1] == 200)
+        audio = sum(r[3] for r in rows if r[1] == 200)
+        summary = {"count": len(rows), "errors": len(rows) - len(ok)}
+        if ok:
+            summary.update({
+                "mean_ms": sum(ok) / len(ok) * 1000,
+                "p50_ms": _percentile(ok, 0.50) * 1000,
+                "p95_ms": _percentile(ok, 0.95) * 1000,
+                "p99_ms": _percentile(ok, 0.99) * 1000,
+            })
+            # RTF แบบเดียวกับ /metrics: วินาทีเสียง / วินาทีที่รอ (> 1 = เร็วกว่า real-time)
+            if audio > 0: summary["rtf"] = audio / sum(r[2] for r in rows if r[1] == 200 and r[3] > 0)
+        return summary
+
+    scenarios = {}
+    for row in results:
+        scenarios.setdefault(row[0], []).append(row)
+    total = summarize(results)
+    total["throughput_rps"] = (total["count"] - total["errors"]) / wall if wall > 0 else 0.0
+    total["wall_sec"] = wall
+    return {"all": total, "scenarios": {name: summarize(rows) for name, rows in sorted(scenarios.items())}}
+
+async def _server_peak_rss(client):
+    for line in (await client.get("/metrics")).text.splitlines():
+        if line.startswith("tts_process_max_rss_bytes "):
+            return float(line.split()[1])
+    return 0.0
+
+@contextlib.asynccontextmanager
+async def _load_client(url):
+    """
+    --url: ยิงไปที่ server ที่รันอยู่ / ไม่ระบุ: รัน main.app ในโปรเซสนี้ (รวม lifespan) ผ่าน ASGI transport
+    """
+    import httpx
+
+    if url:
+        async with httpx.AsyncClient(base_url=url, timeout=None) as client:
+            yield client
+        return
+    import main
+
+    async with main.app.router.lifespan_context(main.app):
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+            yield client
+
+async def _bench_load(args):
+    import observability
+
+    levels, released = [], True
+    async with _load_client(args.url) as client:
+        if args.warmup:
+            await _run_load(client, _load_plan(args.mix, args.warmup, args.seed + 1), 1)
+        for i, concurrency in enumerate(args.concurrency):
+            plan = _load_plan(args.mix, args.requests, args.seed + 1000 * (i + 1))
+            results, wall = await _run_load(client, plan, concurrency)
+            level = {"concurrency": concurrency, **_load_summary(results, wall)}
+            level["peak_rss_mb"] = (await _server_peak_rss(client) if args.url
+                                    else observability.peak_rss_bytes()) / 2**20
+            levels.append(level)
+            _print_load_level(level)
+        if not args.url and hasattr(tts_handler.TTS, "call_overhead"):
+            status, held = await _check_timeout_release(client)
+            # ยกเลิกได้ระหว่าง model batch: worker ควรว่างภายในเวลาประมาณ batch เดียว
+            released = status == 504 and held < args.release_limit
+            print(f"\n⏱️  timeout check: status {status}, worker busy {held:.2f}s after the response"
+                  f"{'' if released else '  ❌ worker not released'}")
+    return levels, released
+
+async def _check_timeout_release(client, timeout=0.3, call_overhead=0.2):
+    """
+    request ที่ได้ 504 ต้องคืน inference worker: ยิงประกาศยาว (Auto Split หลาย batch) ที่ timeout แน่นอน
+    แล้วรอจน scheduler ไม่มีงาน running (in-process + MockTTS เท่านั้น)
+    คืน (status, วินาทีที่ worker ยังทำงานต่อหลังได้ response)
+    """
+
+    text = " ".join(_normalize_corpus()["announcements"][:8])
+    saved = tts_handler.scheduler.timeout, tts_handler.TTS.call_overhead
+    tts_handler.scheduler.timeout, tts_handler.TTS.call_overhead = timeout, call_overhead
+    try:
+        r = await client.post("/api/generate", data={"text": text, "ref_text": config.DEFAULT_REF_TEXT,
+                                                     "use_auto_split": "true"})
+        t0 = time.perf_counter()
+        while tts_handler.scheduler.stats()["running"] and time.perf_counter() - t0 < 30:
+            await asyncio.sleep(0.01)
+        return r.status_code, time.perf_counter() - t0
+    finally:
+        tts_handler.scheduler.timeout, tts_handler.TTS.call_overhead = saved
+
+def _print_load_level(level):
+    a = level["all"]
+    print(f"\n📊 concurrency={level['concurrency']}  {a['count']} requests in {a['wall_sec']:.2f}s  "
+          f"{a['throughput_rps']:.2f} req/s  errors={a['errors']}  peak RSS {level['peak_rss_mb']:.0f} MB")
+    print(f"   {'scenario':<20}{'n':>6}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'RTF':>8}")
+    for name, s in list(level["scenarios"].items()) + [("all", a)]:
+        if "p50_ms" not in s:
+            print(f"   {name:<20}{s['count']:>6}{'(all failed)':>30}")
+            continue
+        rtf = f"{s['rtf']:>8.2f}" if "rtf" in s else f"{'-':>8}"
+        print(f"   {name:<20}{s['count']:>6}{s['p50_ms']:>10.1f}{s['p95_ms']:>10.1f}{s['p99_ms']:>10.1f}{rtf}")
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+def _compare_load(levels, baseline, tolerance):
+    """
+    เทียบกับ baseline ทีละระดับ concurrency: p95 สูงขึ้น หรือ throughput ลดลง เกิน tolerance ถือว่า regression
+    """
+    base_levels = {lvl["concurrency"]: lvl for lvl in baseline["levels"]}
+    regressions = 0
+    print(f"\n📊 vs baseline {baseline['meta'].get('commit') or '?'} (tolerance {tolerance:.0%})")
+    print(f"   {'concurrency':<12}{'p95 ms':>18}{'req/s':>18}")
+    for level in levels:
+        base = base_levels.get(level["concurrency"])
+        if not base or "p95_ms" not in base["all"] or "p95_ms" not in level["all"]:
+            print(f"   {level['concurrency']:<12}{'(no baseline)':>18}")
+            continue
+        p95, base_p95 = level["all"]["p95_ms"], base["all"]["p95_ms"]
+        rps, base_rps = level["all"]["throughput_rps"], base["all"]["throughput_rps"]
+        worse = p95 > base_p95 * (1 + tolerance) or rps < base_rps * (1 - tolerance)
+        regressions += worse
+        print(f"   {level['concurrency']:<12}{base_p95:>8.1f} → {p95:<7.1f}{base_rps:>8.2f} → {rps:<7.2f}"
+              f"{'  ❌ regression' if worse else ''}")
+    return regressions
+
+def bench_load(args):
+    """
+    Latency/throughput แบบ end-to-end ผ่าน /api/generate และ /api/normalize ที่ concurrency หลายระดับ
+    (in-process หรือ server ที่ --url) บันทึก baseline เป็น JSON และเทียบกับ baseline เดิมได้
+    """
+    if not args.url:
+        _configure_mock(args)
+        if not args.segment_cache:
+            # วัด path การสังเคราะห์จริง ไม่ให้ระดับ concurrency ถัดไปได้ผลจาก cache ของระดับก่อน
+            tts_handler.segment_cache = None
+    levels, released = asyncio.run(_bench_load(args))
+
+    meta = {
+        "commit": _git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "target": args.url or "in-process",
+        "mix": args.mix,
+        "requests": args.requests,
+        "seed": args.seed,
+        "model": config.CURRENT_MODEL_VERSION,
+        "mock_tts": None,
+        "segment_cache": bool(args.url or args.segment_cache),
+    }
+    if not args.url and hasattr(tts_handler.TTS, "call_overhead"):
+        meta["mock_tts"] = {"call_overhead": args.call_overhead, "sec_per_char": args.sec_per_char}
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump({"meta": meta, "levels": levels}, f, ensure_ascii=False, indent=2)
+        print(f"\n💾 Baseline saved: {args.save}")
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        if _compare_load(levels, baseline, args.tolerance):
+            sys.exit(1)
+    if not released:
+        sys.exit(1)
+
+def main():
+    parser = argparse.ArgumentParser(description="TTS pipeline benchmarks")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("batch", help="per-segment loop vs batched inference")
+    p.add_argument("--model", default=config.CURRENT_MODEL_VERSION)
+    p.add_argument("--segments", type=int, default=60)
+    p.add_argument("--batch-size", type=int, default=config.INFER_BATCH_SIZE)
+    p.add_argument("--step", type=int, default=config.DEFAULT_STEPS)
+    p.add_argument("--ref-audio", default=config.DEFAULT_REF_AUDIO_PATH)
+    p.add_argument("--ref-text", default="")
+    p.add_argument("--call-overhead", type=float, default=0.05,
+                   help="MockTTS: simulated seconds per model call")
+    p.add_argument("--sec-per-char", type=float, default=0.0005,
+                   help="MockTTS: simulated seconds per generated character")
+    p.set_defaults(func=bench_batch)
+
+    p = sub.add_parser("startup", help="tokenizer startup: legacy trie vs compiled lexicon artifact")
+    p.add_argument("--runs", type=int, default=3)
+    p.set_defaults(func=bench_startup)
+
+    p = sub.add_parser("normalize", help="normalize_text latency over station names and announcements")
+    p.set_defaults(func=bench_normalize)
+
+    p = sub.add_parser("postprocess", help="trim/fade/pause/WAV write: legacy concatenate vs preallocated buffer")
+    p.add_argument("--segments", type=int, default=100)
+    p.add_argument("--runs", type=int, default=5)
+    p.set_defaults(func=bench_postprocess)
+
+    p = sub.add_parser("split", help="intelligent_split: single-pass generator vs legacy (identical output check)")
+    p.add_argument("--pages", type=int, default=50, help="pages in the long-document case")
+    p.add_argument("--runs", type=int, default=3)
+    p.add_argument("--save", default="", help="regenerate a golden JSON file from the legacy splitter")
+    p.add_argument("--compare", default=GOLDEN_SPLIT_PATH,
+                   help="golden JSON to compare against (exit 1 on difference; empty = skip)")
+    p.set_defaults(func=bench_split)
+
+    p = sub.add_parser("encode", help="encode time vs output size per format and sample rate")
+    p.add_argument("--seconds", type=float, default=60)
+    p.add_argument("--runs", type=int, default=3)
+    p.add_argument("--ref-audio", default=config.DEFAULT_REF_AUDIO_PATH)
+    p.set_defaults(func=bench_encode)
+
+    p = sub.add_parser("steps", help="step -> time/RTF per model version, to calibrate ADAPTIVE_MIN_STEPS")
+    p.add_argument("--model", default=config.CURRENT_MODEL_VERSION)
+    p.add_argument("--steps", type=lambda s: [int(v) for v in s.split(",")], default=[8, 16, 24, 32, 48],
+                   help="comma separated step values")
+    p.add_argument("--segments", type=int, default=16)
+    p.add_argument("--runs", type=int, default=3)
+    p.add_argument("--cfg", type=float, default=config.DEFAULT_CFG)
+    p.add_argument("--slo", type=float, default=config.LATENCY_SLO_SEC,
+                   help="print the highest step that meets this SLO for --chars (0 = skip)")
+    p.add_argument("--chars", type=int, default=300, help="request length for the --slo estimate")
+    p.add_argument("--ref-audio", default=config.DEFAULT_REF_AUDIO_PATH)
+    p.add_argument("--ref-text", default=config.DEFAULT_REF_TEXT)
+    p.add_argument("--call-overhead", type=float, default=0.05,
+                   help="MockTTS: simulated seconds per model call")
+    p.add_argument("--sec-per-char", type=float, default=0.0005,
+                   help="MockTTS: simulated seconds per generated character at step 32")
+    p.add_argument("--save", default="", help="write the table as JSON")
+    p.set_defaults(func=bench_steps)
+
+    p = sub.add_parser("load", help="end-to-end latency/throughput of /api/generate and /api/normalize")
+    p.add_argument("--url", default="", help="server to load (default: run the app in-process)")
+    p.add_argument("--mix", choices=sorted(LOAD_MIXES), default="mixed")
+    p.add_argument("--concurrency", type=lambda s: [int(c) for c in s.split(",")], default=[1, 4, 8],
+                   help="comma separated concurrency levels")
+    p.add_argument("--requests", type=int, default=100, help="requests per concurrency level")
+    p.add_argument("--warmup", type=int, default=5, help="untimed requests before the first level")
+    p.add_argument("--seed", type=int, default=0)
+    p.add_argument("--call-overhead", type=float, default=config.MOCK_CALL_OVERHEAD,
+                   help="MockTTS (in-process only): simulated seconds per model call")
+    p.add_argument("--sec-per-char", type=float, default=config.MOCK_SEC_PER_CHAR,
+                   help="MockTTS (in-process only): simulated seconds per generated character")
+    p.add_argument("--segment-cache", action="store_true",
+                   help="keep the segment cache on (in-process only; off by default so levels are comparable)")
+    p.add_argument("--save", default="", help="write results as a JSON baseline")
+    p.add_argument("--compare", default="", help="baseline JSON to compare against (exit 1 on regression)")
+    p.add_argument("--tolerance", type=float, default=0.10,
+                   help="allowed p95/throughput change before flagging a regression")
+    p.add_argument("--release-limit", type=float, default=1.0,
+                   help="in-process: max seconds a worker may stay busy after a 504 (exit 1 beyond)")
+    p.set_defaults(func=bench_load)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
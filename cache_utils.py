@@ -0,0 +1,339 @@
+# cache_utils.py
+import os
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+DIGEST_CHUNK = 1 << 20  # อ่านไฟล์/upload ทีละ 1 MB ตอน hash
+
+def _nbytes(obj):
+    """
+    ประมาณขนาด (bytes) ของ numpy array / torch tensor / dict ที่ซ้อนกัน
+    """
+    if obj is None: return 0
+    if hasattr(obj, "nbytes"): return int(obj.nbytes)
+    if hasattr(obj, "element_size") and hasattr(obj, "nelement"):
+        return int(obj.element_size() * obj.nelement())
+    if isinstance(obj, dict): return sum(_nbytes(v) for v in obj.values())
+    if isinstance(obj, (list, tuple)): return sum(_nbytes(v) for v in obj)
+    return 0
+
+class LRUByteCache:
+    """
+    LRU Cache ที่จำกัดขนาดรวมเป็น bytes (thread-safe)
+    ค่าที่เก็บต้องวัดขนาดได้ด้วย _nbytes หรือมี method nbytes()
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()   # key -> (value, size)
+        self._lock = threading.RLock()
+
+    def _size_of(self, value):
+        size = getattr(value, "nbytes", None)
+        if callable(size): return int(size())
+        return _nbytes(value)
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def put(self, key, value):
+        with self._lock:
+            if key in self._items:
+                self.current_bytes -= self._items.pop(key)[1]
+            size = self._size_of(value)
+            self._items[key] = (value, size)
+            self.current_bytes += size
+            self._evict()
+
+    def resize(self, key):
+        """
+        คำนวณขนาดใหม่ของ key (เช่นหลังเติม conditioning ให้ Reference) แล้ว evict ถ้าเกินงบ
+        """
+        with self._lock:
+            item = self._items.get(key)
+            if item is None: return
+            size = self._size_of(item[0])
+            self.current_bytes += size - item[1]
+            self._items[key] = (item[0], size)
+            self._evict()
+
+    def pop(self, key):
+        with self._lock:
+            item = self._items.pop(key, None)
+            if item is None: return None
+            self.current_bytes -= item[1]
+            self.on_evict(key, item[0])
+            return item[0]
+
+    def discard_if(self, predicate):
+        """
+        ลบทุก key ที่ predicate(key) เป็นจริง คืนจำนวนที่ลบ
+        """
+        with self._lock:
+            keys = [key for key in self._items if predicate(key)]
+            for key in keys:
+                self.pop(key)
+            return len(keys)
+
+    def _evict(self):
+        # เก็บ item ล่าสุดไว้เสมอ แม้จะใหญ่กว่างบทั้งก้อน
+        while self.current_bytes > self.max_bytes and len(self._items) > 1:
+            key, (value, size) = self._items.popitem(last=False)
+            self.current_bytes -= size
+            self.on_evict(key, value)
+
+    def on_evict(self, key, value):
+        pass
+
+    def clear(self):
+        with self._lock:
+            for key in list(self._items):
+                self.pop(key)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._items
+
+    def __len__(self):
+        return len(self._items)
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self._items),
+                "bytes": self.current_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits / total) if total else 0.0,
+            }
+
+class LRUCache(LRUByteCache):
+    """
+    LRU Cache ที่จำกัดจำนวน entry (ทุก item นับขนาดเป็น 1)
+    """
+    def _size_of(self, value):
+        return 1
+
+# --- Reference Audio Cache ---
+
+def audio_digest(source):
+    """
+    SHA-256 ของ bytes เสียง หรือของ file-like ทั้งไฟล์ (อ่านทีละ DIGEST_CHUNK แล้ว seek กลับไปต้นไฟล์)
+    """
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return hashlib.sha256(source).digest()
+    h = hashlib.sha256()
+    source.seek(0)
+    for chunk in iter(lambda: source.read(DIGEST_CHUNK), b""):
+        h.update(chunk)
+    source.seek(0)
+    return h.digest()
+
+def reference_key(digest, ref_text):
+    """
+    key = SHA-256(SHA-256(bytes เสียง) + ref_text) ไฟล์เดียวกันจะได้ key เดียวกันไม่ว่าจะมาจาก path หรือ upload
+    """
+    h = hashlib.sha256(digest)
+    h.update(b"\0")
+    h.update(ref_text.encode("utf-8"))
+    return h.hexdigest()
+
+class ReferenceAudio:
+    """
+    Reference ที่ decode แล้ว (mono float32 ที่ sample rate ของโมเดล)
+    path: ไฟล์ต้นฉบับ หรือ None สำหรับเสียงที่อัปโหลด (tts_handler.reference_path เขียนไฟล์ให้เมื่อจำเป็น)
+    conditioning: feature ฝั่งโมเดล แยกตาม model version (เติมทีหลังโดย tts_handler)
+    """
+    def __init__(self, key, path, ref_text, waveform, sr, owns_file=False):
+        self.key = key
+        self.path = path
+        self.ref_text = ref_text
+        self.waveform = waveform
+        self.sr = sr
+        self.duration = len(waveform) / sr if sr else 0.0
+        self.conditioning = {}
+        self.owns_file = owns_file
+
+    def nbytes(self):
+        return _nbytes(self.waveform) + _nbytes(self.conditioning)
+
+class ReferenceCache(LRUByteCache):
+    """
+    Cache ของ Reference Audio โดยใช้ SHA-256 ของ bytes เสียง + ref_text เป็น key
+    ไฟล์อ้างอิงของเสียงที่อัปโหลดจะถูกลบเมื่อโดน evict
+    """
+    def __init__(self, max_bytes):
+        super().__init__(max_bytes)
+        self._path_keys = {}   # path -> (mtime_ns, size, sha256 ของไฟล์)
+
+    def file_digest(self, path):
+        """
+        Hash ของไฟล์บนดิสก์ (จำไว้ตาม mtime/size จะได้ไม่ต้องอ่านไฟล์ซ้ำทุก request)
+        """
+        st = os.stat(path)
+        stamp = (st.st_mtime_ns, st.st_size)
+        with self._lock:
+            cached = self._path_keys.get(path)
+            if cached and cached[:2] == stamp:
+                return cached[2]
+        with open(path, "rb") as f:
+            digest = audio_digest(f)
+        with self._lock:
+            self._path_keys[path] = (*stamp, digest)
+        return digest
+
+    def drop_conditioning(self, model_type):
+        """
+        ทิ้ง conditioning ของโมเดลหนึ่งจากทุก Reference (เรียกเมื่อโมเดลนั้นถูก evict)
+        """
+        with self._lock:
+            for key, (ref, _) in list(self._items.items()):
+                if ref.conditioning.pop(model_type, None) is not None:
+                    self.resize(key)
+
+    def on_evict(self, key, value):
+        if value.owns_file and value.path and os.path.exists(value.path):
+            try: os.remove(value.path)
+            except OSError: pass
+
+# --- Synthesized Segment Cache ---
+
+def segment_key(text, model_version, ref_key, step, cfg, speed, fix_duration):
+    """
+    key ของเสียงที่สังเคราะห์แล้ว: ข้อความ (ยุบช่องว่าง) + พารามิเตอร์ทุกตัวที่มีผลกับเสียง
+    """
+    text = " ".join(text.split())
+    fix = None if fix_duration is None else round(float(fix_duration), 3)
+    raw = repr((text, model_version, ref_key, int(step), round(float(cfg), 3), round(float(speed), 3), fix))
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+class SegmentCache:
+    """
+    Cache เสียงของ Segment 2 ชั้น:
+    - memory: LRU (จำกัด bytes)
+    - disk: ไฟล์ float32 ดิบ (<key>.f32) อ่านด้วย np.fromfile, ลบไฟล์เก่าสุดเมื่อเกิน disk_max_bytes
+    get() คืนสำเนาเสมอ เพราะขั้น post-process แก้ array แบบ in-place
+    """
+    def __init__(self, max_bytes, cache_dir=None, disk_max_bytes=0):
+        self.memory = LRUByteCache(max_bytes)
+        self.cache_dir = cache_dir if disk_max_bytes > 0 else None
+        self.disk_max_bytes = disk_max_bytes
+        self.disk_bytes = 0
+        self.hits_memory = 0
+        self.hits_disk = 0
+        self.misses = 0
+        self._disk = OrderedDict()   # key -> size (เก่าสุดอยู่หน้า)
+        self._lock = threading.RLock()
+        if self.cache_dir:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            self._scan_disk()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.f32")
+
+    def _scan_disk(self):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(".f32"): continue
+            st = os.stat(os.path.join(self.cache_dir, name))
+            entries.append((st.st_mtime, name[:-4], st.st_size))
+        for _, key, size in sorted(entries):
+            self._disk[key] = size
+            self.disk_bytes += size
+
+    def get(self, key):
+        wav = self.memory.get(key)
+        if wav is not None:
+            with self._lock: self.hits_memory += 1
+            return np.array(wav, dtype=np.float32)
+
+        if self.cache_dir:
+            with self._lock:
+                on_disk = key in self._disk
+                if on_disk: self._disk.move_to_end(key)
+            if on_disk:
+                try:
+                    # อ่านทั้งไฟล์ (ไม่ memory-map) ไม่ให้ entry ใน memory LRU ถือ file descriptor ค้างไว้
+                    wav = np.fromfile(self._path(key), dtype=np.float32)
+                    self.memory.put(key, wav)
+                    with self._lock: self.hits_disk += 1
+                    return np.array(wav, dtype=np.float32)
+                except OSError:
+                    with self._lock:
+                        self.disk_bytes -= self._disk.pop(key, 0)
+
+        with self._lock: self.misses += 1
+        return None
+
+    def put(self, key, wav):
+        wav = np.ascontiguousarray(wav, dtype=np.float32)
+        self.memory.put(key, wav.copy())
+        if not self.cache_dir: return
+
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            wav.tofile(tmp_path)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f"Segment cache write failed: {e}")
+            if os.path.exists(tmp_path): os.remove(tmp_path)
+            return
+
+        with self._lock:
+            self.disk_bytes -= self._disk.pop(key, 0)
+            self._disk[key] = wav.nbytes
+            self.disk_bytes += wav.nbytes
+            while self.disk_bytes > self.disk_max_bytes and len(self._disk) > 1:
+                old_key, size = self._disk.popitem(last=False)
+                self.disk_bytes -= size
+                try: os.remove(self._path(old_key))
+                except OSError: pass
+
+    def discard(self, key):
+        self.memory.pop(key)
+        if not self.cache_dir: return
+        with self._lock:
+            if key not in self._disk: return
+            self.disk_bytes -= self._disk.pop(key)
+        try: os.remove(self._path(key))
+        except OSError: pass
+
+    def clear(self, disk=False):
+        self.memory.clear()
+        if disk and self.cache_dir:
+            with self._lock:
+                keys = list(self._disk)
+            for key in keys:
+                self.discard(key)
+
+    def stats(self):
+        with self._lock:
+            hits = self.hits_memory + self.hits_disk
+            total = hits + self.misses
+            return {
+                "memory_entries": len(self.memory),
+                "memory_bytes": self.memory.current_bytes,
+                "disk_entries": len(self._disk),
+                "disk_bytes": self.disk_bytes,
+                "hits_memory": self.hits_memory,
+                "hits_disk": self.hits_disk,
+                "misses": self.misses,
+                "hit_rate": (hits / total) if total else 0.0,
+            }
@@ -16,11 +16,20 @@ os.environ["HF_HOME"] = HF_HOME
 
 # Input Paths
 LEXICON_PATH = os.getenv("LEXICON_PATH", os.path.join(DATA_DIR, "stations_600.json"))
+# Precompiled tokenizer index (rebuilt automatically when the lexicon changes; empty = disabled)
+LEXICON_CACHE_PATH = os.getenv("LEXICON_CACHE_PATH", os.path.join(DATA_DIR, "cache", "lexicon_index.pkl"))
+# Poll the lexicon file every N seconds and apply changes without restart (0 = off; PATCH /api/lexicon still works)
+LEXICON_WATCH_INTERVAL = float(os.getenv("LEXICON_WATCH_INTERVAL", 2.0))
 DEFAULT_REF_AUDIO_PATH = os.getenv("DEFAULT_REF_AUDIO_PATH", os.path.join(DATA_DIR, "reference.wav"))
+DEFAULT_REF_TEXT = os.getenv("DEFAULT_REF_TEXT", "ยินดีต้อนรับ สู่การรถไฟแห่งประเทศไทย  ขบวนรถไฟ กำลังจะเข้าสู่ชานชาลา  โปรดระมัดระวังค่ะ")
 
 # Output Paths
 RESULTS_AUDIO_DIR = os.path.join(RESULTS_DIR, "audio")
-RESULTS_CSV_PATH = os.path.join(RESULTS_DIR, "results.csv")
+RESULTS_CSV_PATH = os.path.join(RESULTS_DIR, "results.csv")  # รูปแบบเดิม: ย้ายเข้า RESULTS_DB_PATH ตอนเริ่ม server
+RESULTS_DB_PATH = os.getenv("RESULTS_DB_PATH", os.path.join(RESULTS_DIR, "results.db"))
+# Group commit: รวมแถวที่บันทึกพร้อมกันไม่เกิน RESULTS_BATCH_SIZE หรือรอไม่เกิน RESULTS_FLUSH_MS
+RESULTS_BATCH_SIZE = int(os.getenv("RESULTS_BATCH_SIZE", 64))
+RESULTS_FLUSH_MS = int(os.getenv("RESULTS_FLUSH_MS", 20))
 
 # Create directories if not exist
 os.makedirs(RESULTS_AUDIO_DIR, exist_ok=True)
@@ -34,6 +43,13 @@ HOST = os.getenv("HOST", "0.0.0.0")
 PORT = int(os.getenv("PORT", 8000))
 RELOAD = os.getenv("RELOAD", "true").lower() == "true"
 
+# Production serving (serve.py: gunicorn + uvicorn workers)
+WORKERS = int(os.getenv("WORKERS", 1))
+# torch/BLAS threads per worker (0 = CPU cores / WORKERS)
+WORKER_THREADS = int(os.getenv("WORKER_THREADS", 0))
+# Load the tokenizer and models once in the master so forked workers share them copy-on-write (CPU only)
+PRELOAD_MODELS = os.getenv("PRELOAD_MODELS", "true").lower() == "true"
+
 # TTS Generation Default Parameters
 DEFAULT_STEPS = int(os.getenv("DEFAULT_STEPS", 32))
 DEFAULT_SPEED = float(os.getenv("DEFAULT_SPEED", 1.0))
@@ -41,6 +57,91 @@ DEFAULT_CFG = float(os.getenv("DEFAULT_CFG", 2.0))
 USE_NORM_DEFAULT = os.getenv("USE_NORM_DEFAULT", "true").lower() == "true"
 USE_AUTO_SPLIT_DEFAULT = os.getenv("USE_AUTO_SPLIT_DEFAULT", "false").lower() == "true"
 
+# Model Manager (LRU of loaded models; 0 = no budget)
+MODEL_RAM_BUDGET_MB = int(os.getenv("MODEL_RAM_BUDGET_MB", 0))
+MODEL_VRAM_BUDGET_MB = int(os.getenv("MODEL_VRAM_BUDGET_MB", 0))
+# Versions loaded in the background at startup (comma separated)
+MODEL_PREWARM = [v.strip() for v in os.getenv("MODEL_PREWARM", CURRENT_MODEL_VERSION).split(",") if v.strip()]
+
+# Warm-up before /ready reports ready (warmup.py)
+WARMUP_ENABLED = os.getenv("WARMUP_ENABLED", "true").lower() == "true"
+# One dummy inference per model at each of these step counts
+WARMUP_STEPS = [int(v) for v in os.getenv("WARMUP_STEPS", str(DEFAULT_STEPS)).split(",") if v.strip()]
+# Registered reference voices "path|ref_text" separated by ";" (decoded + conditioned per model at startup)
+WARMUP_REFERENCES = [
+    (path.strip(), ref_text.strip())
+    for path, _, ref_text in (entry.partition("|") for entry in
+                              os.getenv("WARMUP_REFERENCES", f"{DEFAULT_REF_AUDIO_PATH}|{DEFAULT_REF_TEXT}").split(";"))
+    if path.strip()
+]
+# Hot phrases to pre-normalize: text file (one per line) or JSON list / dict keys (empty = off)
+WARMUP_PHRASES_PATH = os.getenv("WARMUP_PHRASES_PATH", "")
+
+# Mock TTS (used when f5_tts_th is not installed): simulated inference cost for benchmarks
+MOCK_CALL_OVERHEAD = float(os.getenv("MOCK_CALL_OVERHEAD", 0.0))
+MOCK_SEC_PER_CHAR = float(os.getenv("MOCK_SEC_PER_CHAR", 0.0))
+
+# Text Normalization memo (entries)
+NORMALIZE_CACHE_SIZE = int(os.getenv("NORMALIZE_CACHE_SIZE", 10000))
+
+# Batched Inference (Auto Split)
+INFER_BATCH_SIZE = int(os.getenv("INFER_BATCH_SIZE", 8))
+
+# Inference Scheduler (worker pool + bounded queue)
+INFER_WORKERS = int(os.getenv("INFER_WORKERS", 1))
+INFER_QUEUE_SIZE = int(os.getenv("INFER_QUEUE_SIZE", 16))
+INFER_TIMEOUT = float(os.getenv("INFER_TIMEOUT", 300))
+
+# Adaptive step/CFG under load (step_control.py)
+ADAPTIVE_STEPS_ENABLED = os.getenv("ADAPTIVE_STEPS_ENABLED", "false").lower() == "true"
+# Target latency per request (queue wait + synthesis) before steps are lowered
+LATENCY_SLO_SEC = float(os.getenv("LATENCY_SLO_SEC", 10.0))
+# Lowest step per model version: "16" or "16,v2:20" (a bare number applies to every version)
+ADAPTIVE_MIN_STEPS = {
+    (version.strip() if steps else "*"): int(steps or version)
+    for version, _, steps in (entry.partition(":") for entry in os.getenv("ADAPTIVE_MIN_STEPS", "16").split(","))
+    if version.strip()
+}
+# Segments shorter than this run without CFG (cfg=0) when over the SLO (0 = never skip CFG)
+ADAPTIVE_CFG_SKIP_CHARS = int(os.getenv("ADAPTIVE_CFG_SKIP_CHARS", 15))
+
+# Dynamic Micro-Batching across concurrent requests (needs INFER_WORKERS > 1 to have anything to merge)
+COALESCE_ENABLED = os.getenv("COALESCE_ENABLED", "false").lower() == "true"
+COALESCE_MAX_BATCH = int(os.getenv("COALESCE_MAX_BATCH", 16))
+COALESCE_MAX_WAIT_MS = float(os.getenv("COALESCE_MAX_WAIT_MS", 10))
+
+# Reference Audio Cache (decoded waveform + conditioning, LRU by size)
+REF_CACHE_MAX_MB = int(os.getenv("REF_CACHE_MAX_MB", 512))
+
+# Synthesized Segment Cache (memory LRU + raw float32 files on disk, read whole into memory on a hit)
+SEGMENT_CACHE_ENABLED = os.getenv("SEGMENT_CACHE_ENABLED", "true").lower() == "true"
+SEGMENT_CACHE_MAX_MB = int(os.getenv("SEGMENT_CACHE_MAX_MB", 256))
+SEGMENT_CACHE_DIR = os.getenv("SEGMENT_CACHE_DIR", os.path.join(DATA_DIR, "segment_cache"))
+SEGMENT_CACHE_DISK_MAX_MB = int(os.getenv("SEGMENT_CACHE_DISK_MAX_MB", 2048))
+
+# Quality Gate (silent/degenerate segment detection + retry)
+QUALITY_DECIMATE = int(os.getenv("QUALITY_DECIMATE", 4))
+QUALITY_SILENCE_RMS = float(os.getenv("QUALITY_SILENCE_RMS", 0.002))
+# Speaking rate of the reference (chars/sec) is used to predict retry durations; outside this range the default is used
+QUALITY_DEFAULT_CHARS_PER_SEC = float(os.getenv("QUALITY_DEFAULT_CHARS_PER_SEC", 8.0))
+QUALITY_MIN_CHARS_PER_SEC = float(os.getenv("QUALITY_MIN_CHARS_PER_SEC", 3.0))
+QUALITY_MAX_CHARS_PER_SEC = float(os.getenv("QUALITY_MAX_CHARS_PER_SEC", 25.0))
+QUALITY_DURATION_MARGIN = float(os.getenv("QUALITY_DURATION_MARGIN", 1.15))
+# Retry candidates (multiples of the predicted duration) synthesized together in one batch;
+# segments that still fail get one more retry at ref duration + 6s
+QUALITY_RETRY_SCALES = [float(v) for v in os.getenv("QUALITY_RETRY_SCALES", "1.0,1.3").split(",") if v.strip()]
+# Add a speculative candidate to the first batch when a text class fails at least this often (0 = off)
+QUALITY_SPECULATE_RATE = float(os.getenv("QUALITY_SPECULATE_RATE", 0.25))
+
+# Offline Batch Jobs (batch_jobs.py / /api/jobs)
+BATCH_JOBS_DIR = os.getenv("BATCH_JOBS_DIR", os.path.join(DATA_DIR, "jobs"))
+BATCH_JOB_WORKERS = int(os.getenv("BATCH_JOB_WORKERS", 1))
+BATCH_JOB_CHUNK_SIZE = int(os.getenv("BATCH_JOB_CHUNK_SIZE", 64))
+# Directories a job's "ref" may point into (comma-separated); the default/warm-up references are always allowed
+BATCH_REF_DIRS = [d.strip() for d in os.getenv("BATCH_REF_DIRS", DATA_DIR).split(",") if d.strip()]
+# Jobs that may run at once via /api/jobs (more are rejected with 429)
+BATCH_MAX_JOBS = int(os.getenv("BATCH_MAX_JOBS", 2))
+
 # Audio Processing
 FADE_DURATION = float(os.getenv("FADE_DURATION", 0.02))
 SILENCE_THRESHOLD = float(os.getenv("SILENCE_THRESHOLD", 0.005))
@@ -51,4 +152,6 @@ MIN_PAUSE_DURATION = float(os.getenv("MIN_PAUSE_DURATION", 0.07))
 MAX_PAUSE_DURATION = float(os.getenv("MAX_PAUSE_DURATION", 0.14))
 
 # Logging
-LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
\ No newline at end of file
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+# text (key=value) or json (one JSON object per line)
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")
\ No newline at end of file
@@ -1,41 +1,83 @@
 # main.py
 import os
 import io
+import asyncio
+import time
 import uuid
-import csv
-import random
-import numpy as np
+import shutil
+import logging
 import soundfile as sf
 from datetime import datetime
 from typing import Optional
 from contextlib import asynccontextmanager
-from fastapi import FastAPI, UploadFile, File, Form, HTTPException
-from fastapi.responses import StreamingResponse, HTMLResponse
+from fastapi import FastAPI, UploadFile, File, Form, Body, HTTPException, WebSocket, WebSocketDisconnect
+from fastapi.responses import Response, StreamingResponse, HTMLResponse, JSONResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from fastapi.requests import Request
+from starlette.concurrency import run_in_threadpool
 
 # Import local modules
 import config
 import audio_utils
 import text_utils
 import tts_handler
+import quality_gate
+import batch_jobs
+import results_store
+import observability
+import step_control
+import warmup
+
+observability.setup_logging()
+logger = logging.getLogger(__name__)
 
 # --- Lifecycle ---
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    # Setup Dictionary
-    text_utils.setup_tokenizer()
-    # Pre-load default model
-    print(f"🚀 Pre-loading default model ({config.CURRENT_MODEL_VERSION})...")
-    tts_handler.get_tts_model(config.CURRENT_MODEL_VERSION)
+    # Setup Dictionary (serve.py โหลดไว้ใน master ก่อน fork แล้ว) + ตรวจไฟล์ Lexicon เพื่อ reload โดยไม่ต้อง restart
+    if text_utils.custom_tokenizer is None:
+        text_utils.setup_tokenizer()
+    text_utils.watcher.start()
+    # Pre-load models + warm-up in the background (request แรกที่มาระหว่างโหลดจะรอการโหลดเดียวกัน, /ready ตอบ 503 จนเสร็จ)
+    logger.info(f"Pre-loading models ({', '.join(config.MODEL_PREWARM)})")
+    warmup.start(config.MODEL_PREWARM)
+    # ย้าย results.csv เดิมเข้า SQLite (ครั้งเดียว)
+    await run_in_threadpool(results_store.store.migrate_csv, config.RESULTS_CSV_PATH)
     yield
     # Cleanup
+    text_utils.watcher.stop()
+    results_store.store.close()
     tts_handler.clear_cache()
     import gc
     gc.collect()
 
+class RequestIdMiddleware:
+    """
+    ASGI middleware: ใช้ X-Request-ID จาก client (หรือสร้างใหม่) เป็น request_id ของทุก log/trace และส่งกลับใน header
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] not in ("http", "websocket"):
+            return await self.app(scope, receive, send)
+        headers = dict(scope.get("headers") or [])
+        rid = headers.get(b"x-request-id", b"").decode("latin-1")[:64] or uuid.uuid4().hex[:16]
+        token = observability.request_id.set(rid)
+
+        async def send_with_id(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = list(message.get("headers", [])) + [(b"x-request-id", rid.encode("latin-1"))]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            observability.request_id.reset(token)
+
 app = FastAPI(lifespan=lifespan)
+app.add_middleware(RequestIdMiddleware)
 app.mount("/files", StaticFiles(directory=config.DATA_DIR), name="files")
 templates = Jinja2Templates(directory="templates")
 
@@ -47,11 +89,252 @@ async def read_root(request: Request):
 
 @app.post("/api/normalize")
 async def api_normalize(text: str = Form(...)):
-    normalized, tokens = text_utils.normalize_text(text)
+    trace = observability.start_trace("normalize")
+    with observability.stage("normalize"):
+        normalized, tokens = text_utils.normalize_text(text)
+    trace.set(chars=len(text))
+    trace.finish()
     return {"original": text, "normalized": normalized, "tokens": tokens}
 
+@app.patch("/api/lexicon")
+async def api_lexicon_patch(changes: dict = Body(...)):
+    """
+    แก้ Lexicon โดยไม่ต้อง restart: {"upsert": {"คำ": "คำอ่าน"}, "remove": ["คำ"]}
+    บันทึกลงไฟล์ Lexicon ด้วย (worker อื่นที่เปิด LEXICON_WATCH_INTERVAL จะเห็นจากไฟล์)
+    """
+    upserts = changes.get("upsert") or {}
+    removals = changes.get("remove") or []
+    if not isinstance(upserts, dict) or not isinstance(removals, list):
+        raise HTTPException(status_code=400, detail="upsert must be an object and remove a list")
+    return await run_in_threadpool(text_utils.apply_lexicon_changes, upserts, removals, persist=True)
+
+@app.post("/api/lexicon/reload")
+async def api_lexicon_reload():
+    try:
+        return await run_in_threadpool(text_utils.reload_lexicon)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Lexicon file unreadable: {e}")
+
+@app.get("/api/lexicon/stats")
+async def api_lexicon_stats():
+    return text_utils.lexicon_stats()
+
+def _load_ref(ref_text, ref_file=None):
+    """
+    Handle Reference Audio (decode/duration/conditioning ถูก cache ตาม hash ของเสียง + ref_text)
+    ref_file: file-like ของ upload (spooled) decode ตรงจาก buffer ไม่ผ่านไฟล์ temp
+    """
+    try:
+        if ref_file is not None:
+            return tts_handler.load_reference(ref_file, ref_text)
+        if os.path.exists(config.DEFAULT_REF_AUDIO_PATH):
+            return tts_handler.load_reference(config.DEFAULT_REF_AUDIO_PATH, ref_text)
+        raise FileNotFoundError(config.DEFAULT_REF_AUDIO_PATH)
+    except OSError:
+        raise HTTPException(status_code=400, detail="Reference audio file not found.")
+    except tts_handler.ReferenceDecodeError as e:
+        if ref_file is not None:
+            raise HTTPException(status_code=400, detail=str(e))
+        logger.error(f"Default reference {config.DEFAULT_REF_AUDIO_PATH}: {e}")
+        raise HTTPException(status_code=500, detail="Default reference audio could not be decoded.")
+
+def _plan_text(text, ref, is_use_norm, is_auto_split):
+    """
+    เตรียมข้อความที่จะสังเคราะห์จริง (split + normalize) ก่อนตัดสิน step: คืน (seg_texts, forced_durs)
+    step_control ประมาณเวลาจากจำนวนตัวอักษรหลัง normalize (ตัวเลข/คำย่อยาวกว่าข้อความดิบมาก)
+    ซึ่งเป็นหน่วยเดียวกับที่ _generate_segments บันทึกเป็น cost; ไม่ Auto Split = Segment เดียว
+    """
+    if not is_auto_split:
+        gen_text = text
+        if is_use_norm:
+            with observability.stage("normalize"):
+                gen_text = text_utils.normalize_text(text)[0]
+        return [gen_text], [None]
+    ref_duration_sec = ref.duration if ref.duration > 0 else 5.0
+    return tts_handler.plan_segments(text, ref_duration_sec, is_use_norm)
+
+def _planned_chars(plan):
+    return sum(len(t) for t in plan[0])
+
+def _generate_segments(plan, model, model_version, ref, is_auto_split,
+                       speed, step, cfg, stream=False, cancel_event=None, cfg_skip_chars=0):
+    """
+    Generator: yield เสียงดิบ (float) ของแต่ละ Segment ตามลำดับ (ยังไม่ตัดเงียบ/Fade ดู _post_options)
+    plan: ผลของ _plan_text
+    stream=True จะสังเคราะห์ Segment แรกก่อน เพื่อให้ส่งเสียงแรกออกไปได้เร็วที่สุด
+    รันบน worker ของ tts_handler.scheduler (blocking) และหยุดเมื่อ cancel_event ถูก set
+    cfg_skip_chars: Segment ที่สั้นกว่านี้ใช้ cfg=0 (step_control ตัดสินเมื่อเกิน SLO)
+    เมื่อจบ: ป้อนเวลา inference ของตัวอักษรที่สังเคราะห์จริง (ไม่รวม cache hit/retry/กลุ่มที่ข้าม CFG)
+    และเวลาทั้ง request ให้ step_control.controller
+    """
+    trace = observability.current_trace()
+    t0 = time.perf_counter()
+    usage = {"chars": 0, "seconds": 0.0}
+    seg_texts, forced_durs = plan
+
+    logger.info(f"Generating ({model_version}): {' '.join(seg_texts)[:50]}... (AutoSplit: {is_auto_split})")
+
+    # Get Ref Duration
+    ref_duration_sec = ref.duration if ref.duration > 0 else 5.0
+    logger.debug(f"Ref Duration: {ref_duration_sec:.2f}s")
+
+    if is_auto_split:
+        # =========================================================
+        # 🔥 AUTO SPLIT & SHORT TEXT FIX LOGIC 🔥
+        # =========================================================
+        if trace: trace.set(segments=len(seg_texts), chars=_planned_chars(plan))
+
+        # Inference: segment cache + batch + retry ถ้าเงียบ (ดู tts_handler.synthesize_segments)
+        wavs = tts_handler.synthesize_segments(
+            model, model_version, ref, seg_texts,
+            step=step, speed=speed, cfg=cfg,
+            fix_durations=forced_durs,
+            retry_duration=ref_duration_sec + 6.0,
+            first_batch_size=1 if stream else None,
+            cancel_event=cancel_event,
+            cfg_skip_chars=cfg_skip_chars,
+            usage=usage
+        )
+
+        yield from wavs
+    else:
+        # --- Standard Logic ---
+        gen_text = seg_texts[0]
+        if trace: trace.set(segments=1, chars=len(gen_text))
+        if cfg_skip_chars and len(gen_text) < cfg_skip_chars: cfg = 0.0
+        seg_cache = tts_handler.segment_cache
+        cache_key = tts_handler.segment_cache_key(gen_text, model_version, ref, step, cfg, speed)
+        final_wav = seg_cache.get(cache_key) if seg_cache else None
+        if final_wav is None:
+            t_infer = time.perf_counter()
+            with observability.stage("infer"):
+                final_wav = tts_handler.to_mono(model.infer(
+                    ref_audio=tts_handler.reference_input(model, ref), ref_text=ref.ref_text, gen_text=gen_text,
+                    step=step, speed=speed, cfg=cfg
+                ))
+            if cfg:
+                usage["chars"], usage["seconds"] = len(gen_text), time.perf_counter() - t_infer
+            if seg_cache and quality_gate.check_segment(final_wav) is None:
+                seg_cache.put(cache_key, final_wav)
+        else:
+            logger.debug("Segment cache hit")
+        yield final_wav
+
+    step_control.controller.observe(model_version, step, usage["chars"], usage["seconds"])
+    step_control.controller.observe_service(time.perf_counter() - t0)
+
+def _post_options(is_auto_split):
+    # Auto Split: ตัดเงียบ + Fade 0.05 ทุก Segment และเว้นวรรคระหว่าง Segment / ปกติ: Fade 0.02 อย่างเดียว
+    if is_auto_split:
+        return {"trim": True, "fade_duration": 0.05}
+    return {"trim": False, "fade_duration": 0.02}
+
+def _render_audio(wavs, ref, is_auto_split, fmt="wav", sr=24000):
+    """
+    WAV: ต่อทุก Segment ลง buffer เดียว (audio_utils.render_segments) แล้วเขียน PCM16
+    format บีบอัด: encode ทีละ Segment (ไม่ต้องเก็บ float ของทั้งไฟล์)
+    """
+    trace = observability.current_trace()
+    if fmt != "wav":
+        encoder = audio_utils.AudioEncoder(fmt, sr)
+        for clip in _generate_clips(wavs, ref, is_auto_split):
+            if trace: trace.add(audio_sec=len(clip) / 24000)
+            with observability.stage("encode"):
+                encoder.write(clip)
+        with observability.stage("encode"):
+            return encoder.close()
+
+    pcm = audio_utils.render_segments(wavs, ref.path, pcm16=sr == 24000, **_post_options(is_auto_split))
+    if trace: trace.add(audio_sec=len(pcm) / 24000)
+    with observability.stage("encode"):
+        if sr != 24000:
+            pcm = audio_utils.to_pcm16_inplace(audio_utils.resample(pcm, 24000, sr))
+        buffer = io.BytesIO()
+        sf.write(buffer, pcm, sr, format='WAV', subtype='PCM_16')
+        return buffer.getvalue()
+
+def _generate_clips(wavs, ref, is_auto_split):
+    """
+    Generator (stream): ก้อนเสียงที่ตัดเงียบ/ใส่ Fade แล้วทีละ Segment รวมช่วงเว้นวรรค
+    """
+    return audio_utils.postprocess_segments(wavs, ref.path, **_post_options(is_auto_split))
+
+def _stream_audio(clips, fmt="wav", sr=24000):
+    """
+    ส่ง header (WAV ไม่ระบุความยาว / Ogg) แล้วตามด้วยเสียงที่ encode แล้วของแต่ละก้อนทันทีที่สังเคราะห์เสร็จ
+    """
+    trace = observability.current_trace()
+    status = "cancelled"
+    encoder = audio_utils.AudioEncoder(fmt, sr, streaming=True)
+    header = encoder.flush()
+    if header: yield header
+    try:
+        for clip in clips:
+            with observability.stage("encode"):
+                data = encoder.write(clip)
+            if trace: trace.add(audio_sec=len(clip) / 24000)
+            if data: yield data
+        with observability.stage("encode"):
+            data = encoder.close()
+        if data: yield data
+        status = "ok"
+    except tts_handler.InferenceCancelled:
+        logger.warning("Stream cancelled (client disconnected)")
+    except Exception as e:
+        # Header ถูกส่งไปแล้ว เปลี่ยน status ไม่ได้ ทำได้แค่จบ stream
+        status = "error"
+        logger.exception(f"Error (stream): {e}")
+    finally:
+        if trace: trace.finish(status)
+
+# Accept media type -> format (ดู audio_utils.OUTPUT_FORMATS)
+ACCEPT_FORMATS = {
+    "audio/wav": "wav", "audio/x-wav": "wav", "audio/wave": "wav",
+    "audio/flac": "flac", "audio/x-flac": "flac",
+    "audio/ogg": "opus", "audio/opus": "opus",
+    "audio/mpeg": "mp3", "audio/mp3": "mp3",
+    "audio/*": "wav", "*/*": "wav",
+}
+
+def _negotiate_format(output_format, accept, sample_rate, is_stream):
+    """
+    เลือก format จาก field output_format (ถ้ามี) หรือ header Accept (ตาม q) ไม่ตรงอะไรเลยใช้ WAV
+    """
+    if output_format:
+        fmt = output_format.lower()
+        if fmt not in audio_utils.OUTPUT_FORMATS:
+            raise HTTPException(status_code=400, detail=f"Unsupported format: {output_format} "
+                                f"(supported: {', '.join(audio_utils.OUTPUT_FORMATS)})")
+    else:
+        candidates = []
+        for i, part in enumerate((accept or "").split(",")):
+            media, *params = [p.strip() for p in part.split(";")]
+            q = 1.0
+            for param in params:
+                if param.startswith("q="):
+                    try: q = float(param[2:])
+                    except ValueError: q = 0.0
+            fmt = ACCEPT_FORMATS.get(media.lower())
+            if fmt in audio_utils.OUTPUT_FORMATS and q > 0:
+                candidates.append((-q, i, fmt))
+        fmt = min(candidates)[2] if candidates else "wav"
+
+    if sample_rate not in audio_utils.OUTPUT_SAMPLE_RATES:
+        raise HTTPException(status_code=400, detail=f"Unsupported sample_rate: {sample_rate} "
+                            f"(supported: {', '.join(map(str, audio_utils.OUTPUT_SAMPLE_RATES))})")
+    if fmt == "opus" and sample_rate not in audio_utils.OPUS_SAMPLE_RATES:
+        raise HTTPException(status_code=400, detail=f"Opus does not support {sample_rate} Hz")
+    if is_stream and fmt not in audio_utils.STREAMABLE_FORMATS:
+        raise HTTPException(status_code=400, detail=f"{fmt} cannot be streamed "
+                            f"(use {' or '.join(audio_utils.STREAMABLE_FORMATS)})")
+    return fmt
+
+def _busy_response(e):
+    return HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+
 @app.post("/api/generate")
 async def api_generate(
+    request: Request,
     text: str = Form(...),
     ref_text: str = Form(...),
     model_version: str = Form("v1"),     
@@ -60,151 +343,281 @@ async def api_generate(
     speed: float = Form(1.0),
     step: int = Form(32),               
     cfg: float = Form(2.0),              
+    stream: str = Form("false"),
+    output_format: str = Form(""),
+    sample_rate: int = Form(24000),
     ref_audio: Optional[UploadFile] = File(None)
 ):
     is_use_norm = use_norm.lower() == 'true'
     is_auto_split = use_auto_split.lower() == 'true' 
-
-    # Prepare input text
-    if is_use_norm:
-        if not is_auto_split:
-            gen_text = text_utils.normalize_text(text)[0]
-        else:
-            gen_text = text
-    else:
-        gen_text = text
-
-    print(f"Generating ({model_version}): {gen_text[:50]}... (AutoSplit: {is_auto_split})")
-
-    # Handle Reference Audio
-    ref_audio_path = config.DEFAULT_REF_AUDIO_PATH
-    temp_audio_path = None
-    if ref_audio:
-        temp_audio_path = os.path.join(config.DATA_DIR, "temp", f"temp_{ref_audio.filename}")
-        with open(temp_audio_path, "wb") as buffer:
-            buffer.write(await ref_audio.read())
-        ref_audio_path = temp_audio_path
-
-    if not os.path.exists(ref_audio_path):
-         return HTTPException(status_code=400, detail="Reference audio file not found.")
-
-    # Get Ref Duration
+    is_stream = stream.lower() == 'true'
+    trace = observability.start_trace("generate")
     try:
-        data_ref, sr_ref = sf.read(ref_audio_path)
-        ref_duration_sec = len(data_ref) / sr_ref
-        print(f"✅ Ref Duration: {ref_duration_sec:.2f}s")
-    except Exception as e:
-        print(f"⚠️ Could not read ref duration: {e}")
-        ref_duration_sec = 5.0
+        fmt = _negotiate_format(output_format, request.headers.get("accept"), sample_rate, is_stream)
+    except HTTPException:
+        trace.finish("bad_request")
+        raise
+    media_type = audio_utils.OUTPUT_FORMATS[fmt][2]
 
-    model = tts_handler.get_tts_model(model_version)
+    # งาน blocking (decode reference, split/normalize, โหลดโมเดล, inference) ไม่รันบน event loop
+    try:
+        ref = await run_in_threadpool(_load_ref, ref_text, ref_audio.file if ref_audio else None)
+    except HTTPException:
+        trace.finish("bad_request")
+        raise
+    plan = await run_in_threadpool(_plan_text, text, ref, is_use_norm, is_auto_split)
+    decision = step_control.controller.decide(model_version, step, _planned_chars(plan),
+                                              tts_handler.scheduler.stats())
+    trace.set(model=model_version, auto_split=is_auto_split, stream=is_stream, step=decision.step,
+              requested_step=step, format=fmt, sample_rate=sample_rate)
+    model = await run_in_threadpool(tts_handler.get_tts_model, model_version)
     
     try:
         if model:
-            if is_auto_split:
-                # =========================================================
-                # 🔥 AUTO SPLIT & SHORT TEXT FIX LOGIC 🔥
-                # =========================================================
-                segments = text_utils.intelligent_split(gen_text)
-                audio_clips = []
-                print(f"✂️ Split into {len(segments)} segments")
-
-                for i, seg in enumerate(segments):
-                    # Normalize segment if needed
-                    seg_to_gen = text_utils.normalize_text(seg)[0] if is_use_norm else seg
-                    if not seg_to_gen.strip(): continue
-
-                    print(f"  [{i+1}/{len(segments)}] Generating: {seg_to_gen}")
-                    
-                    # Logic: Short Text
-                    is_short = len(seg_to_gen) < 15
-                    forced_dur = (ref_duration_sec + 2.0) if is_short else None
-                    if is_short: print(f"    ⚡ Short text -> Force Duration: {forced_dur:.2f}s")
-
-                    # Inference
-                    wav = model.infer(
-                        ref_audio=ref_audio_path,
-                        ref_text=ref_text,
-                        gen_text=seg_to_gen,
-                        step=step, speed=speed,
-                        cfg=cfg,
-                        fix_duration=forced_dur,
-                        max_chars=300 # เพิ่มตาม main.py
-                    )
-                    
-                    if isinstance(wav, tuple): wav = wav[0]
-                    if hasattr(wav, 'shape') and len(wav.shape) > 1: wav = wav.flatten()
-
-                    # Retry if silent
-                    if np.max(np.abs(wav)) < 0.01:
-                         print(f"    ❌ Silent output. Retrying with longer duration...")
-                         wav = model.infer(
-                            ref_audio=ref_audio_path, ref_text=ref_text, gen_text=seg_to_gen,
-                            step=step, speed=speed, cfg=cfg,
-                            fix_duration=ref_duration_sec + 6.0
-                        )
-                         if isinstance(wav, tuple): wav = wav[0]
-                         if hasattr(wav, 'shape') and len(wav.shape) > 1: wav = wav.flatten()
-
-                    # Post-Process is_short
-                    # if is_short:
-                    #     original_len = len(wav)
-                    #     wav = audio_utils.trim_silence_numpy(wav, threshold=0.005, padding=0.02)
-                    #     print(f"    ✂️ Trimmed: {original_len} -> {len(wav)} samples")
-
-                    # wav = audio_utils.apply_fade(wav, fade_duration=0.05)
-                    # audio_clips.append(wav)
-
-                    # Post-Process
-                    # 1. ย้ายออกมาข้างนอก เพื่อตัดเงียบทุกกรณี
-                    original_len = len(wav)
-                    wav = audio_utils.trim_silence_numpy(wav, threshold=0.005, padding=0.02)
-
-                    # 2. (Optional) อาจจะ Print เฉพาะตอนที่ตัดเยอะๆ หรือ Print ตลอดก็ได้
-                    if len(wav) < original_len:
-                        print(f"    ✂️ Trimmed: {original_len} -> {len(wav)} samples")
-
-                    # 3. ใส่ Fade ตามปกติ
-                    wav = audio_utils.apply_fade(wav, fade_duration=0.05)
-                    audio_clips.append(wav)
-
-
-                    # Insert Room Tone
-                    if i < len(segments) - 1:
-                        pause_dur = random.uniform(0.07, 0.14)
-                        room_tone = audio_utils.get_room_tone(ref_audio_path, duration=pause_dur)
-                        room_tone = audio_utils.apply_fade(room_tone, fade_duration=0.02)
-                        audio_clips.append(room_tone)
-                
-                if audio_clips:
-                    final_wav = np.concatenate(audio_clips)
-                else:
-                    raise Exception("No audio generated from segments")
-            else:
-                # --- Standard Logic ---
-                final_wav = model.infer(
-                    ref_audio=ref_audio_path, ref_text=ref_text, gen_text=gen_text,
-                    step=step, speed=speed, cfg=cfg
-                )
-                if isinstance(final_wav, tuple): final_wav = final_wav[0]
-                if hasattr(final_wav, 'shape') and len(final_wav.shape) > 1: final_wav = final_wav.flatten()
-                final_wav = audio_utils.apply_fade(final_wav, fade_duration=0.02)
-
-            # Return Streaming Response
-            buffer = io.BytesIO()
-            sf.write(buffer, final_wav, 24000, format='WAV')
-            buffer.seek(0)
-            
-            if temp_audio_path and os.path.exists(temp_audio_path): os.remove(temp_audio_path)
-            return StreamingResponse(buffer, media_type="audio/wav")
+            def segments(cancel_event):
+                return _generate_segments(plan, model, model_version, ref, is_auto_split,
+                                          speed, decision.step, cfg, stream=is_stream, cancel_event=cancel_event,
+                                          cfg_skip_chars=decision.cfg_skip_chars)
+
+            if is_stream:
+                # Streaming: ส่งทีละ Segment ที่ worker สังเคราะห์เสร็จ
+                chunks = tts_handler.scheduler.stream(
+                    lambda cancel_event: _stream_audio(
+                        _generate_clips(segments(cancel_event), ref, is_auto_split), fmt, sample_rate))
+                return StreamingResponse(chunks, media_type=media_type, headers=decision.headers())
+
+            audio_bytes = await tts_handler.scheduler.run(
+                lambda cancel_event: _render_audio(segments(cancel_event), ref, is_auto_split, fmt, sample_rate),
+                is_disconnected=request.is_disconnected
+            )
+            trace.finish()
+            return Response(content=audio_bytes, media_type=media_type, headers=decision.headers())
         else:
             raise Exception("TTS Model not initialized")
 
+    except tts_handler.QueueFullError as e:
+        trace.finish("busy")
+        raise _busy_response(e)
+    except asyncio.TimeoutError:
+        trace.finish("timeout")
+        raise HTTPException(status_code=504, detail="Generation timed out")
+    except tts_handler.InferenceCancelled:
+        logger.warning("Generation cancelled (client disconnected)")
+        trace.finish("cancelled")
+        return Response(status_code=499)
     except Exception as e:
-        if temp_audio_path and os.path.exists(temp_audio_path): os.remove(temp_audio_path)
-        print(f"Error: {e}")
+        logger.exception(f"Error: {e}")
+        trace.finish("error")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.websocket("/ws/generate")
+async def ws_generate(websocket: WebSocket):
+    """
+    WebSocket: ส่ง JSON พารามิเตอร์เดียวกับ /api/generate (ใช้ Reference ค่าเริ่มต้น)
+    ได้กลับ {"type": "start"} -> binary PCM16 ทีละ Segment -> {"type": "end"}
+    """
+    await websocket.accept()
+    trace = None
+    try:
+        params = await websocket.receive_json()
+        trace = observability.start_trace("ws_generate")
+        model_version = params.get("model_version", "v1")
+        ref = await run_in_threadpool(_load_ref, params.get("ref_text", ""))
+        model = await run_in_threadpool(tts_handler.get_tts_model, model_version)
+        if not model:
+            raise Exception("TTS Model not initialized")
+
+        is_auto_split = str(params.get("use_auto_split", "true")).lower() == 'true'
+        is_use_norm = str(params.get("use_norm", "true")).lower() == 'true'
+        step = int(params.get("step", 32))
+        plan = await run_in_threadpool(_plan_text, params["text"], ref, is_use_norm, is_auto_split)
+        decision = step_control.controller.decide(model_version, step, _planned_chars(plan),
+                                                  tts_handler.scheduler.stats())
+        trace.set(model=model_version, auto_split=is_auto_split, stream=True, step=decision.step,
+                  requested_step=step)
+
+        def clips(cancel_event):
+            return _generate_clips(_generate_segments(
+                plan, model, model_version, ref, is_auto_split,
+                float(params.get("speed", 1.0)), decision.step, float(params.get("cfg", 2.0)),
+                stream=True, cancel_event=cancel_event, cfg_skip_chars=decision.cfg_skip_chars
+            ), ref, is_auto_split)
+
+        chunks = tts_handler.scheduler.stream(clips)
+        await websocket.send_json({"type": "start", "sample_rate": 24000, "format": "pcm_s16le", "channels": 1,
+                                   "step": decision.step, "cfg_skip_chars": decision.cfg_skip_chars})
+        async for clip in chunks:
+            with observability.stage("encode"):
+                pcm = audio_utils.to_pcm16(clip)
+            trace.add(audio_sec=len(clip) / 24000)
+            await websocket.send_bytes(pcm)
+        await websocket.send_json({"type": "end"})
+        trace.finish()
+    except WebSocketDisconnect:
+        if trace: trace.finish("cancelled")
+        return
+    except tts_handler.QueueFullError as e:
+        if trace: trace.finish("busy")
+        await websocket.send_json({"type": "error", "detail": str(e), "retry_after": e.retry_after})
+    except Exception as e:
+        detail = e.detail if isinstance(e, HTTPException) else str(e)
+        logger.error(f"Error (ws): {detail}")
+        if trace: trace.finish("error")
+        await websocket.send_json({"type": "error", "detail": detail})
+    await websocket.close()
+
+# --- Metrics ---
+
+def _collect_runtime_metrics():
+    """
+    เติม Gauge/Counter จาก stats() ของ cache, model manager, scheduler และ quality gate (เรียกตอน scrape)
+    """
+    caches = {
+        "reference": tts_handler.reference_cache.stats(),
+        "normalize": text_utils._normalize_memo.stats(),
+    }
+    if tts_handler.segment_cache:
+        seg = tts_handler.segment_cache.stats()
+        caches["segment"] = {
+            "hits": seg["hits_memory"] + seg["hits_disk"], "misses": seg["misses"],
+            "hit_rate": seg["hit_rate"], "bytes": seg["memory_bytes"] + seg["disk_bytes"],
+        }
+    for name, s in caches.items():
+        observability.CACHE_HITS.set(s["hits"], cache=name)
+        observability.CACHE_MISSES.set(s["misses"], cache=name)
+        observability.CACHE_HIT_RATIO.set(s["hit_rate"], cache=name)
+        observability.CACHE_BYTES.set(s.get("bytes", 0), cache=name)
+
+    models = tts_handler.model_manager.stats()
+    for version, info in models["models"].items():
+        observability.MODEL_LOAD_SECONDS.set(info.get("load_sec", 0.0), version=version)
+        observability.MODEL_BYTES.set(info.get("ram_bytes", 0), version=version, device="cpu")
+        observability.MODEL_BYTES.set(info.get("vram_bytes", 0), version=version, device="cuda")
+        observability.MODEL_RESIDENT.set(1 if info["resident"] else 0, version=version)
+        observability.MODEL_LOADS.set(info["loads"], version=version)
+
+    observability.PROCESS_MAX_RSS.set(observability.peak_rss_bytes())
+    observability.READY.set(1 if warmup.state.ready else 0)
+
+    sched = tts_handler.scheduler.stats()
+    observability.QUEUE_DEPTH.set(sched["queue_depth"])
+    observability.INFER_RUNNING.set(sched["running"])
+    observability.INFER_REJECTED.set(sched["rejected"])
+    observability.INFER_TIMEOUTS.set(sched["timeouts"])
+
+    adaptive = step_control.controller.stats()
+    observability.STEPS_REDUCED.set(adaptive["reduced"])
+    observability.CFG_SKIPPED.set(adaptive["cfg_skipped"])
+
+    for model_version, classes in quality_gate.stats.stats().items():
+        for cls, s in classes.items():
+            observability.QUALITY_CHECKED.set(s["checked"], model=model_version, text_class=cls)
+            observability.QUALITY_FAILED.set(s["failed"], model=model_version, text_class=cls)
+            observability.QUALITY_RETRIED.set(s["retried"], model=model_version, text_class=cls)
+
+observability.add_collector(_collect_runtime_metrics)
+
+@app.get("/metrics")
+async def metrics():
+    return Response(content=observability.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.get("/ready")
+async def ready():
+    """
+    Readiness ของ worker นี้: 200 เมื่อโหลดโมเดล + warm-up เสร็จ, 503 ระหว่างนั้น
+    """
+    stats = warmup.state.stats()
+    return JSONResponse(stats, status_code=200 if stats["ready"] else 503)
+
+@app.get("/api/cache/stats")
+async def api_cache_stats():
+    seg_cache = tts_handler.segment_cache
+    return {
+        "reference": tts_handler.reference_cache.stats(),
+        "segment": seg_cache.stats() if seg_cache else None,
+    }
+
+@app.get("/api/models/stats")
+async def api_model_stats():
+    return tts_handler.model_manager.stats()
+
+@app.get("/api/quality/stats")
+async def api_quality_stats():
+    return quality_gate.stats.stats()
+
+@app.get("/api/scheduler/stats")
+async def api_scheduler_stats():
+    stats = tts_handler.scheduler.stats()
+    if tts_handler.coalescer:
+        stats["coalescer"] = tts_handler.coalescer.stats()
+    stats["adaptive"] = step_control.controller.stats()
+    return stats
+
+# --- Batch Jobs ---
+
+UPLOAD_COPY_CHUNK = 1 << 20
+
+def _write_upload(file_path, upload_file):
+    """
+    คัดลอก upload (spooled file) ลงดิสก์ทีละ chunk ไม่อ่านทั้งไฟล์เข้าหน่วยความจำ
+    """
+    tmp_path = file_path + ".part"
+    with open(tmp_path, "wb") as buffer:
+        shutil.copyfileobj(upload_file, buffer, UPLOAD_COPY_CHUNK)
+    os.replace(tmp_path, file_path)
+
+def _start_job(input_path, out_dir, workers, job_id):
+    # workers=0 ผ่าน scheduler ของ server; workers>0 ไม่เกิน BATCH_JOB_WORKERS process ต่อ Job
+    workers = max(0, min(workers, config.BATCH_JOB_WORKERS))
+    try:
+        return batch_jobs.start_job(input_path, out_dir, workers=workers, job_id=job_id)
+    except batch_jobs.JobLimitError as e:
+        raise HTTPException(status_code=429, detail=str(e))
+
+@app.post("/api/jobs")
+async def api_create_job(
+    requests_file: UploadFile = File(...),
+    workers: int = Form(0)
+):
+    """
+    รับไฟล์ JSONL แล้วเริ่ม Batch Job ใน background (workers=0 ใช้โมเดลที่โหลดไว้ใน server ร่วมกัน)
+    """
+    if batch_jobs.active_jobs() >= config.BATCH_MAX_JOBS:
+        raise HTTPException(status_code=429, detail=f"Too many batch jobs running (max {config.BATCH_MAX_JOBS})")
+    job_id = uuid.uuid4().hex[:12]
+    out_dir = os.path.join(config.BATCH_JOBS_DIR, job_id)
+    input_path = os.path.join(out_dir, batch_jobs.REQUESTS_NAME)
+    os.makedirs(out_dir, exist_ok=True)
+    await run_in_threadpool(_write_upload, input_path, requests_file.file)
+    try:
+        job = _start_job(input_path, out_dir, workers, job_id)
+    except HTTPException:
+        shutil.rmtree(out_dir, ignore_errors=True)
+        raise
+    return job.stats()
+
+@app.get("/api/jobs/{job_id}")
+async def api_job_status(job_id: str):
+    job = batch_jobs.jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job.stats()
+
+@app.post("/api/jobs/{job_id}/resume")
+async def api_resume_job(job_id: str, workers: int = Form(0)):
+    """
+    รัน Job เดิมต่อจาก manifest (เช่นหลัง server restart)
+    """
+    job = batch_jobs.jobs.get(job_id)
+    if job is not None and job.status in ("queued", "running"):
+        raise HTTPException(status_code=409, detail="Job is still running")
+    out_dir = os.path.join(config.BATCH_JOBS_DIR, os.path.basename(job_id))
+    input_path = os.path.join(out_dir, batch_jobs.REQUESTS_NAME)
+    if not os.path.exists(input_path):
+        raise HTTPException(status_code=404, detail="Job not found")
+    job = _start_job(input_path, out_dir, workers, job_id)
+    return job.stats()
+
 @app.post("/api/save_result")
 async def api_save_result(
     text: str = Form(...),
@@ -222,33 +635,51 @@ async def api_save_result(
         filename = f"{timestamp}_{utterance_id}.wav"
         file_path = os.path.join(config.RESULTS_AUDIO_DIR, filename)
 
-        with open(file_path, "wb") as buffer:
-            buffer.write(await audio.read())
-
-        file_exists = os.path.isfile(config.RESULTS_CSV_PATH)
-        with open(config.RESULTS_CSV_PATH, mode='a', newline='', encoding='utf-8') as csv_file:
-            fieldnames = ['timestamp', 'text', 'model', 'speed', 'step', 'cfg', 'gen_time', 'filename']
-            writer = csv.DictWriter(csv_file, fieldnames=fieldnames)
-            if not file_exists:
-                writer.writeheader()
-            writer.writerow({
-                'timestamp': timestamp,
-                'text': text,
-                'model': model_version,
-                'speed': speed,
-                'step': step,
-                'cfg': cfg,
-                'gen_time': f"{gen_time:.2f}",
-                'filename': filename
-            })
-
-        print(f"✅ Saved result: {filename}")
-        return {"status": "success", "filename": filename}
+        row = {
+            'timestamp': timestamp,
+            'text': text,
+            'model': model_version,
+            'speed': speed,
+            'step': step,
+            'cfg': cfg,
+            'gen_time': gen_time,
+            'filename': filename
+        }
+        await run_in_threadpool(_write_upload, file_path, audio.file)
+        # รอจน commit (แถวที่บันทึกพร้อมกันถูกเขียนใน transaction เดียว)
+        result_id = await asyncio.wrap_future(results_store.store.add(row))
+
+        logger.info(f"Saved result: {filename}")
+        return {"status": "success", "filename": filename, "id": result_id}
     
     except Exception as e:
-        print(f"❌ Error saving result: {e}")
+        logger.exception(f"Error saving result: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/api/results")
+async def api_results(
+    model: Optional[str] = None,
+    since: Optional[str] = None,
+    until: Optional[str] = None,
+    text: Optional[str] = None,
+    text_prefix: Optional[str] = None,
+    contains: Optional[str] = None,
+    cursor: Optional[int] = None,
+    limit: int = 50
+):
+    """
+    รายการผลที่บันทึกไว้ (ล่าสุดก่อน) กรองตาม model / ช่วงเวลา / ข้อความ แบ่งหน้าด้วย next_cursor
+    """
+    if not 1 <= limit <= 500:
+        raise HTTPException(status_code=400, detail="limit must be between 1 and 500")
+    return await run_in_threadpool(
+        results_store.store.query, model=model, since=since, until=until, text=text,
+        text_prefix=text_prefix, contains=contains, before_id=cursor, limit=limit)
+
+@app.get("/api/results/stats")
+async def api_results_stats():
+    return await run_in_threadpool(results_store.store.stats)
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run("main:app", host=config.HOST, port=config.PORT, reload=config.RELOAD)
\ No newline at end of file
@@ -0,0 +1,306 @@
+# observability.py
+"""
+Logging + Metrics + Trace ต่อ request
+- setup_logging(): log แบบมีโครงสร้าง (text หรือ json ตาม LOG_FORMAT) ทุกบรรทัดมี request_id
+- Counter / Gauge / Histogram แบบเบา ๆ แล้ว render() เป็น Prometheus text format สำหรับ /metrics
+- Trace: เก็บเวลาแต่ละขั้น (stage) ของ request เดียว แล้ว log สรุป 1 บรรทัด + ส่งเข้า histogram ตอน finish()
+"""
+import json
+import logging
+import math
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+import config
+
+request_id = ContextVar("request_id", default="-")
+_current_trace = ContextVar("trace", default=None)
+
+logger = logging.getLogger(__name__)
+
+# --- Logging ---
+
+class _RequestIdFilter(logging.Filter):
+    def filter(self, record):
+        record.request_id = request_id.get()
+        return True
+
+class _TextFormatter(logging.Formatter):
+    def format(self, record):
+        line = super().format(record)
+        fields = getattr(record, "fields", None)
+        if fields:
+            line += " " + " ".join(f"{k}={v}" for k, v in fields.items())
+        return line
+
+class _JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "request_id": record.request_id,
+            "msg": record.getMessage(),
+        }
+        entry.update(getattr(record, "fields", None) or {})
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+def setup_logging(level=None, fmt=None):
+    """
+    ตั้งค่า root logger ครั้งเดียว (เรียกซ้ำได้ จะแทน handler เดิมของเรา)
+    """
+    level = level or config.LOG_LEVEL
+    fmt = fmt or config.LOG_FORMAT
+    handler = logging.StreamHandler()
+    handler.addFilter(_RequestIdFilter())
+    if fmt == "json":
+        handler.setFormatter(_JsonFormatter())
+    else:
+        handler.setFormatter(_TextFormatter("%(asctime)s %(levelname)s %(name)s [%(request_id)s] %(message)s"))
+    handler._tts_handler = True
+
+    root = logging.getLogger()
+    root.handlers = [h for h in root.handlers if not getattr(h, "_tts_handler", False)]
+    root.addHandler(handler)
+    root.setLevel(level.upper())
+
+# --- Metrics ---
+
+_registry = []
+_collectors = []
+_registry_lock = threading.Lock()
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values)) + (extra or [])
+    if not pairs: return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+def _format_value(value):
+    if value == math.inf: return "+Inf"
+    return repr(float(value))
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        with _registry_lock:
+            _registry.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(n, "")) for n in self.label_names)
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, key, None, value) for key, value in self._values.items()]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for name, key, extra, value in self.samples():
+            lines.append(f"{name}{_format_labels(self.label_names, key, extra)} {_format_value(value)}")
+        return lines
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+class Histogram(_Metric):
+    kind = "histogram"
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key) or ([0] * len(self.buckets), 0.0)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            self._values[key] = (counts, total + value)
+
+    def samples(self):
+        out = []
+        with self._lock:
+            for key, (counts, total) in self._values.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets, counts):
+                    cumulative += count
+                    out.append((f"{self.name}_bucket", key, [("le", _format_value(bound))], cumulative))
+                out.append((f"{self.name}_sum", key, None, total))
+                out.append((f"{self.name}_count", key, None, cumulative))
+        return out
+
+def peak_rss_bytes():
+    """
+    Peak RSS ของโปรเซสนี้ (0 ถ้าระบบไม่มีโมดูล resource เช่น Windows)
+    """
+    try:
+        import resource
+    except ImportError:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux รายงานเป็น KB, macOS เป็น bytes
+    return peak if sys.platform == "darwin" else peak * 1024
+
+def add_collector(fn):
+    """
+    fn() ถูกเรียกก่อน render ทุกครั้ง ใช้ดึงค่าจาก stats() ของส่วนอื่นมาใส่ Gauge
+    """
+    _collectors.append(fn)
+
+def render():
+    for fn in list(_collectors):
+        try:
+            fn()
+        except Exception:
+            logger.exception("Metrics collector failed")
+    with _registry_lock:
+        metrics = list(_registry)
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+STAGE_SECONDS = Histogram("tts_stage_seconds", "Time spent per pipeline stage per request",
+                          ["stage"])
+REQUEST_SECONDS = Histogram("tts_request_seconds", "Wall time per request", ["endpoint"])
+REQUESTS = Counter("tts_requests_total", "Requests by endpoint and outcome", ["endpoint", "status"])
+REQUEST_SEGMENTS = Histogram("tts_request_segments", "Segments synthesized per request",
+                             buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256))
+REQUEST_CHARS = Histogram("tts_request_chars", "Characters synthesized per request",
+                          buckets=(10, 25, 50, 100, 250, 500, 1000, 2500, 5000))
+REQUEST_RTF = Histogram("tts_request_rtf", "Real-time factor per request (audio seconds / wall seconds)",
+                        buckets=(0.25, 0.5, 1, 2, 5, 10, 20, 50, 100))
+AUDIO_SECONDS = Counter("tts_audio_seconds_total", "Seconds of audio returned")
+QUEUE_WAIT_SECONDS = Histogram("tts_queue_wait_seconds", "Time a job waited for an inference worker")
+PROCESS_MAX_RSS = Gauge("tts_process_max_rss_bytes", "Peak resident set size of the server process")
+READY = Gauge("tts_ready", "1 once model loading and warm-up have finished in this process")
+
+# ค่าด้านล่างถูกเติมจาก stats() ของแต่ละส่วนตอน scrape (ดู add_collector ใน main.py)
+CACHE_HITS = Counter("tts_cache_hits_total", "Cache hits", ["cache"])
+CACHE_MISSES = Counter("tts_cache_misses_total", "Cache misses", ["cache"])
+CACHE_HIT_RATIO = Gauge("tts_cache_hit_ratio", "Cache hit ratio since start", ["cache"])
+CACHE_BYTES = Gauge("tts_cache_bytes", "Bytes held by a cache", ["cache"])
+MODEL_LOAD_SECONDS = Gauge("tts_model_load_seconds", "Duration of the last load of a model", ["version"])
+MODEL_BYTES = Gauge("tts_model_bytes", "Measured model footprint", ["version", "device"])
+MODEL_RESIDENT = Gauge("tts_model_resident", "1 if the model is loaded", ["version"])
+MODEL_LOADS = Counter("tts_model_loads_total", "Model loads", ["version"])
+QUEUE_DEPTH = Gauge("tts_queue_depth", "Jobs waiting for an inference worker")
+INFER_RUNNING = Gauge("tts_inference_running", "Jobs running on inference workers")
+INFER_REJECTED = Counter("tts_inference_rejected_total", "Jobs rejected because the queue was full")
+INFER_TIMEOUTS = Counter("tts_inference_timeouts_total", "Jobs that exceeded INFER_TIMEOUT")
+STEPS_REDUCED = Counter("tts_steps_reduced_total", "Requests whose step was lowered to meet LATENCY_SLO_SEC")
+CFG_SKIPPED = Counter("tts_cfg_skipped_total", "Requests whose short segments ran without CFG")
+QUALITY_CHECKED = Counter("tts_quality_checked_total", "Segments checked by the quality gate", ["model", "text_class"])
+QUALITY_FAILED = Counter("tts_quality_failed_total", "Segments that failed the quality gate", ["model", "text_class"])
+QUALITY_RETRIED = Counter("tts_quality_retried_total", "Segments retried", ["model", "text_class"])
+
+# --- Trace ---
+
+class Trace:
+    """
+    เวลาแต่ละขั้นของ request เดียว (ใช้ร่วมกันข้าม thread ผ่าน contextvars ที่ copy ไปยัง worker)
+    """
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.request_id = request_id.get()
+        self.started = time.perf_counter()
+        self.stages = {}
+        self.fields = {}
+        self.finished = False
+        self._lock = threading.Lock()
+
+    def add_stage(self, name, seconds):
+        with self._lock:
+            self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def set(self, **fields):
+        with self._lock:
+            self.fields.update(fields)
+
+    def add(self, **counts):
+        with self._lock:
+            for k, v in counts.items():
+                self.fields[k] = self.fields.get(k, 0) + v
+
+    def finish(self, status="ok"):
+        with self._lock:
+            if self.finished: return
+            self.finished = True
+            stages = dict(self.stages)
+            fields = dict(self.fields)
+        wall = time.perf_counter() - self.started
+
+        REQUESTS.inc(endpoint=self.endpoint, status=status)
+        REQUEST_SECONDS.observe(wall, endpoint=self.endpoint)
+        for name, seconds in stages.items():
+            STAGE_SECONDS.observe(seconds, stage=name)
+        if "segments" in fields: REQUEST_SEGMENTS.observe(fields["segments"])
+        if "chars" in fields: REQUEST_CHARS.observe(fields["chars"])
+        audio_sec = fields.get("audio_sec", 0.0)
+        if audio_sec > 0:
+            AUDIO_SECONDS.inc(audio_sec)
+            if wall > 0:
+                fields["rtf"] = round(audio_sec / wall, 3)
+                REQUEST_RTF.observe(audio_sec / wall)
+
+        summary = {"endpoint": self.endpoint, "status": status, "wall_ms": round(wall * 1000, 1)}
+        summary.update({f"{name}_ms": round(sec * 1000, 1) for name, sec in stages.items()})
+        summary.update({k: round(v, 3) if isinstance(v, float) else v for k, v in fields.items()})
+        logger.info("request finished", extra={"fields": summary})
+
+def start_trace(endpoint):
+    trace = Trace(endpoint)
+    _current_trace.set(trace)
+    return trace
+
+def current_trace():
+    return _current_trace.get()
+
+@contextmanager
+def stage(name):
+    """
+    จับเวลาขั้น name: ถ้าอยู่ใน request จะสะสมใน Trace (ส่งเข้า histogram ตอน finish)
+    ถ้าไม่อยู่ (เช่น batch job) ส่งเข้า histogram ทันที
+    """
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - t0
+        trace = _current_trace.get()
+        if trace is not None and not trace.finished:
+            trace.add_stage(name, seconds)
+        else:
+            STAGE_SECONDS.observe(seconds, stage=name)
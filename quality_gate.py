@@ -0,0 +1,118 @@
+# quality_gate.py
+"""
+Quality Gate ของเสียงที่สังเคราะห์ (Auto Split)
+- ตรวจ Segment ที่เงียบ/เสียหายด้วย RMS บนสัญญาณที่ decimate แล้ว (อ่านแค่ 1/QUALITY_DECIMATE ของ sample)
+- ทำนาย fix_duration ที่เหมาะกว่าจากความยาวข้อความ + อัตราการพูดของ Reference
+- เก็บสถิติ fail/retry แยกตาม model version และประเภทข้อความ ใช้ตัดสินว่าควรยิง retry ล่วงหน้า (speculative) หรือไม่
+"""
+import math
+import threading
+import numpy as np
+
+import config
+
+CLIP_LEVEL = 0.999       # |x| ที่นับว่าเป็น sample ที่ clip
+MAX_CLIPPED_RATIO = 0.2  # สัดส่วน sample ที่ clip เกินนี้ถือว่าเสียหาย
+MIN_SPEC_SAMPLES = 20    # ต้องเห็นข้อความประเภทนี้อย่างน้อยเท่านี้ก่อนจะเริ่ม speculate
+
+def text_class(text):
+    """
+    ประเภทข้อความสำหรับแยกสถิติ (short ตรงกับเกณฑ์ Force Duration ใน tts_handler.plan_segments)
+    """
+    n = len(text)
+    if n < 15: return "short"
+    if n < 50: return "medium"
+    return "long"
+
+def segment_rms(wav, decimate=None):
+    decimate = decimate or config.QUALITY_DECIMATE
+    x = np.asarray(wav)[::decimate]
+    if len(x) == 0: return 0.0
+    return math.sqrt(float(np.dot(x, x)) / len(x))
+
+def check_segment(wav):
+    """
+    คืนเหตุผลถ้าเสียงใช้ไม่ได้ ("empty" / "non_finite" / "silent" / "clipped") หรือ None ถ้าผ่าน
+    """
+    if len(wav) == 0: return "empty"
+    rms = segment_rms(wav)
+    if not math.isfinite(rms): return "non_finite"
+    if rms < config.QUALITY_SILENCE_RMS: return "silent"
+    x = np.asarray(wav)[::config.QUALITY_DECIMATE]
+    if np.count_nonzero(np.abs(x) >= CLIP_LEVEL) > MAX_CLIPPED_RATIO * len(x): return "clipped"
+    return None
+
+def speaking_rate(ref):
+    """
+    ตัวอักษร (ไม่นับช่องว่าง) ต่อวินาทีของ Reference; ใช้ค่า default ถ้า ref_text ไม่สมเหตุสมผล
+    """
+    n_chars = len("".join(ref.ref_text.split()))
+    if ref.duration > 0 and n_chars:
+        rate = n_chars / ref.duration
+        if config.QUALITY_MIN_CHARS_PER_SEC <= rate <= config.QUALITY_MAX_CHARS_PER_SEC:
+            return rate
+    return config.QUALITY_DEFAULT_CHARS_PER_SEC
+
+def predict_duration(text, ref, speed=1.0):
+    """
+    fix_duration (วินาที รวมความยาว Reference แบบเดียวกับ F5) ที่คาดว่าพอสำหรับ text
+    """
+    n_chars = len("".join(text.split()))
+    gen_sec = n_chars / speaking_rate(ref) / max(speed, 0.1)
+    return ref.duration + max(gen_sec * config.QUALITY_DURATION_MARGIN, 0.5)
+
+class QualityStats:
+    """
+    สถิติต่อ (model version, text class): ตรวจกี่ครั้ง, fail เพราะอะไร, retry/กู้คืนได้กี่ครั้ง, speculative ได้ใช้กี่ครั้ง
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def _entry(self, model_version, cls):
+        return self._stats.setdefault(model_version, {}).setdefault(cls, {
+            "checked": 0, "failed": 0, "reasons": {}, "retried": 0, "recovered": 0,
+            "speculated": 0, "speculative_used": 0,
+        })
+
+    def record_check(self, model_version, cls, reason):
+        with self._lock:
+            entry = self._entry(model_version, cls)
+            entry["checked"] += 1
+            if reason:
+                entry["failed"] += 1
+                entry["reasons"][reason] = entry["reasons"].get(reason, 0) + 1
+
+    def record(self, model_version, cls, field):
+        with self._lock:
+            self._entry(model_version, cls)[field] += 1
+
+    def should_speculate(self, model_version, cls):
+        """
+        ยิง candidate สำรองพร้อมรอบแรกเมื่ออัตรา fail ของประเภทนี้สูงกว่า QUALITY_SPECULATE_RATE
+        """
+        if config.QUALITY_SPECULATE_RATE <= 0: return False
+        with self._lock:
+            entry = self._stats.get(model_version, {}).get(cls)
+            if not entry or entry["checked"] < MIN_SPEC_SAMPLES: return False
+            return entry["failed"] / entry["checked"] >= config.QUALITY_SPECULATE_RATE
+
+    def clear(self):
+        with self._lock:
+            self._stats.clear()
+
+    def stats(self):
+        with self._lock:
+            result = {}
+            for model_version, classes in self._stats.items():
+                result[model_version] = {}
+                for cls, entry in classes.items():
+                    checked = entry["checked"]
+                    result[model_version][cls] = dict(
+                        entry, reasons=dict(entry["reasons"]),
+                        failure_rate=(entry["failed"] / checked) if checked else 0.0,
+                        retry_rate=(entry["retried"] / checked) if checked else 0.0,
+                    )
+            return result
+
+stats = QualityStats()
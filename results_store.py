@@ -0,0 +1,260 @@
+# results_store.py
+"""
+ที่เก็บผลการสังเคราะห์ (/api/save_result) แทน results.csv
+- SQLite โหมด WAL: เขียนต่อท้าย, อ่านพร้อมกันได้ระหว่างเขียน
+- การเขียนผ่าน writer thread เดียว รวมหลายแถวที่มาพร้อมกันเป็น transaction เดียว (group commit)
+- index ตาม model, timestamp และ text สำหรับ query/แบ่งหน้า
+- ย้ายข้อมูลจาก results.csv เดิมครั้งเดียวตอนเปิด (ไฟล์เดิมถูกเปลี่ยนชื่อเป็น .migrated)
+
+timestamp เก็บรูปแบบเดียวกับชื่อไฟล์เสียง (YYYYmmdd_HHMMSS) จึงเรียงตามตัวอักษร = เรียงตามเวลา
+
+Usage:
+    python results_store.py migrate [path/to/results.csv]
+"""
+import argparse
+import csv
+import logging
+import os
+import queue
+import sqlite3
+import threading
+from concurrent.futures import Future
+
+import config
+
+logger = logging.getLogger(__name__)
+
+COLUMNS = ("timestamp", "text", "model", "speed", "step", "cfg", "gen_time", "filename")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    id INTEGER PRIMARY KEY,
+    timestamp TEXT NOT NULL,
+    text TEXT NOT NULL,
+    model TEXT NOT NULL,
+    speed REAL,
+    step INTEGER,
+    cfg REAL,
+    gen_time REAL,
+    filename TEXT NOT NULL UNIQUE
+);
+CREATE INDEX IF NOT EXISTS idx_results_model ON results (model);
+CREATE INDEX IF NOT EXISTS idx_results_ts ON results (timestamp);
+CREATE INDEX IF NOT EXISTS idx_results_text ON results (text);
+"""
+
+_INSERT = (f"INSERT OR IGNORE INTO results ({', '.join(COLUMNS)}) "
+           f"VALUES ({', '.join('?' * len(COLUMNS))})")
+
+def normalize_timestamp(value):
+    """
+    รับ YYYYmmdd_HHMMSS, ISO (2024-12-18T10:30:00) หรือแค่วันที่ -> รูปแบบที่เก็บ (ตัดส่วนที่ไม่ได้ระบุทิ้ง)
+    """
+    value = value.strip().replace("-", "").replace(":", "").replace("T", "_").replace(" ", "_")
+    return value[:15]
+
+def _row_values(row):
+    gen_time = row.get("gen_time")
+    return (
+        str(row["timestamp"]), str(row["text"]), str(row["model"]),
+        float(row["speed"]) if row.get("speed") not in (None, "") else None,
+        int(float(row["step"])) if row.get("step") not in (None, "") else None,
+        float(row["cfg"]) if row.get("cfg") not in (None, "") else None,
+        round(float(gen_time), 2) if gen_time not in (None, "") else None,
+        str(row["filename"]),
+    )
+
+class ResultsStore:
+    """
+    writer thread เดียวถือ connection สำหรับเขียน; add() คืน Future ที่เสร็จเมื่อ commit แล้ว
+    การอ่านใช้ connection แยกต่อ thread (WAL ให้อ่านได้โดยไม่ต้องรอ writer)
+    """
+    def __init__(self, db_path, batch_size=64, flush_ms=20):
+        self.db_path = db_path
+        self.batch_size = batch_size
+        self.flush_sec = flush_ms / 1000
+        self.commits = 0
+        self.rows_written = 0
+        self._queue = queue.Queue()
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._thread = None
+
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        conn = self._connect()
+        conn.executescript(_SCHEMA)
+        conn.close()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        # WAL + NORMAL: ไม่เสียข้อมูลเมื่อโปรเซสตาย (อาจเสีย commit ล่าสุดถ้าไฟดับ)
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    # --- Write ---
+
+    def _ensure_writer(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._writer, name="results-writer", daemon=True)
+                self._thread.start()
+
+    def add(self, row):
+        """
+        เพิ่มแถว (dict ตาม COLUMNS) -> Future ที่ได้ค่า id ของแถวเมื่อ commit แล้ว
+        """
+        future = Future()
+        self._queue.put((_row_values(row), future))
+        self._ensure_writer()
+        return future
+
+    def _writer(self):
+        conn = self._connect()
+        try:
+            while True:
+                item = self._queue.get()
+                if item is None: return
+                batch = [item]
+                # รอแถวอื่นที่มาพร้อมกันไม่เกิน flush_sec แล้ว commit ครั้งเดียว
+                try:
+                    while len(batch) < self.batch_size:
+                        item = self._queue.get(timeout=self.flush_sec)
+                        if item is None:
+                            self._commit(conn, batch)
+                            return
+                        batch.append(item)
+                except queue.Empty:
+                    pass
+                self._commit(conn, batch)
+        finally:
+            conn.close()
+
+    def _commit(self, conn, batch):
+        try:
+            ids = []
+            with conn:
+                for values, _ in batch:
+                    cur = conn.execute(_INSERT, values)
+                    ids.append(cur.lastrowid if cur.rowcount else None)
+            self.commits += 1
+            self.rows_written += len(batch)
+            for (_, future), row_id in zip(batch, ids):
+                future.set_result(row_id)
+        except Exception as e:
+            logger.exception(f"Results commit failed ({len(batch)} rows)")
+            for _, future in batch:
+                future.set_exception(e)
+
+    def close(self):
+        """
+        เขียนแถวที่ค้างในคิวให้เสร็จแล้วหยุด writer thread
+        """
+        with self._lock:
+            thread = self._thread
+        if thread is not None and thread.is_alive():
+            self._queue.put(None)
+            thread.join()
+
+    # --- Read ---
+
+    def _reader(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+        return conn
+
+    def query(self, model=None, since=None, until=None, text=None, text_prefix=None, contains=None,
+              before_id=None, limit=50):
+        """
+        ผลล่าสุดก่อน (id มากไปน้อย) แบ่งหน้าแบบ keyset: ส่ง next_cursor ที่ได้กลับมาเป็น before_id
+        since/until เทียบกับ timestamp (until ไม่รวมค่าที่ระบุ), text = ตรงทั้งข้อความ, contains = มีคำนี้ (scan)
+        """
+        where, params = [], []
+        if model:
+            where.append("model = ?"); params.append(model)
+        if since:
+            where.append("timestamp >= ?"); params.append(normalize_timestamp(since))
+        if until:
+            where.append("timestamp < ?"); params.append(normalize_timestamp(until))
+        if text:
+            where.append("text = ?"); params.append(text)
+        if text_prefix:
+            # ช่วงแทน LIKE เพื่อให้ใช้ idx_results_text ได้
+            where.append("text >= ? AND text < ?"); params += [text_prefix, text_prefix + "\U0010ffff"]
+        if contains:
+            where.append("instr(text, ?) > 0"); params.append(contains)
+        if before_id:
+            where.append("id < ?"); params.append(int(before_id))
+
+        sql = f"SELECT id, {', '.join(COLUMNS)} FROM results"
+        if where: sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY id DESC LIMIT ?"
+        rows = [dict(r) for r in self._reader().execute(sql, params + [limit + 1])]
+
+        next_cursor = rows[limit - 1]["id"] if len(rows) > limit else None
+        return {"results": rows[:limit], "next_cursor": next_cursor}
+
+    def stats(self):
+        conn = self._reader()
+        total = conn.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+        models = {r["model"]: r["n"] for r in conn.execute(
+            "SELECT model, COUNT(*) AS n FROM results GROUP BY model")}
+        return {
+            "rows": total,
+            "models": models,
+            "pending": self._queue.qsize(),
+            "commits": self.commits,
+            "rows_written": self.rows_written,
+            "avg_rows_per_commit": (self.rows_written / self.commits) if self.commits else 0.0,
+        }
+
+    # --- Migration ---
+
+    def migrate_csv(self, csv_path):
+        """
+        นำเข้า results.csv เดิมครั้งเดียว (transaction เดียว, แถวที่ filename ซ้ำถูกข้าม)
+        แล้วเปลี่ยนชื่อไฟล์เป็น .migrated เพื่อไม่ให้นำเข้าซ้ำ คืนจำนวนแถวที่นำเข้า
+        """
+        if not csv_path or not os.path.isfile(csv_path):
+            return 0
+        with open(csv_path, newline="", encoding="utf-8") as f:
+            rows = []
+            for line_no, row in enumerate(csv.DictReader(f), start=2):
+                try:
+                    rows.append(_row_values(row))
+                except (KeyError, TypeError, ValueError) as e:
+                    logger.warning(f"Skipping results.csv line {line_no}: {e}")
+
+        conn = self._connect()
+        try:
+            with conn:
+                before = conn.total_changes
+                conn.executemany(_INSERT, rows)
+                imported = conn.total_changes - before
+        finally:
+            conn.close()
+        os.replace(csv_path, csv_path + ".migrated")
+        logger.info(f"Migrated {csv_path}", extra={"fields": {"rows": len(rows), "imported": imported}})
+        return imported
+
+store = ResultsStore(config.RESULTS_DB_PATH, batch_size=config.RESULTS_BATCH_SIZE,
+                     flush_ms=config.RESULTS_FLUSH_MS)
+
+def main():
+    import observability
+
+    observability.setup_logging()
+    parser = argparse.ArgumentParser(description="Results store maintenance")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p = sub.add_parser("migrate", help="import a results.csv into the SQLite store")
+    p.add_argument("csv", nargs="?", default=config.RESULTS_CSV_PATH)
+    args = parser.parse_args()
+
+    if args.command == "migrate":
+        imported = store.migrate_csv(args.csv)
+        print(f"Imported {imported} rows into {store.db_path}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+# serve.py
+"""
+Production launcher: gunicorn + uvicorn worker หลาย process บนเครื่องเดียว
+- master โหลด tokenizer + โมเดล (CPU) ครั้งเดียวก่อน fork -> ทุก worker ใช้ weights ชุดเดียวกันแบบ copy-on-write
+  (gc.freeze กันไม่ให้ GC ของ worker ไปแตะ object ที่โหลดไว้จนหน้า memory ถูก copy)
+- จำกัด thread ของ torch/BLAS ต่อ worker ให้รวมกันพอดีจำนวน core (WORKER_THREADS)
+- worker แต่ละตัว warm-up เอง แล้ว GET /ready จึงตอบ 200
+ถ้ามี CUDA จะไม่โหลดโมเดลใน master (CUDA ใช้ข้าม fork ไม่ได้) แต่ละ worker โหลดของตัวเองบน GPU
+
+Usage:
+    python serve.py --workers 4
+    python serve.py --workers 4 --threads 2 --bind 0.0.0.0:8000
+"""
+import argparse
+import gc
+import os
+
+import config
+
+def _cpu_count():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+def _pin_threads_env(threads):
+    # ต้องตั้งก่อน import numpy/torch (BLAS/OpenMP อ่านค่าตอนโหลด library)
+    for var in ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS", "NUMEXPR_NUM_THREADS"):
+        os.environ.setdefault(var, str(threads))
+    # ตรวจ CUDA ผ่าน NVML ไม่ initialize CUDA ใน master (ไม่งั้น worker ที่ fork ออกไปใช้ CUDA ไม่ได้)
+    os.environ.setdefault("PYTORCH_NVML_BASED_CUDA_CHECK", "1")
+
+def _preload(logger):
+    """
+    งานที่ทำครั้งเดียวใน master ก่อน fork: tokenizer, ย้าย results.csv และโมเดลตาม MODEL_PREWARM
+    """
+    import torch
+    import text_utils
+    import tts_handler
+    import results_store
+
+    text_utils.setup_tokenizer()
+    results_store.store.migrate_csv(config.RESULTS_CSV_PATH)
+    if not config.PRELOAD_MODELS:
+        return
+    if torch.cuda.is_available():
+        logger.info("CUDA available: each worker loads its own models")
+        return
+    for version in config.MODEL_PREWARM:
+        tts_handler.model_manager.get(version)
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the TTS server with multiple worker processes")
+    parser.add_argument("--workers", type=int, default=config.WORKERS)
+    parser.add_argument("--threads", type=int, default=config.WORKER_THREADS,
+                        help="torch/BLAS threads per worker (0 = CPU cores / workers)")
+    parser.add_argument("--bind", default=f"{config.HOST}:{config.PORT}")
+    args = parser.parse_args()
+    threads = args.threads or max(1, _cpu_count() // max(1, args.workers))
+    _pin_threads_env(threads)
+
+    import logging
+    from gunicorn.app.base import BaseApplication
+    import main as server
+    import tts_handler
+
+    logger = logging.getLogger("serve")
+    tts_handler.limit_threads(threads)
+    _preload(logger)
+    # object ที่โหลดแล้วย้ายไป generation ถาวร: GC ใน worker จะไม่เขียน header ของมัน (ไม่ทำลาย copy-on-write)
+    gc.freeze()
+
+    class Server(BaseApplication):
+        def load_config(self):
+            self.cfg.set("bind", args.bind)
+            self.cfg.set("workers", args.workers)
+            self.cfg.set("worker_class", "uvicorn.workers.UvicornWorker")
+            self.cfg.set("preload_app", True)
+            self.cfg.set("post_fork", lambda arbiter, worker: tts_handler.limit_threads(threads))
+
+        def load(self):
+            return server.app
+
+    logger.info(f"Starting {args.workers} workers on {args.bind}", extra={"fields": {"threads_per_worker": threads}})
+    Server().run()
+
+if __name__ == "__main__":
+    main()
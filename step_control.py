@@ -0,0 +1,163 @@
+# step_control.py
+"""
+ปรับคุณภาพตามโหลด (adaptive step / CFG) เพื่อรักษา latency SLO
+- เวลาสังเคราะห์ ~ overhead + อัตรา x step x จำนวนตัวอักษร: ฟิตจาก inference จริงแยกตาม model version (ถ่วงน้ำหนักงานล่าสุด)
+  เฉพาะตัวอักษรที่สังเคราะห์จริง (cache hit, retry และ Segment ที่ข้าม CFG ไม่นับ) ไม่ให้ traffic ที่ hit cache กดอัตราลง
+- เวลารอคิวประมาณจากงานที่รอ/กำลังรันใน scheduler คูณเวลาบริการเฉลี่ย (EWMA) ต่อ request
+- ถ้ารอคิว + สังเคราะห์ที่ step ที่ขอ เกิน LATENCY_SLO_SEC: ลด step ให้พอดีงบที่เหลือ
+  แต่ไม่ต่ำกว่า ADAPTIVE_MIN_STEPS ของ version นั้น (และไม่เกิน step ที่ client ขอ)
+- request ที่เกิน SLO: Segment สั้น (< ADAPTIVE_CFG_SKIP_CHARS ตัวอักษร) ใช้ cfg=0 ซึ่งตัด forward pass รอบ unconditional ของ CFG
+step ที่ใช้จริงส่งกลับใน header X-TTS-Steps; ขอบเขตของแต่ละ version calibrate จาก `python benchmark.py steps`
+"""
+import threading
+
+import config
+
+EWMA_ALPHA = 0.2  # น้ำหนักของค่าล่าสุดใน EWMA
+
+class CostModel:
+    """
+    seconds = overhead + per_unit x (step x chars) ฟิตแบบ least squares บน EWMA ของโมเมนต์
+    (งานเก่าค่อยๆ หมดน้ำหนัก) ถ้างานที่เห็นมีขนาดเท่ากันหมดจะถือว่า overhead = 0
+    """
+    def __init__(self):
+        self.samples = 0
+        self.mean_x = self.mean_y = self.mean_xx = self.mean_xy = 0.0
+
+    def add(self, x, y):
+        a = EWMA_ALPHA if self.samples else 1.0
+        self.samples += 1
+        self.mean_x += a * (x - self.mean_x)
+        self.mean_y += a * (y - self.mean_y)
+        self.mean_xx += a * (x * x - self.mean_xx)
+        self.mean_xy += a * (x * y - self.mean_xy)
+
+    def coefficients(self):
+        var = self.mean_xx - self.mean_x ** 2
+        if var > 1e-6 * self.mean_xx:
+            per_unit = (self.mean_xy - self.mean_x * self.mean_y) / var
+            if per_unit > 0:
+                return max(0.0, self.mean_y - per_unit * self.mean_x), per_unit
+        return 0.0, self.mean_y / self.mean_x
+
+class Decision:
+    """
+    step / cfg_skip_chars ที่ใช้กับ request หนึ่ง (cfg_skip_chars=0 คือไม่ข้าม CFG)
+    """
+    def __init__(self, step, requested_step, cfg_skip_chars=0, predicted_sec=None):
+        self.step = step
+        self.requested_step = requested_step
+        self.cfg_skip_chars = cfg_skip_chars
+        self.predicted_sec = predicted_sec
+
+    @property
+    def reduced(self):
+        return self.step < self.requested_step
+
+    def headers(self):
+        headers = {"X-TTS-Steps": str(self.step)}
+        if self.cfg_skip_chars:
+            headers["X-TTS-CFG-Skip-Chars"] = str(self.cfg_skip_chars)
+        return headers
+
+class StepController:
+    """
+    ตัดสิน step ต่อ request จาก SLO + โหลดปัจจุบัน (thread-safe, สถานะต่อ process)
+    version ที่ยังไม่มี request ไหนจบ (ยังไม่มีข้อมูลเวลา) จะใช้ step ที่ขอเสมอ
+    """
+    def __init__(self, slo_sec, min_steps, cfg_skip_chars=0, enabled=True):
+        self.enabled = enabled
+        self.slo_sec = slo_sec
+        self.min_steps = dict(min_steps)   # version -> step ต่ำสุด ("*" = ทุก version)
+        self.cfg_skip_chars = cfg_skip_chars
+        self.decisions = 0
+        self.reduced = 0
+        self.cfg_skipped = 0
+        self._costs = {}       # version -> CostModel
+        self._service = None   # EWMA วินาทีต่อ request (ทุก version)
+        self._lock = threading.Lock()
+
+    def lower_bound(self, model_version):
+        return self.min_steps.get(model_version, self.min_steps.get("*", 1))
+
+    def observe(self, model_version, step, chars, seconds):
+        """
+        บันทึกเวลา inference ของ request หนึ่ง: chars = ตัวอักษรที่สังเคราะห์จริง, seconds = เวลาของ inference นั้น
+        (request ที่ hit cache ทั้งหมดได้ chars = 0 และไม่ถูกนับ)
+        """
+        if step <= 0 or chars <= 0 or seconds <= 0: return
+        with self._lock:
+            self._costs.setdefault(model_version, CostModel()).add(step * chars, seconds)
+
+    def observe_service(self, seconds):
+        """
+        เวลาทั้ง request บน worker (รวม cache hit/post-process) ใช้ประมาณเวลารอคิว
+        """
+        with self._lock:
+            self._service = seconds if self._service is None else self._service + EWMA_ALPHA * (seconds - self._service)
+
+    def expected_wait(self, load):
+        """
+        เวลารอคิวโดยประมาณของ request ใหม่ จาก scheduler.stats() (worker ว่างอยู่ = ไม่ต้องรอ)
+        """
+        with self._lock:
+            service = self._service
+        workers = max(1, load["workers"])
+        ahead = load["queue_depth"] + load["running"]
+        if service is None or ahead < workers:
+            return 0.0
+        return (ahead - workers + 1) / workers * service
+
+    def decide(self, model_version, step, chars, load):
+        """
+        คืน Decision ของ request ที่ขอ step นี้ ภายใต้ load = scheduler.stats()
+        chars = ตัวอักษรหลัง split/normalize ที่จะสังเคราะห์ (หน่วยเดียวกับที่ observe ใช้ฟิต cost)
+        """
+        if not self.enabled or step <= 0:
+            return Decision(step, step)
+        with self._lock:
+            cost = self._costs.get(model_version)
+            coefficients = cost.coefficients() if cost else None
+            self.decisions += 1
+        if coefficients is None or chars <= 0:
+            return Decision(step, step)
+
+        overhead, per_unit = coefficients
+        wait = self.expected_wait(load)
+        predicted = wait + overhead + per_unit * step * chars
+        if predicted <= self.slo_sec:
+            return Decision(step, step, predicted_sec=predicted)
+
+        budget = self.slo_sec - wait - overhead
+        fit = int(budget / (per_unit * chars)) if budget > 0 else 0
+        used = max(min(step, self.lower_bound(model_version)), min(step, fit))
+        decision = Decision(used, step, self.cfg_skip_chars, wait + overhead + per_unit * used * chars)
+        with self._lock:
+            if decision.reduced: self.reduced += 1
+            if decision.cfg_skip_chars: self.cfg_skipped += 1
+        return decision
+
+    def stats(self):
+        with self._lock:
+            costs = {}
+            for version, cost in self._costs.items():
+                overhead, per_unit = cost.coefficients()
+                costs[version] = {"overhead_sec": overhead, "sec_per_step_char": per_unit, "samples": cost.samples}
+            return {
+                "enabled": self.enabled,
+                "slo_sec": self.slo_sec,
+                "min_steps": dict(self.min_steps),
+                "cfg_skip_chars": self.cfg_skip_chars,
+                "cost": costs,
+                "service_sec": self._service,
+                "decisions": self.decisions,
+                "reduced": self.reduced,
+                "cfg_skipped": self.cfg_skipped,
+            }
+
+controller = StepController(
+    slo_sec=config.LATENCY_SLO_SEC,
+    min_steps=config.ADAPTIVE_MIN_STEPS,
+    cfg_skip_chars=config.ADAPTIVE_CFG_SKIP_CHARS,
+    enabled=config.ADAPTIVE_STEPS_ENABLED,
+)
@@ -0,0 +1,32 @@
+# tests/test_golden_split.py
+"""
+Auto Split ต้องได้ Segment เหมือน splitter แบบเดิม (baseline) ทุกตัวอักษร และ offset คงเดิม
+golden file: data/golden/split.json (สร้างใหม่ด้วย `python benchmark.py split --save data/golden/split.json`)
+"""
+import json
+import os
+
+import pytest
+
+import text_utils
+
+GOLDEN_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data", "golden", "split.json")
+
+with open(GOLDEN_PATH, encoding="utf-8") as f:
+    CASES = json.load(f)
+
+@pytest.fixture(scope="module", autouse=True)
+def tokenizer():
+    # ตัดคำยาวด้วย lexicon สถานีเหมือนตอนสร้าง golden file
+    text_utils.setup_tokenizer()
+
+@pytest.mark.parametrize("case", CASES, ids=[str(i) for i in range(len(CASES))])
+def test_iter_segments_matches_golden(case):
+    pieces = list(text_utils.iter_segments(case["text"]))
+    assert [seg for seg, _, _ in pieces] == case["segments"]
+    assert [[start, end] for _, start, end in pieces] == case["offsets"]
+    assert text_utils.intelligent_split(case["text"]) == case["segments"]
+
+def test_golden_covers_long_documents():
+    # เอกสารยาวต้องผ่าน split_long_sentence (Segment เกิน 120 ตัวอักษรถูกตัดต่อ)
+    assert any(len(case["text"]) > 2000 for case in CASES)
@@ -1,16 +1,54 @@
 import os
 import re
 import json
+import bisect
 import csv
+import pickle
+import time
+import hashlib
+import logging
+import threading
+from functools import lru_cache
+import pythainlp
 from pythainlp import word_tokenize
-from pythainlp.util import dict_trie, num_to_thaiword
+from pythainlp.util import Trie, dict_trie, num_to_thaiword
 from pythainlp.corpus import thai_words
 import config
+from cache_utils import LRUCache
+
+logger = logging.getLogger(__name__)
 
 # Global Variables
 custom_tokenizer = None
 my_custom_dict = {}
+lexicon_version = 0
 TEMP_MARKER = "###_NB_SPACE_###" # กาวสำหรับเชื่อมคำไม่ให้ขาดออกจากกัน
+LEXICON_ARTIFACT_VERSION = 1
+BATCH_SEPARATOR = "\x1f" # ASCII Unit Separator ใช้คั่นข้อความใน normalize_many
+NORMALIZE_BATCH_CHUNK = 32
+
+# Compiled Patterns
+_DATE_PATTERN = re.compile(r'\b(\d{1,2})[/-](\d{1,2})[/-](\d{4})\b')
+# จุดตัด Segment: วันที่ | ช่องว่างทั้งก้อนที่ไม่ได้อยู่ระหว่างอักษรไทยกับตัวเลข
+# (?=[\s\d]) ให้ข้ามตำแหน่งที่ไม่ใช่ตัวเลข/ช่องว่างได้เร็ว
+_SEGMENT_SCAN = re.compile(
+    rf'(?=[\s\d])(?:{_DATE_PATTERN.pattern}'
+    r'|(?<!\s)(?!(?<=[ก-๙])\s++\d)(?!(?<=\d)\s++[ก-๙])\s++)'
+)
+_WS_RUN = re.compile(r'\s+')
+_TIME_PATTERN = re.compile(r'^([0-2]?[0-9])[:.]([0-5][0-9])$')
+_DECIMAL_PATTERN = re.compile(r'^\d+(\.\d+)?$')
+
+# Memo ของผล normalize ต่อข้อความ (ล้างเมื่อโหลด Dictionary ใหม่ / ลบเฉพาะข้อความที่มีคำที่แก้)
+_normalize_memo = LRUCache(config.NORMALIZE_CACHE_SIZE)
+
+# Snapshot ของ Lexicon ที่ใช้อยู่: (custom_dict, trie) ไม่ถูกแก้หลังสลับเข้า
+# normalize อ่านครั้งเดียวต่อ call จึงไม่เห็น dict ใหม่ปนกับ trie เก่า
+_lexicon = None
+_lexicon_lock = threading.RLock()   # ผู้แก้ Lexicon (PATCH / reload) ทีละราย
+_swap_lock = threading.Lock()       # สลับ snapshot กับเขียน memo ไม่ให้สลับลำดับกัน
+_lexicon_stamp = None               # (mtime_ns, size) ของไฟล์ที่โหลดล่าสุด
+_last_change = None
 
 # Dictionary สำหรับแปลงเดือน
 THAI_MONTHS = {
@@ -43,13 +81,290 @@ def load_custom_dict(file_path):
                     custom_dict[row[0].strip()] = row[1].strip()
     return custom_dict
 
+def save_custom_dict(file_path, custom_dict):
+    """
+    เขียน Lexicon กลับรูปแบบเดิม (json / csv) ผ่านไฟล์ชั่วคราว + os.replace (worker อื่นไม่เห็นไฟล์ครึ่งๆ)
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(file_path)), exist_ok=True)
+    tmp_path = f"{file_path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8', newline='') as f:
+        if file_path.endswith('.csv'):
+            csv.writer(f).writerows(custom_dict.items())
+        else:
+            json.dump(custom_dict, f, ensure_ascii=False, indent=4)
+    os.replace(tmp_path, file_path)
+
+class CompiledTrie(Trie):
+    """
+    Trie แบบแบน: dict ของทุก prefix -> เป็นคำหรือไม่ (True/False)
+    ใช้แทน pythainlp Trie ได้ (newmm เรียกแค่ prefixes) แต่ pickle/load เร็วกว่าสร้าง Node ทีละตัวมาก
+    """
+    def __init__(self, words=(), index=None):
+        self._index = index if index is not None else {}
+        self._word_count = sum(1 for v in self._index.values() if v)
+        for word in words:
+            self.add(word)
+
+    def add(self, word):
+        word = word.strip()
+        if not word: return
+        index = self._index
+        for k in range(1, len(word)):
+            index.setdefault(word[:k], False)
+        if not index.get(word):
+            index[word] = True
+            self._word_count += 1
+
+    def remove(self, word):
+        # prefix ที่ค้างอยู่ไม่มีผลกับผลลัพธ์ (แค่ทำให้เดินต่อได้)
+        if self._index.get(word):
+            self._index[word] = False
+            self._word_count -= 1
+
+    def prefixes(self, text, start=0):
+        res = []
+        get = self._index.get
+        n = len(text)
+        i = start + 1
+        while i <= n:
+            end = get(text[start:i])
+            if end is None:
+                break
+            if end:
+                res.append(text[start:i])
+            i += 1
+        return res
+
+    def __contains__(self, key):
+        return bool(self._index.get(key))
+
+    def __iter__(self):
+        return (word for word, end in self._index.items() if end)
+
+    def __len__(self):
+        return self._word_count
+
+def _lexicon_fingerprint(file_path):
+    """
+    ค่าเปลี่ยนเมื่อไฟล์ Lexicon / เวอร์ชัน pythainlp (คลังคำ thai_words) / รูปแบบ artifact เปลี่ยน
+    """
+    h = hashlib.sha256(f"{LEXICON_ARTIFACT_VERSION}|{pythainlp.__version__}|".encode("utf-8"))
+    if os.path.exists(file_path):
+        with open(file_path, "rb") as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+def build_lexicon_artifact(file_path, artifact_path):
+    """
+    สร้าง artifact: header (fingerprint) + payload (lexicon mapping + index ของ CompiledTrie)
+    เขียนไฟล์ชั่วคราวแล้ว os.replace เพื่อไม่ให้ worker อื่นอ่านไฟล์ครึ่งๆ
+    """
+    custom_dict = load_custom_dict(file_path)
+    trie = CompiledTrie(thai_words())
+    for word in custom_dict:
+        trie.add(word)
+    _write_lexicon_artifact(file_path, artifact_path, custom_dict, trie)
+    return custom_dict, trie
+
+def _write_lexicon_artifact(file_path, artifact_path, custom_dict, trie):
+    header = {"fingerprint": _lexicon_fingerprint(file_path), "words": len(trie)}
+    os.makedirs(os.path.dirname(artifact_path) or ".", exist_ok=True)
+    tmp_path = f"{artifact_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        pickle.dump(header, f, protocol=pickle.HIGHEST_PROTOCOL)
+        pickle.dump({"lexicon": custom_dict, "index": trie._index}, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, artifact_path)
+
+def load_lexicon_artifact(file_path, artifact_path):
+    """
+    โหลด artifact ถ้า fingerprint ตรงกับ Lexicon ปัจจุบัน ไม่งั้นสร้างใหม่
+    คืน (custom_dict, trie, rebuilt)
+    """
+    if os.path.exists(artifact_path):
+        try:
+            with open(artifact_path, "rb") as f:
+                header = pickle.load(f)
+                if header.get("fingerprint") == _lexicon_fingerprint(file_path):
+                    payload = pickle.load(f)
+                    return payload["lexicon"], CompiledTrie(index=payload["index"]), False
+        except Exception as e:
+            logger.warning(f"Lexicon artifact unreadable, rebuilding: {e}")
+    custom_dict, trie = build_lexicon_artifact(file_path, artifact_path)
+    return custom_dict, trie, True
+
+def _file_stamp(file_path):
+    try:
+        st = os.stat(file_path)
+        return st.st_mtime_ns, st.st_size
+    except OSError:
+        return None
+
+def _install_lexicon(custom_dict, trie, affected=None):
+    """
+    สลับ snapshot ใหม่เข้าแทนทีเดียว แล้วล้าง memo (ทั้งหมด หรือเฉพาะข้อความที่มีคำใน affected)
+    คืนจำนวน memo entry ที่ถูกล้าง
+    """
+    global _lexicon, custom_tokenizer, my_custom_dict, lexicon_version
+    if affected is None:
+        match = None
+    else:
+        pattern = re.compile("|".join(re.escape(w) for w in sorted(affected, key=len, reverse=True)))
+        # เทียบกับข้อความหลังแปลงวันที่ เพราะชื่อเดือนที่แปลงแล้วก็ผ่าน Dictionary
+        match = lambda text: pattern.search(_prepare_for_tokenize(text)) is not None
+    with _swap_lock:
+        _lexicon = (custom_dict, trie)
+        custom_tokenizer, my_custom_dict = trie, custom_dict
+        lexicon_version += 1
+        if match is None:
+            invalidated = len(_normalize_memo)
+            _normalize_memo.clear()
+            return invalidated
+        return _normalize_memo.discard_if(match)
+
+def _current_lexicon():
+    if _lexicon is None:
+        setup_tokenizer()
+    return _lexicon
+
 def setup_tokenizer():
-    global custom_tokenizer, my_custom_dict
-    my_custom_dict = load_custom_dict(config.LEXICON_PATH)
-    all_words = set(thai_words())
-    all_words.update(my_custom_dict.keys())
-    custom_tokenizer = dict_trie(all_words)
-    print(f"✅ Loaded Dictionary: {len(my_custom_dict)} words")
+    global _lexicon_stamp
+    with _lexicon_lock:
+        stamp = _file_stamp(config.LEXICON_PATH)
+        if config.LEXICON_CACHE_PATH:
+            custom_dict, trie, rebuilt = load_lexicon_artifact(config.LEXICON_PATH, config.LEXICON_CACHE_PATH)
+            _install_lexicon(custom_dict, trie)
+            _lexicon_stamp = stamp
+            logger.info(f"Loaded dictionary: {len(custom_dict)} words ({'rebuilt' if rebuilt else 'compiled'} index)")
+            return
+        custom_dict = load_custom_dict(config.LEXICON_PATH)
+        all_words = set(thai_words())
+        all_words.update(custom_dict.keys())
+        _install_lexicon(custom_dict, dict_trie(all_words))
+        _lexicon_stamp = stamp
+        logger.info(f"Loaded dictionary: {len(custom_dict)} words")
+
+# --- Lexicon Hot Reload ---
+
+def apply_lexicon_changes(upserts=None, removals=(), persist=False):
+    """
+    แก้ Lexicon แบบ incremental โดยไม่ต้อง restart
+    - copy-on-write: สำเนา dict + index ของ trie แล้วเพิ่ม/ลบเฉพาะคำที่เปลี่ยน จากนั้นสลับ snapshot ทีเดียว
+      (normalize ที่ทำอยู่ใช้ snapshot เดิมจนจบ ไม่ต้องรอ lock)
+    - ล้าง memo เฉพาะข้อความที่มีคำที่เปลี่ยน; Segment cache ไม่ต้องล้าง เพราะ key มาจากข้อความหลัง normalize
+      (คำอ่านใหม่ = key ใหม่ ของเก่าจะหมดอายุไปเองตาม LRU)
+    - คำที่ลบแต่มีใน thai_words() ยังอยู่ใน trie (ตัดคำได้เหมือนเดิม แค่ไม่มีคำอ่านพิเศษ)
+    persist=True เขียนไฟล์ Lexicon (และ artifact) ด้วย
+    """
+    global _lexicon_stamp, _last_change
+    start = time.perf_counter()
+    upserts = {str(w).strip(): str(p).strip() for w, p in (upserts or {}).items() if str(w).strip()}
+    removals = {str(w).strip() for w in removals if str(w).strip()} - upserts.keys()
+
+    with _lexicon_lock:
+        old_dict, old_trie = _current_lexicon()
+        added = {w: p for w, p in upserts.items() if w not in old_dict}
+        updated = {w: p for w, p in upserts.items() if w in old_dict and old_dict[w] != p}
+        removed = [w for w in removals if w in old_dict]
+        affected = set(added) | set(updated) | set(removed)
+
+        invalidated = 0
+        if affected:
+            custom_dict = dict(old_dict)
+            custom_dict.update(upserts)
+            for w in removed:
+                del custom_dict[w]
+            if isinstance(old_trie, CompiledTrie):
+                trie = CompiledTrie(index=dict(old_trie._index))
+            else:
+                trie = CompiledTrie(old_trie)
+            for w in added:
+                trie.add(w)
+            base_words = thai_words()
+            for w in removed:
+                if w not in base_words: trie.remove(w)
+            invalidated = _install_lexicon(custom_dict, trie, affected)
+
+            if persist:
+                save_custom_dict(config.LEXICON_PATH, custom_dict)
+                if config.LEXICON_CACHE_PATH:
+                    _write_lexicon_artifact(config.LEXICON_PATH, config.LEXICON_CACHE_PATH, custom_dict, trie)
+                _lexicon_stamp = _file_stamp(config.LEXICON_PATH)
+
+        _last_change = {
+            "added": len(added),
+            "updated": len(updated),
+            "removed": len(removed),
+            "invalidated": invalidated,
+            "elapsed_ms": round((time.perf_counter() - start) * 1000, 2),
+            "version": lexicon_version,
+        }
+        if affected:
+            logger.info("Lexicon updated", extra={"fields": _last_change})
+        return dict(_last_change)
+
+def reload_lexicon():
+    """
+    อ่านไฟล์ Lexicon ใหม่แล้วใช้เฉพาะส่วนที่ต่างจากที่โหลดอยู่ (ผ่าน apply_lexicon_changes)
+    """
+    global _lexicon_stamp
+    with _lexicon_lock:
+        stamp = _file_stamp(config.LEXICON_PATH)
+        new_dict = load_custom_dict(config.LEXICON_PATH)
+        current = _current_lexicon()[0]
+        upserts = {w: p for w, p in new_dict.items() if current.get(w) != p}
+        removals = [w for w in current if w not in new_dict]
+        result = apply_lexicon_changes(upserts, removals)
+        _lexicon_stamp = stamp
+        if config.LEXICON_CACHE_PATH and (upserts or removals):
+            _write_lexicon_artifact(config.LEXICON_PATH, config.LEXICON_CACHE_PATH, *_lexicon)
+        return result
+
+def lexicon_stats():
+    custom_dict, trie = _current_lexicon()
+    return {
+        "path": config.LEXICON_PATH,
+        "entries": len(custom_dict),
+        "tokenizer_words": len(trie),
+        "version": lexicon_version,
+        "watching": watcher.running,
+        "last_change": _last_change,
+    }
+
+class LexiconWatcher:
+    """
+    Thread ที่ตรวจ mtime/size ของไฟล์ Lexicon ทุก interval วินาที แล้ว reload_lexicon() เมื่อเปลี่ยน
+    ไฟล์ที่อ่านไม่ได้ (เช่นเขียนค้างครึ่งไฟล์) จะข้ามไปแล้วลองใหม่รอบถัดไป
+    """
+    def __init__(self, interval):
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if self.interval <= 0 or self.running: return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="lexicon-watcher", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            if _file_stamp(config.LEXICON_PATH) == _lexicon_stamp: continue
+            try:
+                reload_lexicon()
+            except Exception as e:
+                logger.warning(f"Lexicon reload failed, keeping current dictionary: {e}")
+
+watcher = LexiconWatcher(config.LEXICON_WATCH_INTERVAL)
 
 def replace_dates(text):
     """
@@ -66,100 +381,267 @@ def replace_dates(text):
         # เช่น: วันที่###18###เดือน###ธันวาคม###พุทธศักราช###2567
         return f"{TEMP_MARKER}{d_val}{TEMP_MARKER}{TEMP_MARKER}{m_name}{TEMP_MARKER}{TEMP_MARKER}{y}\n"
 
-    pattern = r'\b(\d{1,2})[/-](\d{1,2})[/-](\d{4})\b'
-    return re.sub(pattern, date_replacer, text)
+    return _DATE_PATTERN.sub(date_replacer, text)
 
 def split_long_sentence(text, max_length=150):
     text = text.strip()
     if len(text) <= max_length:
         return [text]
 
-    if custom_tokenizer is None: setup_tokenizer()
-    words = word_tokenize(text, engine="newmm", custom_dict=custom_tokenizer)
+    words = word_tokenize(text, engine="newmm", custom_dict=_current_lexicon()[1])
 
+    # ต่อคำลง list แล้ว join ทีเดียวต่อ chunk (ไม่ต่อ string ซ้ำๆ)
     chunks = []
-    current_chunk = ""
+    current, current_len = [], 0
 
     for word in words:
-        if len(current_chunk) + len(word) <= max_length:
-            current_chunk += word
+        if current_len + len(word) <= max_length:
+            current.append(word)
+            current_len += len(word)
         else:
-            if current_chunk: chunks.append(current_chunk)
-            current_chunk = word
+            if current: chunks.append("".join(current))
+            current, current_len = [word], len(word)
 
-    if current_chunk:
-        chunks.append(current_chunk)
+    if current:
+        chunks.append("".join(current))
 
     return chunks
 
-def intelligent_split(text):
-    if not text: return []
+def _joins(prev_ch, next_ch):
+    # ช่องว่างระหว่างอักษรไทยกับตัวเลข (ทั้งสองทิศ) ไม่ใช่จุดตัด Segment
+    return (("ก" <= prev_ch <= "๙") and next_ch.isdecimal()) or (prev_ch.isdecimal() and ("ก" <= next_ch <= "๙"))
+
+def _date_reading(m):
+    d, mo, y = m.group(1, 2, 3)
+    return f" {int(d)}  {THAI_MONTHS.get(mo, mo)}  {y}"
+
+def _segment_text(text, start, end, dates):
+    """
+    ข้อความของ Segment text[start:end]: ช่องว่างภายในเป็นช่องว่างที่เชื่อมคำทั้งหมด -> " ", วันที่ -> คำอ่าน
+    """
+    if not dates:
+        return _WS_RUN.sub(" ", text[start:end])
+    pieces, pos = [], start
+    for m in dates:
+        pieces.append(_WS_RUN.sub(" ", text[pos:m.start()]))
+        pieces.append(_date_reading(m))
+        pos = m.end()
+        if pos < end:
+            # ช่องว่าง (หรือ newline ที่ตามวันที่) ที่ไม่ได้ตัด Segment -> " "
+            pieces.append(" ")
+            ws = _WS_RUN.match(text, pos, end)
+            if ws: pos = ws.end()
+    pieces.append(_WS_RUN.sub(" ", text[pos:end]))
+    return "".join(pieces)
+
+def _segment_spans(text, start, end, dates):
+    """
+    เหมือน _segment_text แต่คืนตำแหน่งของแต่ละส่วนในต้นฉบับด้วย (ใช้ตอนต้องตัด Segment ยาวต่อ)
+    span = (ตำแหน่งใน Segment, ความยาว, start, end, ตรงตัวอักษรหรือไม่)
+    """
+    pieces, spans = [], []
+
+    def add(piece, a, b, literal):
+        spans.append((spans[-1][0] + spans[-1][1] if spans else 0, len(piece), a, b, literal))
+        pieces.append(piece)
+
+    def add_literal(a, b):
+        for m in _WS_RUN.finditer(text, a, b):
+            if m.start() > a: add(text[a:m.start()], a, m.start(), True)
+            add(" ", m.start(), m.end(), False)
+            a = m.end()
+        if a < b: add(text[a:b], a, b, True)
+
+    pos = start
+    for m in dates:
+        add_literal(pos, m.start())
+        add(_date_reading(m), m.start(), m.end(), False)
+        pos = m.end()
+        if pos < end:
+            ws = _WS_RUN.match(text, pos, end)
+            add(" ", pos, ws.end() if ws else pos, False)
+            if ws: pos = ws.end()
+    add_literal(pos, end)
+    return "".join(pieces), spans
+
+def _piece_offsets(spans, starts, r_start, r_end):
+    """
+    แปลงช่วง [r_start, r_end) ของข้อความ Segment กลับเป็นช่วงในข้อความต้นฉบับ
+    ส่วนที่ถูกแปลง (วันที่ / ช่องว่างที่เชื่อม) คืนขอบของทั้งส่วน
+    """
+    p = spans[bisect.bisect_right(starts, r_start) - 1]
+    start = p[2] + (r_start - p[0]) if p[4] else p[2]
+    p = spans[bisect.bisect_right(starts, r_end - 1) - 1]
+    end = p[2] + (r_end - p[0]) if p[4] else p[3]
+    return start, end
+
+def _segment_bounds(text):
+    """
+    Generator: yield (start, end, วันที่ใน Segment) ของแต่ละ Segment ใน text (strip แล้ว)
+    """
+    n = len(text)
+    seg_start, dates = 0, []
+    for m in _SEGMENT_SCAN.finditer(text):
+        if m.group(1) is None:
+            yield seg_start, m.start(), dates
+            seg_start, dates = m.end(), []
+            continue
+
+        # วันที่: ช่องว่างข้างหน้า (ถ้ามี) ตัด Segment เสมอ แม้จะอยู่หลังอักษรไทย
+        a = m.start()
+        if a > seg_start and text[a - 1].isspace():
+            r = a - 1
+            while text[r - 1].isspace(): r -= 1
+            yield seg_start, r, dates
+            seg_start, dates = a, []
+        dates.append(m)
+        # หลังวันที่ติดตัวอักษรเลย (ไม่มีช่องว่าง): ตัดตรงนั้น เว้นแต่เป็นตัวเลขกับอักษรไทย
+        e = m.end()
+        if e < n and not text[e].isspace() and not _joins(text[e - 1], text[e]):
+            yield seg_start, e, dates
+            seg_start, dates = e, []
+    if seg_start < n:
+        yield seg_start, n, dates
+
+def iter_segments(text):
+    """
+    Generator: yield (segment, start, end) ตามลำดับ start/end เป็นตำแหน่งใน text ต้นฉบับ
+    ได้ Segment เหมือน intelligent_split เดิมทุกตัวอักษร แต่หาจุดตัดด้วย _SEGMENT_SCAN รอบเดียว (วันที่ | ช่องว่างที่ตัด)
+    - ช่องว่างระหว่างอักษรไทยกับตัวเลข -> " " (ไม่ตัด) ช่องว่างอื่นทุกแบบ (รวม newline) -> ตัด Segment
+    - วันที่ DD/MM/YYYY -> " d  เดือน  ปี" และจบ Segment หลังวันที่ (เว้นแต่ตามด้วยอักษรไทย)
+    - Segment ที่ยาวเกิน 120 ตัวอักษรถูกตัดต่อด้วย split_long_sentence
+    """
+    if not text: return
+    base = len(text) - len(text.lstrip())
     text = text.strip()
-    
-    # 1. แปลงวันที่ (จะได้ก้อนวันที่ติดกัน + \n)
-    text = replace_dates(text)
-    
-    # 2. ล็อก Space ระหว่างตัวเลขไทย-อังกฤษ
-    text = re.sub(r'(?<=[ก-๙])\s+(?=\d)', TEMP_MARKER, text)
-    text = re.sub(r'(?<=\d)\s+(?=[ก-๙])', TEMP_MARKER, text)
-
-    # 3. ตัดด้วย Newline (ซึ่งวันที่ของเราจะโดนตัดแยกออกมาตรงนี้)
-    raw_chunks = re.split(r'[\n\r]+', text)
-    
-    final_segments = []
-    for chunk in raw_chunks:
-        # 4. ตัดด้วย Whitespace (วันที่เราเชื่อมด้วย Marker ไว้ จะไม่โดนตัดตรงนี้)
-        sub_chunks = re.split(r'\s+', chunk)
-        for sub in sub_chunks:
-            sub = sub.strip()
-            if sub:
-                # 5. คืนค่า Marker กลับเป็นช่องว่าง เพื่อให้โมเดลอ่านได้ถูกต้อง
-                restored = sub.replace(TEMP_MARKER, " ")
-                
-                # Check Length
-                if len(restored) > 120:
-                    micro_segments = split_long_sentence(restored, max_length=150)
-                    final_segments.extend(micro_segments)
-                else:
-                    final_segments.append(restored)
-                    
-    return final_segments
+    has_marker = TEMP_MARKER in text
 
-def normalize_text(text):
-    if custom_tokenizer is None:
-        setup_tokenizer()
-    
+    for start, end, dates in _segment_bounds(text):
+        segment = _segment_text(text, start, end, dates)
+        if has_marker:
+            # ข้อความที่มี TEMP_MARKER อยู่แล้ว: แบบเดิมแปลงเป็นช่องว่างด้วย (ตำแหน่งคืนทั้งช่วง)
+            segment = segment.replace(TEMP_MARKER, " ")
+        if len(segment) <= 120:
+            yield segment, start + base, end + base
+            continue
+
+        if has_marker:
+            spans = [(0, len(segment), start, end, False)]
+        else:
+            segment, spans = _segment_spans(text, start, end, dates)
+        starts = [span[0] for span in spans]
+        pos = len(segment) - len(segment.lstrip())
+        for chunk in split_long_sentence(segment, max_length=150):
+            a, b = _piece_offsets(spans, starts, pos, pos + len(chunk))
+            yield chunk, a + base, b + base
+            pos += len(chunk)
+
+def intelligent_split(text):
+    return [segment for segment, _, _ in iter_segments(text)]
+
+@lru_cache(maxsize=8192)
+def verbalize_number(token):
+    """
+    คำอ่านของตัวเลข / เวลา (HH:MM, HH.MM) / ทศนิยม หรือ None ถ้า token ไม่ใช่ตัวเลข
+    """
+    if token.isdigit():
+        try: return num_to_thaiword(int(token))
+        except Exception: return None
+    m = _TIME_PATTERN.match(token)
+    if m:
+        try:
+            hh, mm = int(m.group(1)), int(m.group(2))
+            val = f"{num_to_thaiword(hh)}นาฬิกา"
+            if mm > 0: val += f"{num_to_thaiword(mm)}นาที"
+            return val
+        except Exception: return None
+    if _DECIMAL_PATTERN.match(token):
+        try: return num_to_thaiword(float(token))
+        except Exception: return None
+    return None
+
+def _prepare_for_tokenize(text):
     # 🔥 Fix Preview: เรียก replace_dates เพื่อให้หน้าเว็บเห็นคำอ่านวันที่
     text = replace_dates(text)
     # ล้าง Marker ออกให้เป็นช่องว่างปกติ คนอ่านจะได้ไม่งง
-    text = text.replace(TEMP_MARKER, " ")
-    
-    raw_tokens = word_tokenize(text, engine="newmm", custom_dict=custom_tokenizer)
+    return text.replace(TEMP_MARKER, " ")
+
+def _normalize_tokens(raw_tokens, custom_dict):
     processed_tokens = []
-    
+
     for token in raw_tokens:
-        val = token
-        
-        if token in my_custom_dict:
-            val = my_custom_dict[token]
-        elif token.isdigit():
-            try: val = num_to_thaiword(int(token))
-            except: pass
-        elif re.match(r'^([0-2]?[0-9])[:.]([0-5][0-9])$', token):
-            try:
-                parts = re.split(r'[:.]', token)
-                hh, mm = int(parts[0]), int(parts[1])
-                val = f"{num_to_thaiword(hh)}นาฬิกา"
-                if mm > 0: val += f"{num_to_thaiword(mm)}นาที"
-            except: pass
-        elif re.match(r'^\d+(\.\d+)?$', token):
-             try: val = num_to_thaiword(float(token))
-             except: pass
-             
+        val = custom_dict.get(token)
+        if val is None:
+            val = verbalize_number(token)
+            if val is None: val = token
+
         val = val.strip()
-        if val in ["น.", "น"]:
+        if val in ("น.", "น"):
             continue
         if val: processed_tokens.append(val)
-        
-    final_text = " ".join(processed_tokens)
-    return final_text, processed_tokens
\ No newline at end of file
+
+    return " ".join(processed_tokens), processed_tokens
+
+def _memo_put(text, value, state):
+    # ไม่เก็บผลที่คำนวณจาก snapshot ที่ถูกสลับออกไประหว่างทาง (memo ส่วนนั้นอาจถูกล้างไปแล้ว)
+    with _swap_lock:
+        if _lexicon is state:
+            _normalize_memo.put(text, value)
+
+def normalize_text(text):
+    state = _current_lexicon()
+
+    cached = _normalize_memo.get(text)
+    if cached is not None:
+        return cached[0], list(cached[1])
+
+    custom_dict, trie = state
+    raw_tokens = word_tokenize(_prepare_for_tokenize(text), engine="newmm", custom_dict=trie)
+    final_text, processed_tokens = _normalize_tokens(raw_tokens, custom_dict)
+    _memo_put(text, (final_text, tuple(processed_tokens)), state)
+    return final_text, processed_tokens
+
+def _tokenize_joined(texts, trie):
+    if len(texts) > 1 and not any(BATCH_SEPARATOR in t for t in texts):
+        raw_tokens = word_tokenize(BATCH_SEPARATOR.join(texts), engine="newmm", custom_dict=trie)
+        groups = [[]]
+        for token in raw_tokens:
+            if token == BATCH_SEPARATOR: groups.append([])
+            else: groups[-1].append(token)
+        if len(groups) == len(texts):
+            return groups
+    return [word_tokenize(t, engine="newmm", custom_dict=trie) for t in texts]
+
+def normalize_many(texts):
+    """
+    Normalize หลายข้อความ (เช่นทุก Segment ของ Auto Split) ด้วย word_tokenize ครั้งเดียว
+    ต่อข้อความด้วย BATCH_SEPARATOR (ไม่ใช่อักษรไทย newmm จึงตัดตรงนั้นเสมอ) แล้วแยกผลกลับ
+    คืน list ของ (final_text, tokens) ตามลำดับเดิม
+    """
+    state = _current_lexicon()
+    custom_dict, trie = state
+
+    results = [None] * len(texts)
+    pending = {}
+    for i, text in enumerate(texts):
+        cached = _normalize_memo.get(text)
+        if cached is not None:
+            results[i] = (cached[0], list(cached[1]))
+        else:
+            pending.setdefault(text, []).append(i)
+
+    if pending:
+        misses = list(pending)
+        prepared = [_prepare_for_tokenize(t) for t in misses]
+        groups = []
+        # ข้อความยาวมากๆ ทำให้ newmm ช้าลง จึงต่อกันทีละ NORMALIZE_BATCH_CHUNK ข้อความ
+        for start in range(0, len(prepared), NORMALIZE_BATCH_CHUNK):
+            groups.extend(_tokenize_joined(prepared[start:start + NORMALIZE_BATCH_CHUNK], trie))
+
+        for text, raw_tokens in zip(misses, groups):
+            final_text, processed_tokens = _normalize_tokens(raw_tokens, custom_dict)
+            _memo_put(text, (final_text, tuple(processed_tokens)), state)
+            for i in pending[text]:
+                results[i] = (final_text, list(processed_tokens))
+
+    return results
@@ -1,46 +1,962 @@
 # tts_handler.py
+import os
+import math
+import time
+import asyncio
+import logging
+import tempfile
+import threading
+import contextvars
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
 import numpy as np
+import soundfile as sf
 import torch
 
+import config
+import audio_utils
+import text_utils
+import quality_gate
+import observability
+from cache_utils import ReferenceCache, ReferenceAudio, SegmentCache, audio_digest, reference_key, segment_key
+
+logger = logging.getLogger(__name__)
+
 try:
     from f5_tts_th.tts import TTS
 except ImportError:
-    print("Warning: f5_tts_th not found. Using Mock TTS.")
+    logger.warning("f5_tts_th not found. Using Mock TTS.")
     class MockTTS:
+        accepts_waveform = True  # ref_audio เป็น numpy array ได้ (ไม่ต้องเขียนไฟล์ Reference)
+        # Simulated cost so batching can be benchmarked without a GPU
+        call_overhead = config.MOCK_CALL_OVERHEAD  # seconds paid once per infer/infer_batch call
+        sec_per_char = config.MOCK_SEC_PER_CHAR    # seconds paid per generated character (at step=32 with CFG)
+        resident_bytes = 0    # simulated model footprint for the model manager
+
         def __init__(self, model="v1"):
             self.model = model
-            print(f"   [MockTTS] Initialized with model {model}")
-        def infer(self, ref_audio, ref_text, gen_text, step=32, cfg=2.0, speed=1.0, fix_duration=None):
-            print(f"   [MockTTS] Inferring: '{gen_text}' (Speed={speed}, FixDur={fix_duration})")
+            logger.debug(f"[MockTTS] Initialized with model {model}")
+        def _synth(self, gen_text, speed=1.0, fix_duration=None):
             sr = 24000
             duration = fix_duration if fix_duration else max(0.5, len(gen_text) * 0.1 / speed)
             samples = int(duration * sr)
-            audio = np.random.uniform(-0.1, 0.1, samples)
-            return audio
+            return np.random.uniform(-0.1, 0.1, samples)
+        def _simulate_cost(self, n_chars, step=32, cfg=2.0):
+            # like F5: cost grows with step, and CFG doubles the forward pass (cfg=0 skips it)
+            cost = self.call_overhead + n_chars * self.sec_per_char * (step / 32) * (1.0 if cfg else 0.5)
+            if cost > 0:
+                time.sleep(cost)
+        def infer(self, ref_audio, ref_text, gen_text, step=32, cfg=2.0, speed=1.0, max_chars=100, fix_duration=None):
+            logger.debug(f"[MockTTS] Inferring: '{gen_text}' (Speed={speed}, FixDur={fix_duration})")
+            self._simulate_cost(len(gen_text), step, cfg)
+            return self._synth(gen_text, speed, fix_duration)
+        def infer_batch(self, ref_audio, ref_text, gen_texts, step=32, cfg=2.0, speed=1.0, fix_durations=None):
+            logger.debug(f"[MockTTS] Batch inferring {len(gen_texts)} segments (Speed={speed})")
+            fix_durations = fix_durations or [None] * len(gen_texts)
+            self._simulate_cost(sum(len(t) for t in gen_texts), step, cfg)
+            return [self._synth(t, speed, d) for t, d in zip(gen_texts, fix_durations)]
     TTS = MockTTS
 
-# Model Cache
-model_cache = {}
+# --- Model Manager ---
 
-def get_tts_model(version="v1"):
-    global model_cache
-    if version in model_cache:
-        return model_cache[version]
-    
-    print(f"🔄 Loading Model {version} to memory...")
-    if TTS:
+def model_footprint(model):
+    """
+    ขนาดของโมเดลแยกตามอุปกรณ์ (bytes): นับ parameter/buffer ของ torch.nn.Module ทุกตัวที่ model ถือไว้
+    (MockTTS ใช้ค่า resident_bytes แทน)
+    """
+    ram, vram, seen = 0, 0, set()
+    modules = [model] if isinstance(model, torch.nn.Module) else [
+        v for v in vars(model).values() if isinstance(v, torch.nn.Module)]
+    for module in modules:
+        for tensor in list(module.parameters()) + list(module.buffers()):
+            if id(tensor) in seen: continue
+            seen.add(id(tensor))
+            size = tensor.element_size() * tensor.nelement()
+            if tensor.device.type == "cuda": vram += size
+            else: ram += size
+    if not seen:
+        ram = int(getattr(model, "resident_bytes", 0))
+    return ram, vram
+
+class ModelManager:
+    """
+    เก็บโมเดลที่โหลดแล้วแบบ LRU ภายใต้งบ RAM/VRAM (0 = ไม่จำกัด)
+    - โมเดลที่เกินงบจะถูก evict ทั้งตัว (เก็บตัวที่ใช้ล่าสุดไว้อย่างน้อย 1 ตัวเสมอ)
+    - request ที่ขอ version เดียวกันพร้อมกันจะรอการโหลดครั้งเดียวกัน (ไม่โหลดซ้ำ)
+    - ถ้าเคยโหลดมาก่อน จะ evict ล่วงหน้าตามขนาดที่วัดได้ครั้งก่อน เพื่อไม่ให้ OOM ระหว่างโหลด
+    request ที่ยังถือโมเดลที่ถูก evict อยู่ใช้ต่อได้จนจบ (หน่วยความจำคืนเมื่อไม่มีใครอ้างถึง)
+    """
+    def __init__(self, ram_budget=0, vram_budget=0):
+        self.ram_budget = ram_budget
+        self.vram_budget = vram_budget
+        self._models = OrderedDict()   # version -> model (เก่าสุดอยู่หน้า)
+        self._loading = {}             # version -> Future ของการโหลดที่กำลังทำอยู่
+        self._info = {}                # version -> สถิติการโหลด/ขนาด
+        self._lock = threading.RLock()
+
+    def _usage(self, exclude=None):
+        ram = sum(self._info[v]["ram_bytes"] for v in self._models if v != exclude)
+        vram = sum(self._info[v]["vram_bytes"] for v in self._models if v != exclude)
+        return ram, vram
+
+    def _over_budget(self, extra_ram=0, extra_vram=0):
+        ram, vram = self._usage()
+        return ((self.ram_budget and ram + extra_ram > self.ram_budget)
+                or (self.vram_budget and vram + extra_vram > self.vram_budget))
+
+    def _evict_until_fits(self, extra_ram=0, extra_vram=0, keep=None):
+        with self._lock:
+            while self._over_budget(extra_ram, extra_vram):
+                victims = [v for v in self._models if v != keep]
+                if not victims: break
+                self.evict(victims[0])
+
+    def get(self, version):
+        with self._lock:
+            model = self._models.get(version)
+            if model is not None:
+                self._models.move_to_end(version)
+                self._info[version]["hits"] += 1
+                return model
+            future = self._loading.get(version)
+            owner = future is None
+            if owner:
+                future = Future()
+                self._loading[version] = future
+
+        if not owner:
+            logger.info(f"Waiting for model {version} (already loading)")
+            return future.result()
+
+        model = None
         try:
-            model = TTS(model=version)
-            model_cache[version] = model
-            print(f"✅ Model {version} Loaded and Cached")
+            model = self._load(version)
             return model
+        finally:
+            future.set_result(model)
+            with self._lock:
+                self._loading.pop(version, None)
+
+    def _load(self, version):
+        if not TTS: return None
+        info = self._info.get(version)
+        if info:
+            # เคยโหลดแล้ว: รู้ขนาด -> evict ก่อนโหลดจริง
+            self._evict_until_fits(info["ram_bytes"], info["vram_bytes"])
+
+        logger.info(f"Loading model {version}")
+        t0 = time.perf_counter()
+        try:
+            model = TTS(model=version)
         except Exception as e:
-            print(f"❌ Error loading model {version}: {e}")
+            logger.error(f"Error loading model {version}: {e}")
             return None
-    return None
+        load_sec = time.perf_counter() - t0
+        ram, vram = model_footprint(model)
+
+        with self._lock:
+            info = self._info.setdefault(version, {"loads": 0, "hits": 0, "evictions": 0})
+            info.update(load_sec=load_sec, ram_bytes=ram, vram_bytes=vram, loads=info["loads"] + 1)
+            self._models[version] = model
+            self._evict_until_fits(keep=version)
+        logger.info(f"Model {version} loaded", extra={"fields": {
+            "load_sec": round(load_sec, 2), "ram_mb": round(ram / 2**20), "vram_mb": round(vram / 2**20)}})
+        return model
+
+    def evict(self, version):
+        with self._lock:
+            model = self._models.pop(version, None)
+            if model is None: return False
+            self._info[version]["evictions"] += 1
+        logger.info(f"Evicted model {version}")
+        # conditioning ของ Reference ที่คำนวณด้วยโมเดลนี้ก็ทิ้งด้วย (อยู่บน GPU เดียวกัน)
+        model_type = getattr(model, "model_type", None)
+        if model_type is not None:
+            reference_cache.drop_conditioning(model_type)
+        del model
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+        return True
+
+    def prewarm(self, versions):
+        """
+        โหลดโมเดลใน background thread (ไม่บล็อก startup); request ที่มาก่อนโหลดเสร็จจะรอการโหลดเดียวกัน
+        """
+        versions = [v for v in versions if v]
+        def run():
+            for version in versions:
+                self.get(version)
+        thread = threading.Thread(target=run, name="model-prewarm", daemon=True)
+        thread.start()
+        return thread
+
+    def clear(self):
+        with self._lock:
+            for version in list(self._models):
+                self.evict(version)
+
+    def __contains__(self, version):
+        with self._lock:
+            return version in self._models
+
+    def stats(self):
+        with self._lock:
+            ram, vram = self._usage()
+            return {
+                "ram_bytes": ram,
+                "vram_bytes": vram,
+                "ram_budget": self.ram_budget,
+                "vram_budget": self.vram_budget,
+                "resident": list(self._models),
+                "loading": list(self._loading),
+                "models": {v: dict(info, resident=v in self._models) for v, info in self._info.items()},
+            }
+
+model_manager = ModelManager(
+    ram_budget=config.MODEL_RAM_BUDGET_MB * 1024 * 1024,
+    vram_budget=config.MODEL_VRAM_BUDGET_MB * 1024 * 1024,
+)
+
+def get_tts_model(version="v1"):
+    return model_manager.get(version)
 
 def clear_cache():
-    global model_cache
-    model_cache.clear()
+    model_manager.clear()
+    reference_cache.clear()
+    if segment_cache: segment_cache.clear()
     if torch.cuda.is_available():
-        torch.cuda.empty_cache()
\ No newline at end of file
+        torch.cuda.empty_cache()
+
+def limit_threads(n):
+    """
+    จำกัด thread ของ torch (intra-op) และ BLAS/OpenMP ของ numpy ใน process นี้ (หลาย worker บนเครื่องเดียว)
+    ใช้ threadpoolctl ถ้าติดตั้งไว้ ไม่งั้นพึ่ง OMP_NUM_THREADS ฯลฯ ที่ serve.py ตั้งไว้ก่อน import numpy
+    """
+    torch.set_num_threads(n)
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        return
+    threadpool_limits(n)
+
+# --- Reference Cache ---
+# ใช้ร่วมกันทุก request/segment: decode + resample + conditioning ทำครั้งเดียวต่อเสียง
+reference_cache = ReferenceCache(max_bytes=config.REF_CACHE_MAX_MB * 1024 * 1024)
+
+class ReferenceDecodeError(ValueError):
+    """
+    decode Reference ไม่ได้ (ไฟล์ไม่ใช่เสียง/เสียหาย/ว่าง): upload -> 400, ไฟล์ default ที่ตั้งไว้ -> 500
+    """
+
+def load_reference(source, ref_text):
+    """
+    คืน ReferenceAudio จาก path, bytes หรือ file-like ที่อัปโหลด (ใช้ cache ตาม SHA-256 ของเสียง + ref_text)
+    เสียงที่อัปโหลดถูก decode จาก buffer/spooled file โดยตรง ไม่เขียนลงดิสก์
+    โยน ReferenceDecodeError ถ้า decode ไม่ได้ (ไม่เก็บลง cache)
+    """
+    if isinstance(source, str):
+        digest = reference_cache.file_digest(source)
+    else:
+        digest = audio_digest(source)
+    key = reference_key(digest, ref_text)
+
+    ref = reference_cache.get(key)
+    if ref is not None:
+        return ref
+
+    try:
+        waveform, sr = audio_utils.load_audio(source)
+    except Exception as e:
+        raise ReferenceDecodeError(f"Could not decode reference audio: {e}") from e
+    if len(waveform) == 0:
+        raise ReferenceDecodeError("Reference audio is empty")
+
+    path = source if isinstance(source, str) else None
+    ref = ReferenceAudio(key, path, ref_text, waveform, sr)
+    reference_cache.put(key, ref)
+    logger.info(f"Cached reference {key[:8]}", extra={"fields": {"duration_sec": round(ref.duration, 2)}})
+    return ref
+
+_ref_file_lock = threading.Lock()
+
+def reference_path(ref):
+    """
+    path ของ Reference สำหรับโมเดลที่รับแต่ไฟล์ เสียงที่อัปโหลดจะถูกเขียนเป็น WAV (ชื่อไม่ซ้ำ)
+    ครั้งแรกที่ต้องใช้เท่านั้น และถูกลบเมื่อ Reference โดน evict จาก cache
+    """
+    if ref.path is None:
+        with _ref_file_lock:
+            if ref.path is None:
+                fd, path = tempfile.mkstemp(prefix=f"ref_{ref.key[:16]}_", suffix=".wav",
+                                            dir=os.path.join(config.DATA_DIR, "temp"))
+                with os.fdopen(fd, "wb") as f:
+                    sf.write(f, ref.waveform, ref.sr, format="WAV")
+                ref.owns_file = True
+                ref.path = path
+    return ref.path
+
+def reference_input(model, ref):
+    """
+    ค่า ref_audio ที่ส่งให้ model.infer: waveform (ถ้าโมเดลรับ array ได้) หรือ path
+    """
+    if getattr(model, "accepts_waveform", False):
+        return ref.waveform
+    return reference_path(ref)
+
+def _get_f5_conditioning(model, ref):
+    """
+    Conditioning ของ F5 (แยกตาม model version) เก็บไว้ใน ReferenceAudio
+    """
+    cond = ref.conditioning.get(model.model_type)
+    if cond is None:
+        cond = _prepare_f5_reference(model, reference_path(ref), ref.ref_text)
+        ref.conditioning[model.model_type] = cond
+        reference_cache.resize(ref.key)
+    return cond
+
+# --- Segment Cache ---
+segment_cache = None
+if config.SEGMENT_CACHE_ENABLED:
+    segment_cache = SegmentCache(
+        max_bytes=config.SEGMENT_CACHE_MAX_MB * 1024 * 1024,
+        cache_dir=config.SEGMENT_CACHE_DIR,
+        disk_max_bytes=config.SEGMENT_CACHE_DISK_MAX_MB * 1024 * 1024,
+    )
+
+def segment_cache_key(gen_text, model_version, ref, step, cfg, speed, fix_duration=None):
+    return segment_key(gen_text, model_version, ref.key, step, cfg, speed, fix_duration)
+
+# --- Batched Inference ---
+
+def to_mono(wav):
+    """
+    แปลงผลลัพธ์จาก model.infer ให้เป็น numpy 1 มิติเสมอ
+    """
+    if isinstance(wav, tuple): wav = wav[0]
+    if hasattr(wav, 'shape') and len(wav.shape) > 1: wav = wav.flatten()
+    return wav
+
+def _prepare_f5_reference(model, ref_audio, ref_text):
+    """
+    เตรียม Reference (ตัดเงียบ, resample, ปรับ RMS) ครั้งเดียวต่อ batch
+    แทนที่จะทำซ้ำทุก Segment เหมือน model.infer
+    """
+    import torchaudio
+    from f5_tts_th import utils_infer as ui
+
+    ref_file, ref_text = ui.preprocess_ref_audio_text(ref_audio, ref_text)
+    audio, sr = torchaudio.load(ref_file)
+    if audio.shape[0] > 1:
+        audio = torch.mean(audio, dim=0, keepdim=True)
+
+    rms = torch.sqrt(torch.mean(torch.square(audio)))
+    if rms < ui.target_rms:
+        audio = audio * ui.target_rms / rms
+    if sr != ui.target_sample_rate:
+        audio = torchaudio.transforms.Resample(sr, ui.target_sample_rate)(audio)
+
+    if len(ref_text[-1]) == 1:
+        ref_text = ref_text + " "
+    use_ipa = model.model_type != "v1"
+    if use_ipa:
+        ref_text = ui.th_to_g2p(ref_text)
+
+    return {
+        "audio": audio.to(ui.device),
+        "rms": float(rms),
+        "ref_text": ref_text,
+        "use_ipa": use_ipa,
+    }
+
+def _f5_infer_batch(model, refs, gen_texts, step, speeds, cfg, fix_durations):
+    """
+    รัน F5 หลาย Segment ใน forward pass เดียว (pad ด้วย duration ต่อ Segment)
+    refs/speeds เป็นค่าต่อ Segment: Reference ต่างกันได้ (pad cond แล้วบอกความยาวจริงผ่าน lens)
+    """
+    from f5_tts_th import utils_infer as ui
+
+    hop, sr = ui.hop_length, ui.target_sample_rate
+    ref_lens = [ref["audio"].shape[-1] // hop for ref in refs]
+
+    texts, durations = [], []
+    for ref, ref_audio_len, gen_text, speed, fix_duration in zip(refs, ref_lens, gen_texts, speeds, fix_durations):
+        gen_text = ui.normalize_text(gen_text)
+        gen_text_ipa = ui.th_to_g2p(gen_text)
+        final_text = gen_text_ipa if ref["use_ipa"] else gen_text
+        texts.append(ref["ref_text"] + " " + final_text)
+
+        if fix_duration is not None:
+            durations.append(int(fix_duration * sr / hop))
+        else:
+            gen_len = int(len(gen_text_ipa) * 5 / speed)
+            if gen_len < 50:
+                gen_len *= 2
+            durations.append(ref_audio_len + gen_len)
+
+    batch = len(texts)
+    first = refs[0]["audio"]
+    if all(ref is refs[0] for ref in refs):
+        cond, lens = first.expand(batch, -1), None
+    else:
+        max_len = max(ref["audio"].shape[-1] for ref in refs)
+        cond = torch.zeros(batch, max_len, dtype=first.dtype, device=first.device)
+        for i, ref in enumerate(refs):
+            cond[i, :ref["audio"].shape[-1]] = ref["audio"][0]
+        lens = torch.tensor(ref_lens, device=first.device, dtype=torch.long)
+
+    with torch.inference_mode():
+        generated, _ = model.f5_model.sample(
+            cond=cond,
+            text=texts,
+            duration=torch.tensor(durations, device=first.device, dtype=torch.long),
+            lens=lens,
+            steps=step,
+            cfg_strength=cfg,
+            sway_sampling_coef=ui.sway_sampling_coef,
+        )
+        generated = generated.to(torch.float32)
+
+        wavs = []
+        for i, (ref, ref_audio_len, duration) in enumerate(zip(refs, ref_lens, durations)):
+            mel = generated[i:i + 1, ref_audio_len:duration, :].permute(0, 2, 1)
+            wave = model.vocoder.decode(mel)
+            if ref["rms"] < ui.target_rms:
+                wave = wave * ref["rms"] / ui.target_rms
+            wavs.append(wave.squeeze().cpu().numpy())
+    return wavs
+
+def _resolve_reference(model, ref_audio, ref_text):
+    """
+    คืน (ref_audio สำหรับ model.infer, conditioning ของ F5 หรือ None) จาก path หรือ ReferenceAudio
+    """
+    if isinstance(ref_audio, ReferenceAudio):
+        if hasattr(model, "f5_model"):
+            return None, _get_f5_conditioning(model, ref_audio)
+        return reference_input(model, ref_audio), None
+    cond = _prepare_f5_reference(model, ref_audio, ref_text) if hasattr(model, "f5_model") else None
+    return ref_audio, cond
+
+def prepare_reference(model, ref):
+    """
+    เตรียม Reference ล่วงหน้าสำหรับโมเดลนี้ (conditioning ของ F5 หรือไฟล์สำหรับโมเดลที่รับแต่ path)
+    ใช้ตอน warm-up เพื่อไม่ให้ request แรกของแต่ละเสียงต้องจ่ายค่านี้
+    """
+    return _resolve_reference(model, ref, ref.ref_text)
+
+def _infer_direct(model, ref_audio, ref_text, gen_texts, step, speed, cfg, fix_durations, batch_size,
+                  cancel_event=None):
+    ref_audio, ref = _resolve_reference(model, ref_audio, ref_text)
+
+    order = sorted(range(len(gen_texts)), key=lambda i: len(gen_texts[i]))
+    results = [None] * len(gen_texts)
+
+    for start in range(0, len(order), batch_size):
+        check_cancelled(cancel_event)
+        idx = order[start:start + batch_size]
+        texts = [gen_texts[i] for i in idx]
+        durs = [fix_durations[i] for i in idx]
+
+        if ref is not None:
+            wavs = _f5_infer_batch(model, [ref] * len(texts), texts, step, [speed] * len(texts), cfg, durs)
+        elif hasattr(model, "infer_batch"):
+            wavs = model.infer_batch(ref_audio=ref_audio, ref_text=ref_text, gen_texts=texts,
+                                     step=step, speed=speed, cfg=cfg, fix_durations=durs)
+        else:
+            wavs = [model.infer(ref_audio=ref_audio, ref_text=ref_text, gen_text=t,
+                                step=step, speed=speed, cfg=cfg, fix_duration=d)
+                    for t, d in zip(texts, durs)]
+
+        for i, wav in zip(idx, wavs):
+            results[i] = to_mono(wav)
+
+    return results
+
+def infer_batch(model, ref_audio, ref_text, gen_texts, step=32, speed=1.0, cfg=2.0,
+                fix_durations=None, batch_size=None, cancel_event=None):
+    """
+    สังเคราะห์เสียงหลาย Segment พร้อมกันเป็น batch ละ batch_size
+    - ref_audio เป็น path หรือ ReferenceAudio (ใช้ conditioning ที่ cache ไว้)
+    - เรียงตามความยาวข้อความก่อนจัด batch เพื่อลด padding แล้วคืนผลตามลำดับเดิม
+    - Model ที่ไม่รองรับ batch จะ fallback ไปเรียก model.infer ทีละ Segment
+    - ถ้าเปิด coalescer: ส่ง Segment เข้าคิวรวมกับ request อื่นที่ใช้ model/step/cfg เดียวกัน แล้วรอผล
+    - cancel_event: โยน InferenceCancelled ก่อนเริ่ม batch ถัดไปเมื่อถูกยกเลิก (client หลุด/timeout)
+    """
+    if not gen_texts: return []
+    batch_size = batch_size or config.INFER_BATCH_SIZE
+    fix_durations = list(fix_durations) if fix_durations else [None] * len(gen_texts)
+
+    check_cancelled(cancel_event)
+    if coalescer is not None:
+        futures = coalescer.submit(model, step, cfg, [
+            (ref_audio, ref_text, t, d, speed) for t, d in zip(gen_texts, fix_durations)
+        ])
+        return [f.result() for f in futures]
+
+    return _infer_direct(model, ref_audio, ref_text, gen_texts, step, speed, cfg, fix_durations, batch_size,
+                         cancel_event)
+
+def _infer_items(model, step, cfg, items):
+    """
+    รัน Segment ที่ coalescer รวบรวมมาจากหลาย request (item = (ref_audio, ref_text, text, fix_duration, speed))
+    F5: forward pass เดียวแม้ Reference/speed ต่างกัน; Model อื่น: แบ่งกลุ่มตาม Reference + speed
+    """
+    if hasattr(model, "f5_model"):
+        conds = {}
+        refs = []
+        for ref_audio, ref_text, _, _, _ in items:
+            key = (ref_audio.key if isinstance(ref_audio, ReferenceAudio) else ref_audio, ref_text)
+            if key not in conds:
+                conds[key] = _resolve_reference(model, ref_audio, ref_text)[1]
+            refs.append(conds[key])
+        wavs = _f5_infer_batch(model, refs, [it[2] for it in items], step,
+                               [it[4] for it in items], cfg, [it[3] for it in items])
+        return [to_mono(w) for w in wavs]
+
+    groups = {}
+    for i, (ref_audio, ref_text, _, _, speed) in enumerate(items):
+        key = (ref_audio.key if isinstance(ref_audio, ReferenceAudio) else ref_audio, ref_text, speed)
+        groups.setdefault(key, []).append(i)
+
+    results = [None] * len(items)
+    for idx in groups.values():
+        ref_audio, ref_text, _, _, speed = items[idx[0]]
+        wavs = _infer_direct(model, ref_audio, ref_text, [items[i][2] for i in idx], step, speed, cfg,
+                             [items[i][3] for i in idx], len(idx))
+        for i, wav in zip(idx, wavs):
+            results[i] = wav
+    return results
+
+class BatchCoalescer:
+    """
+    รวม Segment จากหลาย request ที่มาพร้อมกัน (model + step + cfg เดียวกัน) เป็น batch เดียว
+    รอไม่เกิน max_wait วินาทีนับจาก Segment แรกในกลุ่ม หรือจนครบ max_batch แล้วรันบน dispatcher thread
+    ผลลัพธ์ถูกส่งกลับผ่าน Future ของแต่ละ Segment
+    """
+    def __init__(self, max_batch=16, max_wait=0.01):
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.batches = 0
+        self.items = 0
+        self._pending = OrderedDict()   # (id(model), step, cfg) -> (model, [(item, future, t_submit)])
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def submit(self, model, step, cfg, items):
+        key = (id(model), step, cfg)
+        futures = [Future() for _ in items]
+        now = time.perf_counter()
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop, name="tts-coalescer", daemon=True)
+                self._thread.start()
+            entry = self._pending.setdefault(key, (model, []))
+            entry[1].extend((item, future, now) for item, future in zip(items, futures))
+            self._cond.notify_all()
+        return futures
+
+    def _next_batch(self):
+        with self._cond:
+            while not self._pending:
+                self._cond.wait()
+            key, (model, queue) = next(iter(self._pending.items()))
+            deadline = queue[0][2] + self.max_wait
+            while len(queue) < self.max_batch:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0: break
+                self._cond.wait(remaining)
+            batch, rest = queue[:self.max_batch], queue[self.max_batch:]
+            if rest:
+                self._pending[key] = (model, rest)
+                self._pending.move_to_end(key)
+            else:
+                del self._pending[key]
+            self.batches += 1
+            self.items += len(batch)
+            return model, key, batch
+
+    def _loop(self):
+        while True:
+            model, (_, step, cfg), batch = self._next_batch()
+            try:
+                wavs = _infer_items(model, step, cfg, [item for item, _, _ in batch])
+                for (_, future, _), wav in zip(batch, wavs):
+                    future.set_result(wav)
+            except Exception as e:
+                for _, future, _ in batch:
+                    future.set_exception(e)
+
+    def stats(self):
+        with self._cond:
+            return {
+                "batches": self.batches,
+                "items": self.items,
+                "avg_batch_size": (self.items / self.batches) if self.batches else 0.0,
+                "pending": sum(len(q) for _, q in self._pending.values()),
+            }
+
+coalescer = None
+if config.COALESCE_ENABLED:
+    coalescer = BatchCoalescer(max_batch=config.COALESCE_MAX_BATCH, max_wait=config.COALESCE_MAX_WAIT_MS / 1000)
+
+def _pick_candidate(candidates):
+    """
+    candidate แรกที่ผ่าน quality gate (คืน index) หรือ None
+    """
+    for j, wav in enumerate(candidates):
+        if quality_gate.check_segment(wav) is None:
+            return j
+    return None
+
+def _synthesize_group(model, model_version, ref, gen_texts, step, speed, cfg, fix_durations, retry_duration,
+                      cancel_event=None, usage=None):
+    """
+    Segment กลุ่มเดียว: ดู segment_cache -> infer_batch เฉพาะที่ไม่มี -> quality gate -> retry -> เก็บลง cache
+    - ประเภทข้อความที่ fail บ่อย (ดู quality_gate.stats) จะได้ candidate สำรองที่ duration ทำนายไว้ใน batch แรกเลย
+    - ที่ยังไม่ผ่าน: retry ด้วย duration ทำนาย x QUALITY_RETRY_SCALES (ทุก candidate ใน batch เดียว)
+      ที่ยังไม่ผ่านอีกค่อย retry รอบสองด้วย retry_duration (ยาวสุด จึงไม่ปนกับรอบแรกที่ถูกกว่า)
+    retry_duration=None ปิดการ retry; Segment ที่สุดท้ายยังไม่ผ่าน gate จะไม่ถูกเก็บลง cache
+    usage: dict ที่สะสม chars/seconds ของ inference รอบแรก (เฉพาะ Segment ที่ไม่อยู่ใน cache, ไม่รวม retry)
+    """
+    keys = [segment_cache_key(t, model_version, ref, step, cfg, speed, d)
+            for t, d in zip(gen_texts, fix_durations)]
+    wavs = [segment_cache.get(k) if segment_cache else None for k in keys]
+    miss_idx = [i for i, wav in enumerate(wavs) if wav is None]
+    if segment_cache: logger.debug(f"Segment cache hits: {len(wavs) - len(miss_idx)}/{len(wavs)}")
+
+    classes = {i: quality_gate.text_class(gen_texts[i]) for i in miss_idx}
+    spec_idx = []
+    if retry_duration is not None:
+        spec_idx = [i for i in miss_idx if quality_gate.stats.should_speculate(model_version, classes[i])]
+
+    infer_texts = [gen_texts[i] for i in miss_idx + spec_idx]
+    t0 = time.perf_counter()
+    with observability.stage("infer"):
+        generated = infer_batch(
+            model, ref, ref.ref_text, infer_texts,
+            step=step, speed=speed, cfg=cfg,
+            fix_durations=[fix_durations[i] for i in miss_idx]
+                          + [quality_gate.predict_duration(gen_texts[i], ref, speed) for i in spec_idx],
+            cancel_event=cancel_event
+        )
+    if usage is not None and infer_texts:
+        usage["chars"] += sum(len(t) for t in infer_texts)
+        usage["seconds"] += time.perf_counter() - t0
+    speculative = dict(zip(spec_idx, generated[len(miss_idx):]))
+
+    failed_idx = []
+    for i, wav in zip(miss_idx, generated):
+        reason = quality_gate.check_segment(wav)
+        quality_gate.stats.record_check(model_version, classes[i], reason)
+        if i in speculative: quality_gate.stats.record(model_version, classes[i], "speculated")
+        if reason is not None and i in speculative and _pick_candidate([speculative[i]]) is not None:
+            wav = speculative[i]
+            reason = None
+            quality_gate.stats.record(model_version, classes[i], "speculative_used")
+        wavs[i] = wav
+        if reason is not None: failed_idx.append(i)
+
+    # Retry 2 รอบ: F5 pad ทั้ง batch ตาม duration ที่ยาวสุด รอบแรกจึงใช้แค่ duration ทำนาย x QUALITY_RETRY_SCALES
+    # (batch สั้น) แล้วค่อยใช้ retry_duration (ref + 6s) กับ Segment ที่ยังไม่ผ่านเท่านั้น
+    if failed_idx and retry_duration is not None:
+        logger.warning(f"Degenerate output in {len(failed_idx)} segments, retrying with predicted duration")
+        for i in failed_idx:
+            quality_gate.stats.record(model_version, classes[i], "retried")
+        rounds = [lambda i: [quality_gate.predict_duration(gen_texts[i], ref, speed) * scale
+                             for scale in config.QUALITY_RETRY_SCALES],
+                  lambda i: [retry_duration]]
+        for durations in rounds:
+            if not failed_idx: break
+            candidates = {i: durations(i) for i in failed_idx}
+            retry_items = [(i, d) for i in failed_idx for d in candidates[i]]
+            if not retry_items: continue
+            with observability.stage("retry"):
+                retried = infer_batch(
+                    model, ref, ref.ref_text, [gen_texts[i] for i, _ in retry_items],
+                    step=step, speed=speed, cfg=cfg,
+                    fix_durations=[d for _, d in retry_items],
+                    cancel_event=cancel_event
+                )
+            pos = 0
+            still_failed = []
+            for i in failed_idx:
+                options = retried[pos:pos + len(candidates[i])]
+                pos += len(candidates[i])
+                j = _pick_candidate(options)
+                if j is not None:
+                    quality_gate.stats.record(model_version, classes[i], "recovered")
+                    wavs[i] = options[j]
+                else:
+                    wavs[i] = options[-1]
+                    still_failed.append(i)
+            failed_idx = still_failed
+
+    # เก็บเฉพาะ Segment ที่ผ่าน quality gate: เสียงเสียไม่ถูกจำถาวร request ถัดไปจะได้ลองใหม่
+    if segment_cache:
+        failed = set(failed_idx)
+        for i in miss_idx:
+            if i not in failed:
+                segment_cache.put(keys[i], wavs[i])
+    return wavs
+
+def synthesize_segments(model, model_version, ref, gen_texts, step=32, speed=1.0, cfg=2.0,
+                        fix_durations=None, retry_duration=None, batch_size=None, first_batch_size=None,
+                        cancel_event=None, cfg_skip_chars=0, usage=None):
+    """
+    Generator: yield เสียงดิบของแต่ละ Segment ตามลำดับ
+    - first_batch_size: (โหมด stream) สังเคราะห์กลุ่มแรกให้เล็ก เพื่อให้ได้เสียงแรกเร็วที่สุด
+      จากนั้นทำทีละ batch_size ตามลำดับ; ถ้าไม่กำหนดจะส่งทั้งหมดให้ infer_batch ครั้งเดียว
+    - cancel_event: หยุดก่อนเริ่ม model batch ถัดไป (รวม retry) เมื่อถูกยกเลิก (client หลุด/timeout)
+    - cfg_skip_chars: Segment ที่สั้นกว่านี้ใช้ cfg=0 (ดู step_control) แยก batch กับที่เหลือแล้วเรียงกลับตามลำดับเดิม
+    - usage: dict {"chars": 0, "seconds": 0.0} สะสมตัวอักษรที่ inference จริงและเวลาที่ใช้ (ไม่รวม cache hit,
+      retry และกลุ่มที่ข้าม CFG) สำหรับ step_control
+    """
+    if not gen_texts: return
+    batch_size = batch_size or config.INFER_BATCH_SIZE
+    fix_durations = list(fix_durations) if fix_durations else [None] * len(gen_texts)
+
+    if first_batch_size:
+        bounds = [0, min(first_batch_size, len(gen_texts))]
+        while bounds[-1] < len(gen_texts):
+            bounds.append(min(bounds[-1] + batch_size, len(gen_texts)))
+    else:
+        bounds = [0, len(gen_texts)]
+
+    for start, end in zip(bounds, bounds[1:]):
+        check_cancelled(cancel_event)
+        texts, durs = gen_texts[start:end], fix_durations[start:end]
+        short = {i for i, t in enumerate(texts) if len(t) < cfg_skip_chars} if cfg and cfg_skip_chars else set()
+        if not short:
+            yield from _synthesize_group(model, model_version, ref, texts, step, speed, cfg, durs, retry_duration,
+                                         cancel_event, usage)
+            continue
+        wavs = [None] * len(texts)
+        for idx, group_cfg in ((sorted(short), 0.0), ([i for i in range(len(texts)) if i not in short], cfg)):
+            if not idx: continue
+            group = _synthesize_group(model, model_version, ref, [texts[i] for i in idx], step, speed, group_cfg,
+                                      [durs[i] for i in idx], retry_duration, cancel_event,
+                                      usage if group_cfg else None)
+            for i, wav in zip(idx, group):
+                wavs[i] = wav
+        yield from wavs
+
+def plan_segments(gen_text, ref_duration_sec, is_use_norm=True):
+    """
+    Auto Split: ตัดข้อความเป็น Segment (+ normalize) แล้วกำหนด fix_duration ให้ข้อความสั้น
+    คืน (seg_texts, forced_durs) ใช้ร่วมกันระหว่าง API และ batch job
+    """
+    with observability.stage("split"):
+        segments = text_utils.intelligent_split(gen_text)
+    logger.debug(f"Split into {len(segments)} segments")
+
+    # Normalize segment if needed (ทุก Segment ใน word_tokenize ครั้งเดียว)
+    if is_use_norm:
+        with observability.stage("normalize"):
+            segments = [normalized for normalized, _ in text_utils.normalize_many(segments)]
+    seg_texts = [seg for seg in segments if seg.strip()]
+
+    # Logic: Short Text
+    forced_durs = []
+    for i, seg_to_gen in enumerate(seg_texts):
+        is_short = len(seg_to_gen) < 15
+        forced_dur = (ref_duration_sec + 2.0) if is_short else None
+        forced_durs.append(forced_dur)
+        logger.debug(f"[{i+1}/{len(seg_texts)}] Generating: {seg_to_gen}")
+        if is_short: logger.debug(f"Short text -> Force Duration: {forced_dur:.2f}s")
+    return seg_texts, forced_durs
+
+# --- Inference Scheduler ---
+
+class QueueFullError(Exception):
+    """
+    คิวเต็ม: ให้ผู้เรียกตอบ 429 พร้อม Retry-After (วินาที)
+    """
+    def __init__(self, retry_after):
+        super().__init__(f"Inference queue is full, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+class InferenceCancelled(Exception):
+    pass
+
+def check_cancelled(cancel_event):
+    if cancel_event is not None and cancel_event.is_set():
+        raise InferenceCancelled()
+
+class _Job:
+    def __init__(self):
+        self.cancel_event = threading.Event()
+        self.enqueued_at = time.perf_counter()
+        self.started_at = None
+
+class InferenceScheduler:
+    """
+    รันงาน inference (blocking) บน worker pool แยกจาก event loop
+    - จำกัดจำนวนงานที่รอในคิว (max_queue) เกินแล้วโยน QueueFullError
+    - timeout ต่อ request และยกเลิกงานเมื่อ client หลุด (งานต้องเช็ค cancel_event เอง ระหว่าง Segment)
+    """
+    def __init__(self, workers=1, max_queue=16, timeout=300.0):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="tts-infer")
+        self._lock = threading.Lock()
+        self.waiting = 0
+        self.running = 0
+        self.completed = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.cancelled = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.total_service = 0.0
+
+    def _admit(self):
+        with self._lock:
+            if self.waiting >= self.max_queue:
+                self.rejected += 1
+                avg_service = (self.total_service / self.completed) if self.completed else 5.0
+                retry_after = max(1, math.ceil(avg_service * (self.waiting + self.running) / self.workers))
+                raise QueueFullError(retry_after)
+            self.waiting += 1
+        return _Job()
+
+    def _start(self, job):
+        job.started_at = time.perf_counter()
+        wait = job.started_at - job.enqueued_at
+        observability.QUEUE_WAIT_SECONDS.observe(wait)
+        with self._lock:
+            self.waiting -= 1
+            self.running += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+
+    def _finish(self, job):
+        with self._lock:
+            self.running -= 1
+            self.completed += 1
+            self.total_service += time.perf_counter() - job.started_at
+
+    def _execute(self, job, fn):
+        self._start(job)
+        try:
+            if job.cancel_event.is_set():
+                raise InferenceCancelled()
+            return fn(job.cancel_event)
+        finally:
+            self._finish(job)
+
+    def _submit(self, job, fn):
+        try:
+            # ส่ง context (request_id / trace) ของผู้เรียกไปยัง worker thread ด้วย
+            return self._executor.submit(contextvars.copy_context().run, self._execute, job, fn)
+        except RuntimeError:
+            with self._lock: self.waiting -= 1
+            raise
+
+    def _cancel(self, job, future=None):
+        job.cancel_event.set()
+        if future is not None and future.cancel():
+            # ยังไม่ได้เริ่มรัน -> ออกจากคิวทันที
+            with self._lock: self.waiting -= 1
+        with self._lock: self.cancelled += 1
+
+    def call(self, fn):
+        """
+        รัน fn(cancel_event) บน worker แล้วรอผลแบบ blocking (งาน background นอก event loop เช่น Batch Job)
+        ใช้คิวและจำนวน worker เดียวกับ request ของ API: คิวเต็มโยน QueueFullError
+        """
+        job = self._admit()
+        return self._submit(job, fn).result()
+
+    async def run(self, fn, timeout=None, is_disconnected=None, poll_interval=0.5):
+        """
+        รัน fn(cancel_event) บน worker แล้วรอผล
+        is_disconnected: coroutine function (เช่น request.is_disconnected) ใช้ยกเลิกงานเมื่อ client หลุด
+        """
+        job = self._admit()
+        future = self._submit(job, fn)
+        wrapped = asyncio.wrap_future(future)
+        deadline = time.perf_counter() + (timeout or self.timeout)
+        try:
+            while True:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    with self._lock: self.timeouts += 1
+                    raise asyncio.TimeoutError()
+                done, _ = await asyncio.wait({wrapped}, timeout=min(poll_interval, remaining))
+                if done:
+                    return wrapped.result()
+                if is_disconnected is not None and await is_disconnected():
+                    raise InferenceCancelled()
+        except BaseException:
+            if not future.done():
+                self._cancel(job, future)
+                # งานจะจบด้วย InferenceCancelled ที่ไม่มีใครรอแล้ว: ดึง exception ทิ้งกัน asyncio log เตือน
+                wrapped.add_done_callback(lambda f: f.cancelled() or f.exception())
+            raise
+
+    def stream(self, gen, timeout=None):
+        """
+        วน generator (blocking) บน worker แล้วส่งแต่ละ item ออกมาเป็น async generator
+        ถ้าผู้รับหยุดอ่าน (client หลุด) งานจะถูกยกเลิกระหว่าง Segment
+        gen: callable(cancel_event) ที่คืน iterator
+        จองคิวทันทีที่เรียก (โยน QueueFullError ก่อนเริ่มส่ง response ได้)
+        """
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+        done = object()
+
+        def produce(cancel_event):
+            try:
+                for item in gen(cancel_event):
+                    if cancel_event.is_set():
+                        raise InferenceCancelled()
+                    loop.call_soon_threadsafe(queue.put_nowait, (item, None))
+                loop.call_soon_threadsafe(queue.put_nowait, (done, None))
+            except BaseException as e:
+                loop.call_soon_threadsafe(queue.put_nowait, (done, e))
+
+        job = self._admit()
+        future = self._submit(job, produce)
+        deadline = time.perf_counter() + (timeout or self.timeout)
+
+        async def consume():
+            try:
+                while True:
+                    try:
+                        item, error = await asyncio.wait_for(queue.get(), timeout=deadline - time.perf_counter())
+                    except asyncio.TimeoutError:
+                        with self._lock: self.timeouts += 1
+                        raise
+                    if error is not None:
+                        raise error
+                    if item is done:
+                        return
+                    yield item
+            except BaseException:
+                if not future.done():
+                    self._cancel(job, future)
+                raise
+
+        return consume()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "max_queue": self.max_queue,
+                "queue_depth": self.waiting,
+                "running": self.running,
+                "completed": self.completed,
+                "rejected": self.rejected,
+                "timeouts": self.timeouts,
+                "cancelled": self.cancelled,
+                "avg_wait_sec": (self.total_wait / (self.completed + self.running)) if (self.completed + self.running) else 0.0,
+                "max_wait_sec": self.max_wait,
+                "avg_service_sec": (self.total_service / self.completed) if self.completed else 0.0,
+            }
+
+scheduler = InferenceScheduler(
+    workers=config.INFER_WORKERS,
+    max_queue=config.INFER_QUEUE_SIZE,
+    timeout=config.INFER_TIMEOUT,
+)
@@ -0,0 +1,155 @@
+# warmup.py
+"""
+Warm-up ของ process หลังเริ่ม server และสถานะ readiness (GET /ready)
+- โหลดโมเดลตาม MODEL_PREWARM (ถ้า serve.py โหลดไว้ใน master ก่อน fork แล้ว จะได้ตัวเดิมทันที)
+- decode Reference ที่ลงทะเบียนไว้ (WARMUP_REFERENCES) และเตรียม conditioning ต่อโมเดลเก็บใน reference_cache
+- สังเคราะห์ประโยคสั้นๆ ต่อโมเดลที่ทุก step ใน WARMUP_STEPS เพื่อจ่าย kernel init / first-call cost ก่อนรับ traffic
+- normalize ข้อความที่ใช้บ่อย (WARMUP_PHRASES_PATH) ทั้งข้อความและราย Segment ให้อยู่ใน memo
+/ready ตอบ 503 จนกว่าจะเสร็จ ให้ load balancer / health check ส่ง traffic เข้าเฉพาะ worker ที่พร้อมแล้ว
+"""
+import os
+import json
+import time
+import logging
+import threading
+
+import config
+import text_utils
+import tts_handler
+
+logger = logging.getLogger(__name__)
+
+WARMUP_TEXT = "ขบวนรถไฟ กำลังจะเข้าสู่ชานชาลา"
+
+class Readiness:
+    """
+    สถานะ warm-up ของ process นี้ (แต่ละ worker มีของตัวเอง)
+    ready = warm-up จบแล้วและโหลดโมเดลได้ครบ; error ของขั้นอื่น (reference/inference/phrases) ไม่ทำให้ไม่พร้อม แค่บันทึกไว้
+    """
+    def __init__(self):
+        self.ready = False
+        self.error = None
+        self.started_at = None
+        self.finished_at = None
+        self.stages = {}
+        self.warmed = {}
+        self._lock = threading.Lock()
+
+    def stats(self):
+        with self._lock:
+            now = self.finished_at or time.time()
+            return {
+                "ready": self.ready,
+                "pid": os.getpid(),
+                "elapsed_sec": round(now - self.started_at, 3) if self.started_at else None,
+                "stages": dict(self.stages),
+                "warmed": dict(self.warmed),
+                "error": self.error,
+            }
+
+state = Readiness()
+
+def _stage(name, fn, *args):
+    t0 = time.perf_counter()
+    try:
+        return fn(*args)
+    finally:
+        with state._lock:
+            state.stages[name] = round(time.perf_counter() - t0, 3)
+
+def _optional_stage(name, fn, *args):
+    """
+    ขั้นที่พลาดได้: log + เก็บ error ไว้ แต่ process ยังพร้อมรับ request
+    """
+    try:
+        return _stage(name, fn, *args)
+    except Exception as e:
+        logger.exception(f"Warm-up {name} failed: {e}")
+        with state._lock:
+            state.error = f"{state.error}; {name}: {e}" if state.error else f"{name}: {e}"
+
+def load_phrases(path):
+    """
+    ข้อความที่ใช้บ่อยจากไฟล์: .json (list หรือ key ของ dict เช่นไฟล์รายชื่อสถานี) หรือ text บรรทัดละข้อความ
+    """
+    if not path: return []
+    if not os.path.exists(path):
+        logger.warning(f"Warm-up phrases not found: {path}")
+        return []
+    with open(path, encoding="utf-8") as f:
+        if path.endswith(".json"):
+            return [str(p).strip() for p in json.load(f) if str(p).strip()]
+        return [line.strip() for line in f if line.strip()]
+
+def _load_models(versions):
+    missing = [v for v in versions if tts_handler.model_manager.get(v) is None]
+    if missing:
+        raise RuntimeError(f"Model(s) failed to load: {', '.join(missing)}")
+
+def _prepare_references(versions):
+    refs = []
+    for path, ref_text in config.WARMUP_REFERENCES:
+        if not os.path.exists(path):
+            logger.warning(f"Warm-up reference skipped: {path} not found")
+            continue
+        ref = tts_handler.load_reference(path, ref_text)
+        for version in versions:
+            tts_handler.prepare_reference(tts_handler.model_manager.get(version), ref)
+        refs.append(ref)
+    return refs
+
+def _infer(versions, ref, step):
+    for version in versions:
+        model = tts_handler.model_manager.get(version)
+        tts_handler.infer_batch(model, ref, ref.ref_text, [WARMUP_TEXT], step=step,
+                                speed=config.DEFAULT_SPEED, cfg=config.DEFAULT_CFG)
+
+def _normalize_phrases(phrases):
+    # ทั้งข้อความ (ไม่ Auto Split / /api/normalize) และราย Segment (plan_segments) ใช้ memo คนละ key
+    segments = [seg for phrase in phrases for seg, _, _ in text_utils.iter_segments(phrase)]
+    text_utils.normalize_many(phrases + segments)
+
+def run(versions):
+    """
+    Warm-up แบบ blocking: โหลดโมเดล แล้ว (ถ้า WARMUP_ENABLED) เตรียม Reference, inference ทุก step และ normalize phrases
+    """
+    versions = [v for v in versions if v]
+    with state._lock:
+        state.ready, state.error, state.stages, state.warmed = False, None, {}, {}
+        state.started_at, state.finished_at = time.time(), None
+    ready = True
+    try:
+        _stage("load_models", _load_models, versions)
+    except Exception as e:
+        logger.error(f"Warm-up failed: {e}")
+        state.error = str(e)
+        ready = False
+
+    if ready and config.WARMUP_ENABLED:
+        refs = _optional_stage("references", _prepare_references, versions) or []
+        steps = list(dict.fromkeys(config.WARMUP_STEPS)) if refs else []
+        if refs:
+            for step in steps:
+                _optional_stage(f"inference_step{step}", _infer, versions, refs[0], step)
+        else:
+            logger.warning("Warm-up inference skipped: no reference available")
+        phrases = load_phrases(config.WARMUP_PHRASES_PATH)
+        if phrases:
+            _optional_stage("phrases", _normalize_phrases, phrases)
+        state.warmed = {"references": len(refs), "steps": steps, "phrases": len(phrases)}
+
+    with state._lock:
+        state.ready = ready
+        state.finished_at = time.time()
+    logger.info("Warm-up finished" if ready else "Warm-up finished, not ready",
+                extra={"fields": {**{f"{name}_sec": sec for name, sec in state.stages.items()}, **state.warmed,
+                                  "total_sec": round(state.finished_at - state.started_at, 3)}})
+    return ready
+
+def start(versions):
+    """
+    รัน warm-up ใน background thread (ไม่บล็อก startup); request ที่มาระหว่างโหลดโมเดลจะรอการโหลดเดียวกัน
+    """
+    thread = threading.Thread(target=run, args=(versions,), name="warmup", daemon=True)
+    thread.start()
+    return thread